@@ -1,3 +1,4 @@
+import hashlib
 import time
 import warnings
 
@@ -7,6 +8,18 @@ import h5py
 from abr_analyze.paths import database_dir
 
 
+def _hash_values(values, previous=''):
+    """
+    Returns a hash of the type, shape and contents of values, chained onto a
+    previous hash if there is one
+    """
+    values = np.ascontiguousarray(values)
+    hasher = hashlib.sha1(previous.encode())
+    hasher.update(('%s%s' % (values.dtype, values.shape)).encode())
+    hasher.update(values.tobytes())
+    return hasher.hexdigest()
+
+
 class DataHandler():
     """
     Data handler for saving and loading data
@@ -33,20 +46,26 @@ class DataHandler():
     ----------
     db_name: string, Optional (Default: abr_analyze)
         name of the database being used
+    read_only: boolean, Optional (Default: False)
+        True to open the database in read mode only. The database is not
+        created if it does not exist, and several processes can load from it
+        at the same time. Saving is not possible in this mode
     """
 
-    def __init__(self, db_name='abr_analyze'):
+    def __init__(self, db_name='abr_analyze', read_only=False):
         self.ERRORS = []
         self.db_loc = '%s/%s.h5'%(database_dir, db_name)
+        self.read_only = read_only
+        self.mode = 'r' if read_only else 'a'
         # Instantiate the database object with the provided path so that it
         # gets created if it does not yet exist
-        db = h5py.File(self.db_loc, 'a')
+        db = h5py.File(self.db_loc, self.mode)
         # close the database after each function
         db.close()
 
 
     def save(self, data, save_location, overwrite=False, create=True,
-             timestamp=True):
+             timestamp=True, hash_data=False):
         """
         Saves the data dict passed in to the save_location specified in the
         instantiated database
@@ -73,11 +92,18 @@ class DataHandler():
             exist, or to warn to the user that it does not
         timestamp: boolean, Optional (Default: True)
             whether to save timestamp with data
+        hash_data: boolean, Optional (Default: False)
+            True to save a hash of each dataset with it, used by
+            get_modification_id. This reads all of the data a second time
+            while saving, so it is off by default and the hash is instead
+            computed and saved the first time get_modification_id is called
         """
 
         if not isinstance(data, dict):
             raise TypeError('ERROR: data must be a dict, received ',
                             type(data))
+        if self.read_only:
+            raise Exception('Can not save to a read only DataHandler')
 
         db = h5py.File(self.db_loc, 'a')
         if not self.check_group_exists(save_location):
@@ -93,14 +119,14 @@ class DataHandler():
                     data[key] = 'None'
                 try:
                     try:
-                        db[save_location].create_dataset(
+                        dataset = db[save_location].create_dataset(
                             '%s' % key, data=data[key])
 
                     except RuntimeError as e:
                         if overwrite:
                             # if dataset already exists, then overwrite data
                             del db[save_location+'/%s'%key]
-                            db[save_location].create_dataset(
+                            dataset = db[save_location].create_dataset(
                                 '%s' % key, data=data[key])
                         else:
                             print(e)
@@ -108,6 +134,10 @@ class DataHandler():
                                 'Dataset %s already exists in %s' %
                                 (save_location, key) +
                                 ': set overwrite=True to overwrite')
+                    if hash_data:
+                        # identifies this version of the data, see
+                        # get_modification_id
+                        dataset.attrs['sha1'] = _hash_values(data[key])
                 except TypeError as type_error:
                     print('\n\n*****WARNING: SOME DATA DID NOT SAVE*****')
                     print('Trying to save %s to %s' % (key, save_location))
@@ -119,6 +149,56 @@ class DataHandler():
         db.close()
 
 
+    def append(self, data, save_location):
+        """
+        Appends the arrays in data to datasets at save_location along their
+        first axis, creating the group and resizable datasets if they do not
+        exist. Used to save results as they are generated, so they do not
+        all have to be held in memory and are kept if the process stops
+
+        Parameters
+        ----------
+        data: dictionary of arrays to append
+            the arrays of each key must have the same shape after the first
+            axis every time they are appended
+        save_location: string
+            the group that all of the data will be appended to
+        """
+        if not isinstance(data, dict):
+            raise TypeError('ERROR: data must be a dict, received ',
+                            type(data))
+        if self.read_only:
+            raise Exception('Can not save to a read only DataHandler')
+
+        db = h5py.File(self.db_loc, 'a')
+        try:
+            group = db.require_group(save_location)
+            for key in data:
+                values = np.asarray(data[key])
+                if key not in group:
+                    dataset = group.create_dataset(
+                        key, data=values, chunks=True,
+                        maxshape=(None,) + values.shape[1:])
+                    dataset.attrs['sha1'] = _hash_values(values)
+                else:
+                    dataset = group[key]
+                    if dataset.shape[1:] != values.shape[1:]:
+                        raise ValueError(
+                            'Can not append data of shape %s to %s/%s of '
+                            % (values.shape, save_location, key)
+                            + 'shape %s' % (dataset.shape,))
+                    n_rows = dataset.shape[0]
+                    dataset.resize(n_rows + values.shape[0], axis=0)
+                    dataset[n_rows:] = values
+                    if 'sha1' in dataset.attrs:
+                        # chain the hash of the appended rows onto the
+                        # previous version, see get_modification_id
+                        dataset.attrs['sha1'] = _hash_values(
+                            values, previous=str(dataset.attrs['sha1']))
+        finally:
+            db.close()
+
+
     def load(self, parameters, save_location):
         """
         Accepts a list of parameters and their path to where they are saved in
@@ -144,7 +224,7 @@ class DataHandler():
             raise ValueError('The path %s does not exist'%(save_location))
 
         # otherwise load the keys
-        db = h5py.File(self.db_loc, 'a')
+        db = h5py.File(self.db_loc, self.mode)
         saved_data = {}
         for key in parameters:
             saved_data[key] = np.array(
@@ -155,6 +235,64 @@ class DataHandler():
         return saved_data
 
 
+    def load_chunks(self, parameters, save_location, chunk_size=10000,
+                    overlap=0):
+        """
+        Generator that loads the datasets in parameters chunk_size rows at a
+        time, so that runs too long to fit in memory can be processed. The
+        database is kept open until the generator is finished
+
+        Yields (start, stop, data), where data is a dict of the rows
+        max(start - overlap, 0) to min(stop + overlap, n_rows) of each
+        parameter. The overlap is used to give operations that depend on
+        neighbouring samples, like differentiation, the context they need at
+        the edges of each chunk
+
+        PARAMETERS
+        ----------
+        parameters: list of strings
+            the keys of the datasets to load, all must have the same number
+            of rows
+        save_location: string
+            the location to look for data
+            EX: 'test_group/test_name/session_num/run_num'
+        chunk_size: positive int, Optional (Default: 10000)
+            the number of rows in each chunk, not counting the overlap
+        overlap: int, Optional (Default: 0)
+            the number of rows loaded on either side of each chunk
+        """
+        if not self.check_group_exists(location=save_location, create=False):
+            raise ValueError('The path %s does not exist'%(save_location))
+
+        db = h5py.File(self.db_loc, self.mode)
+        try:
+            datasets = {}
+            for key in parameters:
+                datasets[key] = db.get('%s/%s' % (save_location, key))
+                if datasets[key] is None:
+                    raise ValueError('%s does not exist in %s'
+                                     % (key, save_location))
+                if datasets[key].ndim == 0:
+                    raise ValueError('%s in %s is a scalar and can not be '
+                                     % (key, save_location)
+                                     + 'loaded in chunks')
+            lengths = set(datasets[key].shape[0] for key in parameters)
+            if len(lengths) > 1:
+                raise ValueError('The datasets %s in %s have different '
+                                 % (parameters, save_location)
+                                 + 'numbers of rows')
+            n_rows = lengths.pop()
+
+            for start in range(0, n_rows, chunk_size):
+                stop = min(start + chunk_size, n_rows)
+                low = max(start - overlap, 0)
+                high = min(stop + overlap, n_rows)
+                yield start, stop, {
+                    key: datasets[key][low:high] for key in parameters}
+        finally:
+            db.close()
+
+
     def delete(self, save_location):
         '''
         Deletes save_location and all contents from instantiated database
@@ -202,7 +340,7 @@ class DataHandler():
             save_location of the group that you want the keys from
             ex: 'my_feature_test/sub_test_group/session000/run003'
         """
-        db = h5py.File(self.db_loc, 'a')
+        db = h5py.File(self.db_loc, self.mode)
         if isinstance(db[save_location], h5py.Dataset):
             keys = [None]
         else:
@@ -224,13 +362,14 @@ class DataHandler():
         create: boolean, Optional (Default:True)
             true: create group if it does not exist
             false: do not create group if it does not exist
+            groups are never created if the DataHandler is read_only
         """
         #TODO: should we add check if location is a dataset?
-        db = h5py.File(self.db_loc, 'a')
+        db = h5py.File(self.db_loc, self.mode)
         exists = location in db
 
         if exists is False:
-            if create:
+            if create and not self.read_only:
                 db.create_group(location)
                 exists = True
             else:
@@ -240,6 +379,66 @@ class DataHandler():
         return exists
 
 
+    def get_modification_id(self, save_location, parameters=None,
+                            chunk_size=10000):
+        """
+        Returns a string identifying the current version of the data saved at
+        save_location, that changes whenever the data is overwritten. This is
+        used to check whether results generated from the data are out of date
+
+        The id is made from the hash of the contents of each dataset, which
+        is saved with the dataset so the data only has to be read once.
+        Datasets that have no saved hash are hashed in full chunk_size rows
+        at a time, and the hash is saved with them unless the DataHandler
+        is read only. append updates the saved hash, and overwriting a
+        dataset with save removes it. Data modified in place through h5py
+        keeps its saved hash, so it should be saved again with save or
+        have its 'sha1' attribute deleted. Returns None if save_location
+        does not exist
+
+        Parameters
+        ----------
+        save_location: string
+            the location of the group in the database
+        parameters: list of strings, Optional (Default: None)
+            the keys to include in the id, if None all keys in save_location
+            are included
+        chunk_size: int, Optional (Default: 10000)
+            the number of rows read at a time when hashing datasets that
+            have no saved hash
+        """
+        db = h5py.File(self.db_loc, self.mode)
+        if save_location not in db:
+            db.close()
+            return None
+
+        group = db[save_location]
+        if parameters is None:
+            parameters = sorted(group.keys())
+        identity = []
+        for key in parameters:
+            dataset = group.get(key)
+            if not isinstance(dataset, h5py.Dataset):
+                identity.append((key, None))
+            elif 'sha1' in dataset.attrs:
+                identity.append((key, str(dataset.attrs['sha1'])))
+            else:
+                if dataset.ndim == 0:
+                    content_hash = _hash_values(dataset[()])
+                else:
+                    content_hash = ''
+                    for start in range(0, dataset.shape[0], chunk_size):
+                        content_hash = _hash_values(
+                            dataset[start:start+chunk_size],
+                            previous=content_hash)
+                if not self.read_only:
+                    dataset.attrs['sha1'] = content_hash
+                identity.append((key, content_hash))
+        db.close()
+
+        return hashlib.sha1(repr(identity).encode()).hexdigest()
+
+
     #TODO: make this function
     def sample_data(self):
         '''
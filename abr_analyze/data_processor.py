@@ -4,8 +4,27 @@ calculating average and confidence intervals, scaling data, filtering data,
 and comparing to an ideal trajectory
 """
 
+import collections
+import concurrent.futures
+import hashlib
+import os
+import re
+import time
+import weakref
+
 import numpy as np
 import scipy.interpolate
+import scipy.signal
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+try:
+    import sympy
+except ImportError:
+    sympy = None
 
 from abr_analyze.data_handler import DataHandler
 
@@ -85,25 +104,294 @@ def interpolate_data(data, time_intervals, interpolated_samples):
 
     run_time = sum(time_intervals)
     sample_times = np.cumsum(time_intervals)
-    # interpolate to even samples out
-    data_interp = []
     # if our array is one dimensional, make sure to add a second
-    # dimension to avoid errors in our loop
+    # dimension so all dimensions are interpolated at once
     if data.ndim == 1:
         data = data.reshape(len(data), 1)
-    for kk in range(data.shape[1]):
-        interp = scipy.interpolate.interp1d(
-            sample_times, data[:, kk])
-        data_interp.append(np.array([
-            interp(t) for t in np.linspace(
-                sample_times[0],
-                run_time,
-                interpolated_samples)]))
-    data_interp = np.array(data_interp).T
+    # interpolate to even samples out
+    interp = scipy.interpolate.interp1d(sample_times, data, axis=0)
+    data_interp = interp(np.linspace(
+        sample_times[0], run_time, interpolated_samples))
 
     return data_interp
 
 
+def resample_data(data, time_intervals, dt):
+    """
+    Accepts data and linearly interpolates it to samples spaced dt apart.
+    Returns the resampled data and the cumulative time of each sample
+
+    Parameters
+    ----------
+    data: list of floats time x dimension
+        the data to resample
+    time_intervals: list of floats
+        the timesteps corresponding to the data (not cumulative time)
+    dt: float
+        the time between samples in the resampled data
+    """
+    data = np.asarray(data)
+    sample_times = np.cumsum(time_intervals)
+    if data.ndim == 1:
+        data = data.reshape(len(data), 1)
+
+    resample_times = np.arange(sample_times[0], sample_times[-1], dt)
+    interp = scipy.interpolate.interp1d(sample_times, data, axis=0)
+
+    return interp(resample_times), resample_times
+
+
+def decimate_data(data, factor):
+    """
+    Accepts data and returns every factor'th sample after applying an
+    anti-aliasing low pass filter. The filtering assumes the data is sampled
+    approximately evenly
+
+    Parameters
+    ----------
+    data: list of floats time x dimension
+        the data to decimate
+    factor: positive int
+        the downsampling factor
+    """
+    data = np.asarray(data, dtype=float)
+    if data.ndim == 1:
+        data = data.reshape(len(data), 1)
+    if factor <= 1:
+        return data
+
+    # polyphase filtering applies the anti-aliasing filter only at the
+    # samples that are kept
+    return scipy.signal.resample_poly(data, up=1, down=factor, axis=0)
+
+
+def stride_data(data, stride):
+    """
+    Accepts data and returns a view of every stride'th sample. No filtering
+    is applied and no data is copied
+
+    Parameters
+    ----------
+    data: list of floats time x dimension
+        the data to sample
+    stride: positive int
+        the step between samples that are kept
+    """
+    data = np.asarray(data)
+    if data.ndim == 1:
+        data = data.reshape(len(data), 1)
+    return data[::max(int(stride), 1)]
+
+
+def time_derivative(data, order=1, dt=None, time_vector=None, axis=0,
+                    method='gradient', window_length=11, polyorder=3):
+    """
+    Differentiates data with respect to time along axis, for all other
+    dimensions at once. Data can be a single run (n_timesteps, n_dims) or a
+    batch of runs with a shared time base, ex: (n_runs, n_timesteps, n_dims)
+    with axis=1
+
+    Parameters
+    ----------
+    data: array of floats
+        the data to differentiate
+    order: int, Optional (Default: 1)
+        the order of the derivative, 0 returns the data unchanged
+    dt: float, Optional (Default: None)
+        the time between evenly spaced samples, either dt or time_vector
+        must be provided
+    time_vector: array of floats, Optional (Default: None)
+        the cumulative time of each sample along axis, the samples do not
+        have to be evenly spaced. Used instead of dt if provided
+    axis: int, Optional (Default: 0)
+        the time axis of data
+    method: string, Optional (Default: 'gradient')
+        'gradient': second order central differences, applied order times
+        'savgol': fits a polynomial over a sliding window and takes its
+            derivative of the specified order in one pass, which smooths
+            noise. Non-uniform time is treated as evenly spaced at the
+            average timestep
+    window_length: odd int, Optional (Default: 11)
+        the number of samples in the savgol window, reduced to fit data that
+        has fewer samples
+    polyorder: int, Optional (Default: 3)
+        the order of the savgol polynomial, must be at least order
+    """
+    data = np.asarray(data, dtype=float)
+    if order == 0:
+        return data
+    if dt is None and time_vector is None:
+        raise ValueError('Either dt or time_vector must be provided')
+
+    if method == 'gradient':
+        spacing = (dt if time_vector is None
+                   else np.asarray(time_vector, dtype=float))
+        for _ in range(order):
+            data = np.gradient(data, spacing, axis=axis)
+
+    elif method == 'savgol':
+        if polyorder < order:
+            raise ValueError('polyorder must be at least the derivative '
+                             + 'order, received %i < %i' % (polyorder, order))
+        if time_vector is not None:
+            dt = np.mean(np.diff(time_vector))
+        n_timesteps = data.shape[axis]
+        window_length = min(window_length, n_timesteps - 1 + n_timesteps % 2)
+        if window_length <= polyorder:
+            raise ValueError('%i samples is not enough for a savgol polyorder'
+                             % n_timesteps + ' of %i' % polyorder)
+        data = scipy.signal.savgol_filter(
+            data, window_length=window_length, polyorder=polyorder,
+            deriv=order, delta=dt, axis=axis)
+
+    else:
+        raise ValueError('method must be gradient or savgol, received %s'
+                         % method)
+
+    return data
+
+
+def _dtw_band_numpy(x, y, band):
+    """
+    Fills the banded cumulative cost matrix of dynamic time warping one
+    anti-diagonal at a time, each of which only depends on the previous two,
+    so every cell of a diagonal is calculated at once
+
+    The cost of aligning x[i] and y[j] is saved in column j - i + band of row
+    i, only |i - j| <= band is calculated
+    """
+    n, m = x.shape[0], y.shape[0]
+    cumulative = np.full((n, 2*band + 1), np.inf)
+    for k in range(n + m - 1):
+        lo = max(0, k - (m - 1), -((band - k) // 2))
+        hi = min(n - 1, k, (k + band) // 2)
+        if lo > hi:
+            continue
+        ii = np.arange(lo, hi + 1)
+        jj = k - ii
+        cols = jj - ii + band
+        cost = np.linalg.norm(x[ii] - y[jj], axis=1)
+        if k == 0:
+            cumulative[0, band] = cost[0]
+            continue
+
+        prev_ii = np.maximum(ii - 1, 0)
+        # (i-1, j)
+        up = np.where(
+            (ii > 0) & (cols < 2*band),
+            cumulative[prev_ii, np.minimum(cols + 1, 2*band)], np.inf)
+        # (i, j-1)
+        left = np.where(
+            (jj > 0) & (cols > 0),
+            cumulative[ii, np.maximum(cols - 1, 0)], np.inf)
+        # (i-1, j-1)
+        diagonal = np.where(
+            (ii > 0) & (jj > 0), cumulative[prev_ii, cols], np.inf)
+        cumulative[ii, cols] = cost + np.minimum(
+            np.minimum(up, left), diagonal)
+
+    return cumulative
+
+
+_dtw_band_numba = None
+if numba is not None:
+    @numba.njit(cache=True)
+    def _dtw_band_numba(x, y, band): # pylint: disable=E0102
+        """
+        Fills the banded cumulative cost matrix of dynamic time warping one
+        row at a time, see _dtw_band_numpy
+        """
+        n, m = x.shape[0], y.shape[0]
+        cumulative = np.full((n, 2*band + 1), np.inf)
+        for ii in range(n):
+            for jj in range(max(0, ii - band), min(m, ii + band + 1)):
+                col = jj - ii + band
+                cost = 0.0
+                for dim in range(x.shape[1]):
+                    cost += (x[ii, dim] - y[jj, dim])**2
+                cost = np.sqrt(cost)
+                if ii == 0 and jj == 0:
+                    cumulative[0, band] = cost
+                    continue
+                best = np.inf
+                if ii > 0 and col < 2*band:
+                    best = min(best, cumulative[ii-1, col+1])
+                if jj > 0 and col > 0:
+                    best = min(best, cumulative[ii, col-1])
+                if ii > 0 and jj > 0:
+                    best = min(best, cumulative[ii-1, col])
+                cumulative[ii, col] = cost + best
+        return cumulative
+
+
+def dtw(x, y, band=None, return_path=False, use_numba=None):
+    """
+    Returns the dynamic time warping distance between x and y, the sum of the
+    two norm distances between aligned samples along the lowest cost
+    alignment, with a Sakoe-Chiba band limiting alignments to samples at most
+    band steps apart. This takes O(n_samples * band) time and memory
+
+    If return_path is True, the alignment is also returned as an
+    (n_aligned, 2) array of the indices of x and y that are aligned
+
+    Parameters
+    ----------
+    x: array of floats (n_timesteps, n_dims)
+        the first trajectory
+    y: array of floats (n_timesteps, n_dims)
+        the second trajectory
+    band: int, Optional (Default: None)
+        the width of the Sakoe-Chiba band in samples, if None there is no
+        limit. Increased to the difference in length of x and y if smaller
+    return_path: boolean, Optional (Default: False)
+        True to also return the alignment
+    use_numba: boolean, Optional (Default: None)
+        True to use the numba kernel, False to use the numpy kernel, if None
+        numba is used if it is installed
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if x.ndim == 1:
+        x = x.reshape(-1, 1)
+    if y.ndim == 1:
+        y = y.reshape(-1, 1)
+    n, m = x.shape[0], y.shape[0]
+    if band is None:
+        band = max(n, m)
+    band = int(max(band, abs(n - m), 0))
+
+    if use_numba is None:
+        use_numba = _dtw_band_numba is not None
+    if use_numba:
+        if _dtw_band_numba is None:
+            raise ImportError('numba must be installed to use_numba')
+        cumulative = _dtw_band_numba(
+            np.ascontiguousarray(x), np.ascontiguousarray(y), band)
+    else:
+        cumulative = _dtw_band_numpy(x, y, band)
+
+    distance = cumulative[n-1, (m-1) - (n-1) + band]
+    if not return_path:
+        return distance
+
+    # follow the lowest cost steps back from the end of both trajectories
+    ii, jj = n - 1, m - 1
+    path = [(ii, jj)]
+    while ii > 0 or jj > 0:
+        col = jj - ii + band
+        steps = []
+        if ii > 0 and jj > 0:
+            steps.append((cumulative[ii-1, col], ii - 1, jj - 1))
+        if ii > 0 and col < 2*band:
+            steps.append((cumulative[ii-1, col+1], ii - 1, jj))
+        if jj > 0 and col > 0:
+            steps.append((cumulative[ii, col-1], ii, jj - 1))
+        _, ii, jj = min(steps)
+        path.append((ii, jj))
+
+    return distance, np.array(path[::-1])
+
+
 def scale_data(data, baseline_low, baseline_high, scaling_factor=1):
     """
     Scale data to some baseline to get values from 0-1 relative
@@ -133,7 +421,8 @@ def scale_data(data, baseline_low, baseline_high, scaling_factor=1):
 
 
 def load_and_process(db_name, save_location, parameters,
-                     interpolated_samples=100):
+                     interpolated_samples=100, data_handler=None,
+                     resample=None, dt=None):
     #TODO: move interpolated samples is None check out of interpolation
     # function and add it here, no sense in having it check in the function
     # and have it do nothing, should only call interpolate if interpolating
@@ -142,7 +431,8 @@ def load_and_process(db_name, save_location, parameters,
     returns a dictionary of the interpolated and sampled data
 
     NOTE: if interpolated_samples is set to None, the raw data will be
-    returned without interpolation and sampling
+    returned without interpolation and sampling (unless resample is
+    'fixed_dt'). The raw data is returned as loaded, without any copies
 
     Parameters
     ----------
@@ -156,9 +446,36 @@ def load_and_process(db_name, save_location, parameters,
         the number of samples to take (evenly) from the interpolated data
         if set to None, no interpolated or sampling will be done, the raw
         data will be returned
+    data_handler: instantiated DataHandler, Optional (Default: None)
+        an already instantiated DataHandler to load the data with, if None
+        one will be instantiated for db_name
+    resample: string, Optional (Default: None)
+        how the data is sampled, the sample times are saved under the key
+        'cumulative_time'
+        None: linearly interpolate to interpolated_samples even samples,
+            with 'cumulative_time' evenly spaced from 0 to the sum of
+            'time' and 'time' returned as loaded. This is the original
+            behaviour of load_and_process
+        For the other strategies 'cumulative_time' is the time of each
+        sample measured from the start of the run as the cumulative sum of
+        'time', and 'time' is resampled to the intervals between the
+        returned samples, so every returned array has the same length
+        'linear': linearly interpolate to interpolated_samples even samples
+        'fixed_dt': linearly interpolate to samples spaced dt apart
+        'decimate': apply an anti-aliasing filter and keep every n'th
+            sample, where n is the integer factor that leaves at least
+            interpolated_samples
+        'stride': keep every n'th sample without filtering, as above. The
+            returned arrays are views of the raw data
+        'raw': return the raw data
+    dt: float, Optional (Default: None)
+        the time between samples, required when resample is 'fixed_dt'
     """
     # load data from hdf5 database
-    dat = DataHandler(db_name=db_name)
+    if data_handler is None:
+        dat = DataHandler(db_name=db_name)
+    else:
+        dat = data_handler
     data = dat.load(parameters=parameters, save_location=save_location)
 
     # If time is not passed in, create a range from 0 to the length of any
@@ -169,35 +486,487 @@ def load_and_process(db_name, save_location, parameters,
     if 'time' not in parameters:
         data['time'] = np.ones(data_len)
 
-    total_time = np.sum(data['time'])
+    if resample is None:
+        total_time = np.sum(data['time'])
+        dat = []
+
+        # interpolate for even sampling and save to our dictionary
+        if interpolated_samples is not None:
+            for key in data:
+                if key != 'time':
+                    data[key] = interpolate_data(
+                        data=data[key],
+                        time_intervals=data['time'],
+                        interpolated_samples=interpolated_samples)
+        else:
+            interpolated_samples = data_len
+
+        # since we are interpolating over time, we are not interpolating
+        # the time data, instead evenly sample interpolated_samples from
+        # 0 to the sum(time)
+        data['cumulative_time'] = np.linspace(0, total_time,
+                                              interpolated_samples)
+
+        data['read_location'] = save_location
+        return data
+
+    # the time of each sample since the start of the run, every resample
+    # strategy samples from this same time base
+    cumulative_time = np.cumsum(data['time'])
     dat = []
 
+    if interpolated_samples is None and resample != 'fixed_dt':
+        resample = 'raw'
+
     # interpolate for even sampling and save to our dictionary
-    if interpolated_samples is not None:
+    if resample == 'linear':
         for key in data:
             if key != 'time':
                 data[key] = interpolate_data(
                     data=data[key],
                     time_intervals=data['time'],
                     interpolated_samples=interpolated_samples)
+        # the same sample times as interpolate_data
+        data['cumulative_time'] = np.linspace(
+            cumulative_time[0], cumulative_time[-1], interpolated_samples)
+
+    elif resample == 'fixed_dt':
+        assert dt is not None, 'dt must be provided to resample to fixed_dt'
+        for key in data:
+            if key != 'time':
+                data[key], _ = resample_data(
+                    data=data[key],
+                    time_intervals=data['time'],
+                    dt=dt)
+        # the same sample times as resample_data
+        data['cumulative_time'] = np.arange(
+            cumulative_time[0], cumulative_time[-1], dt)
+
+    elif resample in ('decimate', 'stride'):
+        # the integer factor that leaves at least interpolated_samples
+        factor = max(data_len // interpolated_samples, 1)
+        for key in data:
+            if key != 'time':
+                if resample == 'decimate':
+                    data[key] = decimate_data(data=data[key], factor=factor)
+                else:
+                    data[key] = stride_data(data=data[key], stride=factor)
+        data['cumulative_time'] = cumulative_time[::factor]
+
+    elif resample == 'raw':
+        data['cumulative_time'] = cumulative_time
+
     else:
-        interpolated_samples = data_len
+        raise ValueError('resample must be one of None, linear, fixed_dt, '
+                         + 'decimate, stride or raw, received %s' % resample)
 
-    # since we are interpolating over time, we are not interpolating
-    # the time data, instead evenly sample interpolated_samples from
-    # 0 to the sum(time)
-    data['cumulative_time'] = np.linspace(0, total_time,
-                                          interpolated_samples)
+    if resample != 'raw':
+        # the intervals between the returned samples, so the cumulative sum
+        # of time is still the cumulative_time
+        data['time'] = np.diff(data['cumulative_time'], prepend=0)
 
     data['read_location'] = save_location
     return data
 
 
-def calc_cartesian_points(robot_config, q):
+# the state created by the initializer of map_in_workers, only set in the
+# worker processes
+_worker_state = None
+
+
+def _init_worker(initializer, initargs):
+    """
+    Creates the state that is reused for every call in a worker process
+    """
+    global _worker_state # pylint: disable=W0603
+    _worker_state = initializer(*initargs)
+
+
+def _call_worker(function, args):
+    """
+    Calls function with the worker process's state and args
+    """
+    return function(_worker_state, *args)
+
+
+def map_in_workers(function, args_list, initializer, initargs=(),
+                   n_workers=1, max_in_flight=None):
+    """
+    Yields function(state, *args) for each args in args_list, in order,
+    where state is returned by initializer(*initargs) once per process and
+    reused for every call in it, ex: a read only DataHandler
+
+    The calls are spread across a pool of n_workers processes. At most
+    max_in_flight calls are submitted to the pool at a time, so results do
+    not pile up faster than they are collected. Function and initializer
+    must be defined at the module level so they can be sent to the
+    workers. If n_workers is 1 every call is made in this process
+
+    Parameters
+    ----------
+    function: function
+        accepts the state and the values of args
+    args_list: list of tuples
+        the arguments of each call
+    initializer: function
+        accepts initargs and returns the state of a process
+    initargs: tuple, Optional (Default: ())
+        the arguments of initializer
+    n_workers: positive int, Optional (Default: 1)
+        the number of worker processes to use
+    max_in_flight: positive int, Optional (Default: None)
+        the maximum number of calls submitted to the pool at a time, if
+        None twice the number of workers is used
+    """
+    if n_workers == 1:
+        # the state is local, so nothing is left behind in this process
+        state = initializer(*initargs)
+        for args in args_list:
+            yield function(state, *args)
+        return
+
+    if max_in_flight is None:
+        max_in_flight = 2 * n_workers
+    max_in_flight = max(max_in_flight, 1)
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=n_workers,
+            initializer=_init_worker,
+            initargs=(initializer, initargs)) as executor:
+        in_flight = collections.deque()
+        for args in args_list:
+            if len(in_flight) >= max_in_flight:
+                yield in_flight.popleft().result()
+            in_flight.append(executor.submit(_call_worker, function, args))
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
+def _open_read_only(db_name):
+    """
+    Returns a read only DataHandler, the state of load_and_process_many
+    workers
+    """
+    return DataHandler(db_name=db_name, read_only=True)
+
+
+def _load_and_process_worker(data_handler, db_name, save_location,
+                             parameters, interpolated_samples, resample, dt):
+    """
+    Calls load_and_process with the worker's DataHandler and returns the
+    processed data with the time taken to process it
+    """
+    start = time.time()
+    data = load_and_process(
+        db_name=db_name,
+        save_location=save_location,
+        parameters=parameters,
+        interpolated_samples=interpolated_samples,
+        data_handler=data_handler,
+        resample=resample,
+        dt=dt)
+    data['process_time'] = time.time() - start
+    return data
+
+
+def load_and_process_many(db_name, locations, parameters,
+                          interpolated_samples=100, n_workers=None,
+                          max_in_flight=None, verbose=True,
+                          resample=None, dt=None):
+    """
+    Calls load_and_process for every location in locations, spread across a
+    pool of worker processes. Returns a list of the processed data dicts in
+    the same order as locations. The time taken to process each location is
+    saved in its dict under the key 'process_time'
+
+    Each worker opens the database in read only mode once and reuses it for
+    all of the locations it processes. At most max_in_flight locations are
+    submitted to the pool at a time, so that processed data does not pile
+    up faster than it is collected
+
+    Parameters
+    ----------
+    db_name: string
+        the database where the data is saved
+    locations: list of strings
+        the locations in the hdf5 database to read from
+        EX: ['test_name/session000/run000', 'test_name/session000/run001']
+    parameters: list of strings
+        the parameters to load and interpolate
+    interpolated_samples: positive int, Optional (Default=100)
+        the number of samples to take (evenly) from the interpolated data
+        if set to None, no interpolated or sampling will be done, the raw
+        data will be returned
+    n_workers: positive int, Optional (Default: None)
+        the number of worker processes to use, if None the number of cpus is
+        used. If set to 1 the locations are processed in this process
+    max_in_flight: positive int, Optional (Default: None)
+        the maximum number of locations submitted to the pool at a time, if
+        None twice the number of workers is used
+    verbose: boolean, Optional (Default: True)
+        True to print the progress and the time taken for each location
+    resample: string, Optional (Default: None)
+        how the data is sampled, see load_and_process
+    dt: float, Optional (Default: None)
+        the time between samples, required when resample is 'fixed_dt'
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    n_locations = len(locations)
+
+    results = []
+    for data in map_in_workers(
+            _load_and_process_worker,
+            [(db_name, location, parameters, interpolated_samples, resample,
+              dt) for location in locations],
+            initializer=_open_read_only, initargs=(db_name,),
+            n_workers=n_workers, max_in_flight=max_in_flight):
+        results.append(data)
+        if verbose:
+            print('%i/%i | %.3f s | %s' % (
+                len(results), n_locations, data['process_time'],
+                data['read_location']), end='\r')
+
+    if verbose:
+        print('\nProcessed %i locations in %.3f s of worker time' % (
+            n_locations, sum(data['process_time'] for data in results)))
+
+    return results
+
+
+def get_sessions_and_runs(db_name, test_name, data_handler=None):
+    """
+    Returns a dict of the session numbers saved under test_name, and the run
+    numbers saved in each, following the naming convention of
+    test_name/session%03d/run%03d
+
+    EX: {0: [0, 1, 2], 1: [0, 1]}
+
+    Parameters
+    ----------
+    db_name: string
+        the database where the data is saved
+    test_name: string
+        the location in the database that holds the sessions
+    data_handler: instantiated DataHandler, Optional (Default: None)
+        an already instantiated DataHandler to load the data with, if None
+        one will be instantiated for db_name
+    """
+    if data_handler is None:
+        data_handler = DataHandler(db_name=db_name)
+
+    structure = {}
+    for session_key in data_handler.get_keys(test_name):
+        # get_keys returns [None] for a dataset
+        session_match = re.match(r'session(\d+)$', session_key or '')
+        if session_match is None:
+            continue
+        run_matches = [
+            re.match(r'run(\d+)$', run_key or '')
+            for run_key in data_handler.get_keys(
+                '%s/%s' % (test_name, session_key))]
+        structure[int(session_match.group(1))] = sorted(
+            int(run_match.group(1)) for run_match in run_matches
+            if run_match is not None)
+
+    return dict(sorted(structure.items()))
+
+
+def load_run_array(db_name, test_name, parameter, sessions=None, runs=None,
+                   interpolated_samples=100, resample='linear', dt=None,
+                   n_workers=1):
+    """
+    Loads parameter from every run of every session saved under test_name and
+    returns them aligned in one array of shape
+    (n_sessions, n_runs, n_timesteps, n_dims)
+
+    Each run is sampled to a shared time base using load_and_process, either
+    interpolated_samples per run (resample='linear'), or samples dt apart
+    from the start of each run (resample='fixed_dt'). Runs that are missing,
+    and timesteps past the end of shorter runs, are filled with NaN and
+    marked as False in the mask, so statistics over sessions and runs can be
+    calculated in one reduction, EX: np.nanmean(data['data'], axis=(0, 1))
+
+    the following dict is returned
+    data = {
+        'data': (n_sessions, n_runs, n_timesteps, n_dims) array of parameter,
+        'mask': (n_sessions, n_runs, n_timesteps) boolean array, True where
+            data is valid,
+        'cumulative_time': (n_sessions, n_runs, n_timesteps) array of the
+            sample times of each run,
+        'sessions': list of the session numbers along the first axis,
+        'runs': list of the run numbers along the second axis
+    }
+
+    Parameters
+    ----------
+    db_name: string
+        the database where the data is saved
+    test_name: string
+        the location in the database that holds the sessions
+    parameter: string
+        the key to load from each run
+    sessions: int, Optional (Default: None)
+        the number of sessions to load, if None all saved sessions are found
+    runs: int, Optional (Default: None)
+        the number of runs in each session to load, if None all saved runs
+        are found
+    interpolated_samples: positive int, Optional (Default=100)
+        the number of samples to take (evenly) from the interpolated data
+        if set to None, the raw data will be aligned
+    resample: string, Optional (Default: 'linear')
+        how the data is sampled, see load_and_process. Must be one of the
+        named strategies, which resample 'time' with the other parameters,
+        so time can be aligned the same way as any other parameter
+    dt: float, Optional (Default: None)
+        the time between samples, required when resample is 'fixed_dt'
+    n_workers: positive int, Optional (Default: 1)
+        the number of processes used to load the runs, see
+        load_and_process_many
+    """
+    if resample is None:
+        raise ValueError('load_run_array requires a resample strategy, '
+                         + 'see load_and_process')
+    dat = DataHandler(db_name=db_name)
+    structure = get_sessions_and_runs(db_name, test_name, data_handler=dat)
+    if sessions is not None:
+        structure = {session: structure.get(session, [])
+                     for session in range(sessions)}
+    if runs is not None:
+        structure = {session: [run for run in session_runs if run < runs]
+                     for session, session_runs in structure.items()}
+
+    session_list = list(structure.keys())
+    if runs is not None:
+        run_list = list(range(runs))
+    else:
+        run_list = sorted(set(
+            run for session_runs in structure.values()
+            for run in session_runs))
+
+    indices = []
+    locations = []
+    for ii, session in enumerate(session_list):
+        for run in structure[session]:
+            indices.append((ii, run_list.index(run)))
+            locations.append(
+                '%s/session%03d/run%03d' % (test_name, session, run))
+
+    parameters = [parameter]
+    if parameter != 'time':
+        parameters.append('time')
+    results = load_and_process_many(
+        db_name=db_name, locations=locations, parameters=parameters,
+        interpolated_samples=interpolated_samples, n_workers=n_workers,
+        verbose=False, resample=resample, dt=dt)
+
+    values = []
+    for data in results:
+        value = np.asarray(data[parameter])
+        values.append(value.reshape(value.shape[0], -1))
+    n_timesteps = max((len(value) for value in values), default=0)
+    n_dims = values[0].shape[1] if values else 0
+
+    shape = (len(session_list), len(run_list), n_timesteps)
+    output = {
+        'data': np.full(shape + (n_dims,), np.nan),
+        'mask': np.zeros(shape, dtype=bool),
+        'cumulative_time': np.full(shape, np.nan),
+        'sessions': session_list,
+        'runs': run_list,
+    }
+    for (ii, jj), value, data in zip(indices, values, results):
+        length = len(value)
+        output['data'][ii, jj, :length] = value
+        output['mask'][ii, jj, :length] = True
+        output['cumulative_time'][ii, jj, :length] = (
+            data['cumulative_time'][:length])
+
+    return output
+
+
+# cache of calc_cartesian_points results for each robot_config, keyed by
+# a hash of the joint angles passed in, the oldest entries are dropped once
+# _cartesian_points_cache_size results are stored for a robot_config. The
+# robot_configs are weakly referenced, so their entries are removed when
+# they are garbage collected
+_cartesian_points_cache = weakref.WeakKeyDictionary()
+_cartesian_points_cache_size = 32
+# cache of lambdified batched transform functions for each robot_config,
+# keyed by the name of the joint / link
+_batched_Tx_cache = weakref.WeakKeyDictionary()
+
+
+def _config_cache(cache, robot_config):
+    """
+    Returns the dict of cached values of robot_config in cache, or None if
+    robot_config can not be weakly referenced, in which case nothing is
+    cached
+    """
+    try:
+        return cache.setdefault(robot_config, {})
+    except TypeError:
+        return None
+
+
+def _batched_Tx(robot_config, name, q):
+    """
+    Returns the cartesian coordinates of name for every row of q
+    (n_timesteps, 3)
+
+    If the robot_config exposes the sympy transforms used by abr_control
+    configs (_calc_Tx, q and x), they are lambdified once with numpy and
+    evaluated over all timesteps at once. Otherwise robot_config.Tx is called
+    once for every unique set of joint angles in q
+
+    Parameters
+    ----------
+    robot_config: instantiated abr_control robot config
+        This is required to transform joint angles to cartesian coordinates
+    name: string
+        the name of the joint or link to transform, ex: 'joint0', 'EE'
+    q: np.array of joint angles (n_timesteps, n_joints)
+    """
+    config_cache = _config_cache(_batched_Tx_cache, robot_config)
+    if config_cache is not None and name in config_cache:
+        func = config_cache[name]
+    else:
+        func = None
+        if sympy is not None and hasattr(robot_config, '_calc_Tx'):
+            try:
+                Tx = robot_config._calc_Tx(name, x=[0, 0, 0], lambdify=False)
+                func = sympy.lambdify(
+                    list(robot_config.q) + list(robot_config.x),
+                    [Tx[0], Tx[1], Tx[2]], 'numpy')
+            except (AttributeError, TypeError):
+                func = None
+        if config_cache is not None:
+            config_cache[name] = func
+
+    n_timesteps = q.shape[0]
+    if func is not None:
+        xyz = func(*(list(q.T) + [0, 0, 0]))
+        # constant entries of the transform come back as scalars
+        return np.stack(
+            [np.broadcast_to(np.asarray(val, dtype=float), (n_timesteps,))
+             for val in xyz], axis=1)
+
+    # no symbolic transforms available, only transform the unique joint
+    # angles and map them back to their timesteps
+    q_unique, inverse = np.unique(q, axis=0, return_inverse=True)
+    xyz = np.array([robot_config.Tx(name, q=q_t) for q_t in q_unique],
+                   dtype=float)
+    return xyz.reshape(len(q_unique), -1)[inverse.reshape(-1)]
+
+
+def calc_cartesian_points(robot_config, q, use_cache=True):
     """
     Takes in a robot_config and a list of joint angles and returns the
     cartesian coordinates of the robots joints and link COM's
 
+    The forward kinematics are evaluated for all timesteps at once per joint
+    and link (see _batched_Tx) rather than one timestep at a time. Results
+    are cached per robot_config and set of joint angles
+
     Parameters
     ----------
     robot_config: instantiated abr_control robot config
@@ -205,30 +974,433 @@ def calc_cartesian_points(robot_config, q):
     q: list of joint angles (n_timesteps, n_joints)
         The list of recorded joint angles used to transform link centers of
         mass and joint positions to cartesian coordinates
+    use_cache: boolean, Optional (Default: True)
+        True to reuse the results from a previous call with the same
+        robot_config and joint angles
     """
     assert robot_config is not None, 'robot_config must be provided'
 
-    joints_xyz = []
-    links_xyz = []
-    ee_xyz = []
+    q = np.atleast_2d(np.asarray(q, dtype=float))
+
+    config_cache = None
+    if use_cache:
+        config_cache = _config_cache(_cartesian_points_cache, robot_config)
+    if config_cache is not None:
+        key = (q.shape, hashlib.sha1(
+            np.ascontiguousarray(q).tobytes()).hexdigest())
+        if key in config_cache:
+            return [np.copy(val) for val in config_cache[key]]
+
+    # transform the kinematic chain of joints and the end-effector
+    names = ['joint%i'%ii for ii in range(0, robot_config.N_JOINTS)]
+    names.append('EE')
+    joints_xyz = np.stack(
+        [_batched_Tx(robot_config, name, q) for name in names], axis=1)
+
+    # transform the kinematic chain of links
+    links_xyz = np.zeros((q.shape[0], robot_config.N_LINKS, 3))
+    for ii in range(0, robot_config.N_LINKS):
+        links_xyz[:, ii] = _batched_Tx(robot_config, 'link%i'%ii, q)
+
+    ee_xyz = np.squeeze(joints_xyz[:, -1])
+
+    points = [joints_xyz, links_xyz, ee_xyz]
+    if config_cache is not None:
+        if len(config_cache) >= _cartesian_points_cache_size:
+            del config_cache[next(iter(config_cache))]
+        config_cache[key] = points
+        points = [np.copy(val) for val in points]
+
+    return points
+
+
+class Pipeline():
+    """
+    A lazy chain of processing stages applied to a set of locations in a
+    database. Stages are only recorded when added, and are run when run() is
+    called
+
+    EX: the summed error of the velocity to the path planner, and its mean
+    and confidence intervals over all locations
+        pipeline = (Pipeline(db_name, locations)
+                    .load(['ee_xyz', 'ideal_trajectory', 'time'])
+                    .differentiate(['ee_xyz', 'ideal_trajectory'], order=1)
+                    .norm('ee_xyz', 'ideal_trajectory', name='error')
+                    .reduce('error', np.sum, name='summed_error')
+                    .bootstrap('summed_error'))
+        results = pipeline.run()
+
+    Locations are run chunk_size at a time, with every stage applied to the
+    whole chunk before moving on to the next, so only one chunk of
+    intermediate data is kept in memory. Stages that can be are vectorized
+    across the locations in a chunk. Only the keys listed in keep are kept
+    from each location once all stages have run
+
+    Adding a stage returns a new Pipeline that shares the cache of the one it
+    was added to. Any stage can be cached by passing cache=True, which saves
+    its output for every location. When run, each location continues from the
+    last cached stage whose inputs (the locations and the parameters of every
+    stage up to it) are unchanged, so changing a later stage does not rerun
+    the earlier ones. The cached data of a location is only used while its
+    DataHandler.get_modification_id is unchanged, so saving new data to a
+    location reruns every stage for it
+
+    Parameters
+    ----------
+    db_name: string
+        the database where the data is saved
+    locations: list of strings
+        the locations in the hdf5 database to process
+    chunk_size: positive int, Optional (Default: 10)
+        the number of locations processed at a time
+    keep: list of strings, Optional (Default: None)
+        the keys to keep from each location after all stages have run, if
+        None all keys are kept
+    """
+
+    def __init__(self, db_name, locations, chunk_size=10, keep=None):
+        self.db_name = db_name
+        self.locations = list(locations)
+        self.chunk_size = chunk_size
+        self.keep = keep
+        # list of (signature, function, cache) for stages applied to each
+        # chunk of locations
+        self.stages = []
+        # list of (name, function) for stages applied to the results of all
+        # locations once every chunk has been run
+        self.aggregates = []
+        # dict of (location, signature) to the modification id of the
+        # location and its data at a cached stage
+        self.cache = {}
+
+    def _add(self, signature, function=None, cache=False, aggregate=None):
+        """
+        Returns a copy of this pipeline with the stage appended
+        """
+        pipeline = Pipeline(self.db_name, self.locations,
+                            chunk_size=self.chunk_size, keep=self.keep)
+        pipeline.stages = list(self.stages)
+        pipeline.aggregates = list(self.aggregates)
+        pipeline.cache = self.cache
+
+        if aggregate is not None:
+            pipeline.aggregates.append(aggregate)
+        else:
+            assert not self.aggregates, (
+                'Stages can not be added after an aggregate stage')
+            # the signature of a stage includes the stages before it so that
+            # any change upstream invalidates the cached data
+            if self.stages:
+                signature = self.stages[-1][0] + (signature,)
+            else:
+                signature = (signature,)
+            pipeline.stages.append((signature, function, cache))
+        return pipeline
+
+    def load(self, parameters, interpolated_samples=100, resample='linear',
+             dt=None, cache=False):
+        """
+        Loads and processes parameters from each location, see
+        load_and_process
+
+        Parameters
+        ----------
+        parameters: list of strings
+            the parameters to load and interpolate
+        interpolated_samples: positive int, Optional (Default=100)
+            the number of samples to take (evenly) from the interpolated data
+            if set to None, the raw data will be returned
+        resample: string, Optional (Default: 'linear')
+            how the data is sampled, see load_and_process
+        dt: float, Optional (Default: None)
+            the time between samples, required when resample is 'fixed_dt'
+        cache: boolean, Optional (Default: False)
+            True to cache the loaded data
+        """
+        db_name = self.db_name
+
+        def function(chunk):
+            dat = DataHandler(db_name=db_name, read_only=True)
+            return [load_and_process(
+                db_name=db_name, save_location=data['read_location'],
+                parameters=parameters,
+                interpolated_samples=interpolated_samples,
+                data_handler=dat, resample=resample, dt=dt)
+                    for data in chunk]
+
+        return self._add(
+            ('load', tuple(parameters), interpolated_samples, resample, dt),
+            function, cache)
 
-    # loop through our arm joints over time
-    for q_t in q:
-        joints_t_xyz = []
-        links_t_xyz = []
+    def differentiate(self, keys, order=1, cache=False):
+        """
+        Differentiates the data of each key with respect to time, using the
+        average time between the samples of each location, from its
+        cumulative_time
 
-        # loop through the kinematic chain of joints
-        for ii in range(0, robot_config.N_JOINTS):
-            joints_t_xyz.append(robot_config.Tx('joint%i'%ii, q=q_t))
-        joints_t_xyz.append(robot_config.Tx('EE', q=q_t))
+        Parameters
+        ----------
+        keys: list of strings
+            the keys to differentiate
+        order: int, Optional (Default: 1)
+            the number of times to differentiate
+        cache: boolean, Optional (Default: False)
+            True to cache the differentiated data
+        """
+        def function(chunk):
+            # the time between the samples that were loaded, not the raw
+            # timesteps, which are interpolated away
+            dts = np.array(
+                [(data['cumulative_time'][-1] - data['cumulative_time'][0])
+                 / max(len(data['cumulative_time']) - 1, 1)
+                 for data in chunk])
+            chunk = [dict(data) for data in chunk]
+            for key in keys:
+                values = _stack([data[key] for data in chunk])
+                if values is not None:
+                    # all locations have the same shape, differentiate the
+                    # whole chunk at once
+                    dt = dts.reshape((-1,) + (1,) * (values.ndim - 1))
+                    for _ in range(order):
+                        values = np.gradient(values, axis=1) / dt
+                else:
+                    values = [data[key] for data in chunk]
+                    for ii, dt in enumerate(dts):
+                        for _ in range(order):
+                            values[ii] = np.gradient(values[ii], dt, axis=0)
+                for data, value in zip(chunk, values):
+                    data[key] = value
+            return chunk
 
-        # loop through the kinematic chain of links
-        for ii in range(0, robot_config.N_LINKS):
-            links_t_xyz.append(robot_config.Tx('link%i'%ii, q=q_t))
+        return self._add(
+            ('differentiate', tuple(keys), order), function, cache)
 
-        # append the cartesian coordinates of this time step to our list
-        joints_xyz.append(joints_t_xyz)
-        links_xyz.append(links_t_xyz)
-        ee_xyz.append(robot_config.Tx('EE', q=q_t))
+    def norm(self, key, reference=None, name='error', cache=False):
+        """
+        Calculates the two norm of each timestep of key, or of the difference
+        between key and reference
 
-    return [np.array(joints_xyz), np.array(links_xyz), np.squeeze(ee_xyz)]
+        Parameters
+        ----------
+        key: string
+            the key to take the norm of
+        reference: string, Optional (Default: None)
+            the key to subtract from key before taking the norm
+        name: string, Optional (Default: 'error')
+            the key to save the norm under
+        cache: boolean, Optional (Default: False)
+            True to cache the norm
+        """
+        def function(chunk):
+            chunk = [dict(data) for data in chunk]
+            values = _stack([data[key] for data in chunk])
+            references = None
+            if reference is not None:
+                references = _stack([data[reference] for data in chunk])
+            if values is not None and (
+                    reference is None or references is not None):
+                if reference is not None:
+                    values = values - references
+                norms = np.linalg.norm(values, axis=-1)
+            else:
+                norms = []
+                for data in chunk:
+                    value = data[key]
+                    if reference is not None:
+                        value = value - data[reference]
+                    norms.append(np.linalg.norm(value, axis=-1))
+            for data, value in zip(chunk, norms):
+                data[name] = value
+            return chunk
+
+        return self._add(('norm', key, reference, name), function, cache)
+
+    def reduce(self, key, function=np.sum, name=None, cache=False):
+        """
+        Applies function to the data of key at each location, for example to
+        sum the error over time
+
+        Parameters
+        ----------
+        key: string
+            the key to reduce
+        function: function, Optional (Default: np.sum)
+            accepts the data of key and returns the reduced value
+        name: string, Optional (Default: None)
+            the key to save the result under, if None key is overwritten
+        cache: boolean, Optional (Default: False)
+            True to cache the result
+        """
+        if name is None:
+            name = key
+
+        def stage(chunk):
+            chunk = [dict(data) for data in chunk]
+            for data in chunk:
+                data[name] = function(data[key])
+            return chunk
+
+        return self._add(
+            ('reduce', key, _function_name(function), name), stage, cache)
+
+    def apply(self, function, name=None, cache=False):
+        """
+        Applies a custom function to each location
+
+        Parameters
+        ----------
+        function: function
+            accepts a copy of the data dict of a location and returns the
+            processed data dict. The arrays in the dict should not be
+            modified in place, since they may be saved in the cache
+        name: string, Optional (Default: None)
+            used to identify the stage for caching, if None the name of the
+            function is used. Change the name when the function changes to
+            avoid loading stale cached data
+        cache: boolean, Optional (Default: False)
+            True to cache the result
+        """
+        if name is None:
+            name = _function_name(function)
+
+        def stage(chunk):
+            return [function(dict(data)) for data in chunk]
+
+        return self._add(('apply', name), stage, cache)
+
+    def bootstrap(self, key, shape=None, n=3000, p=0.95, name='bootstrap'):
+        """
+        Calculates the mean and confidence intervals of key over all
+        locations, see get_mean_and_ci
+
+        Parameters
+        ----------
+        key: string
+            the key to get the mean and confidence intervals of
+        shape: tuple of ints, Optional (Default: None)
+            the shape to reshape the values of all locations to, the sets of
+            data have to be grouped along rows, ex: (sessions, runs) for a
+            scalar per location in session major order
+        n: int, Optional (Default: 3000)
+            the number of bootstrap samples
+        p: float, Optional (Default: 0.95)
+            the confidence interval
+        name: string, Optional (Default: 'bootstrap')
+            the key of the result in the dict returned by run()
+        """
+        def function(results):
+            raw_data = np.array([data[key] for data in results])
+            if shape is not None:
+                raw_data = raw_data.reshape(shape)
+            elif raw_data.ndim == 1:
+                raw_data = raw_data[:, None]
+            return get_mean_and_ci(raw_data=raw_data, n=n, p=p)
+
+        return self._add(None, aggregate=(name, function))
+
+    def clear_cache(self):
+        """
+        Removes all cached data shared by this pipeline
+        """
+        self.cache.clear()
+
+    def run(self, verbose=True):
+        """
+        Runs every stage for all locations and returns a dict of the results
+
+        results = {
+            'data': list of the data dict of each location, in order,
+            plus the result of each aggregate stage under its name
+        }
+
+        Parameters
+        ----------
+        verbose: boolean, Optional (Default: True)
+            True to print the progress
+        """
+        results = []
+        # the returned data can share arrays with the cached data
+        copy_results = any(cache for _, _, cache in self.stages)
+        if copy_results:
+            dat = DataHandler(db_name=self.db_name, read_only=True)
+        n_locations = len(self.locations)
+        for start in range(0, n_locations, self.chunk_size):
+            locations = self.locations[start:start+self.chunk_size]
+            if verbose:
+                print('%.3f processing complete...' %
+                      (100 * start / n_locations), end='\r')
+
+            # the version of the data saved at each location, the cached
+            # data of an older version is not used
+            modification_ids = [None] * len(locations)
+            if copy_results:
+                modification_ids = [dat.get_modification_id(location)
+                                    for location in locations]
+
+            # find the last cached stage for each location
+            chunk = []
+            resume = []
+            for location, modification_id in zip(
+                    locations, modification_ids):
+                data = {'read_location': location}
+                index = 0
+                for ii in range(len(self.stages) - 1, -1, -1):
+                    cached = self.cache.get((location, self.stages[ii][0]))
+                    if cached is not None and cached[0] == modification_id:
+                        data = cached[1]
+                        index = ii + 1
+                        break
+                chunk.append(data)
+                resume.append(index)
+
+            # run locations continuing from the same stage together
+            processed = list(chunk)
+            for index in sorted(set(resume)):
+                group = [ii for ii, val in enumerate(resume) if val == index]
+                group_data = [chunk[ii] for ii in group]
+                for signature, function, cache in self.stages[index:]:
+                    group_data = function(group_data)
+                    if cache:
+                        for ii, data in zip(group, group_data):
+                            self.cache[(locations[ii], signature)] = (
+                                modification_ids[ii], data)
+                for ii, data in zip(group, group_data):
+                    processed[ii] = data
+
+            for data in processed:
+                if self.keep is not None:
+                    data = {key: data[key] for key in self.keep}
+                if copy_results:
+                    # return copies so modifying the results does not
+                    # change the cache
+                    data = {key: np.copy(val) if isinstance(val, np.ndarray)
+                            else val for key, val in data.items()}
+                results.append(data)
+
+        if verbose:
+            print('100.000 processing complete...')
+
+        output = {'data': results}
+        for name, function in self.aggregates:
+            output[name] = function(results)
+
+        return output
+
+
+def _stack(values):
+    """
+    Returns values stacked into one array if they all have the same shape,
+    otherwise returns None
+    """
+    shapes = set(np.shape(value) for value in values)
+    if len(shapes) != 1:
+        return None
+    return np.stack(values)
+
+
+def _function_name(function):
+    """
+    Returns a name identifying function for caching pipeline stages
+    """
+    return '%s.%s' % (getattr(function, '__module__', ''),
+                      getattr(function, '__qualname__', repr(function)))
@@ -18,7 +18,8 @@ import nengo
 
 def run(encoders, intercept_vals, input_signal, seed=1,
         db_name='intercepts_scan', save_name='example', notes='',
-        analysis_fncs=None, **kwargs):
+        analysis_fncs=None, reuse_simulator=False, batch_size=1, cache=None,
+        metrics=None, chunk_size=10000, **kwargs):
     '''
     runs a scan for the proportion of neurons that are active over time
 
@@ -41,90 +42,196 @@ def run(encoders, intercept_vals, input_signal, seed=1,
     analysis_fncs: list of network_utils functions to apply to the spike trains
         the function must accept network and input signal, and return a list of
         data and activity
+    reuse_simulator: boolean, Optional (Default: False)
+        True to build the network and simulator once, and set the gain and
+        bias of the neurons for each intercept combination in the built
+        simulator (see network_utils.set_intercepts) instead of building a
+        new one each time. The activities are the same as rebuilding. Only
+        works with the nengo versions in
+        network_utils.SET_SIGNAL_NENGO_VERSIONS
+    batch_size: int, Optional (Default: 1)
+        the number of intercept combinations simulated together. Each
+        combination gets its own copy of the encoders.shape[0] ensembles in
+        one network, driven by the same input node, so the simulator
+        overhead of each timestep is shared. The activities are split back
+        into each combination (see network_utils.split_activities) and
+        passed to the analysis functions with network=None. The ensembles
+        of each combination get different seeds than in their own network,
+        so the results match rebuilding statistically but not exactly
+    cache: network_utils.BuildCache, Optional (Default: None)
+        used to build the simulators, so the decoders and ensemble
+        parameters of networks built in previous scans are loaded from disk
+        instead of calculated
+    metrics: list of network_utils metric classes, Optional (Default: None)
+        used instead of analysis_fncs, ex: network_utils.ProportionTimeActive.
+        A new instance of each is passed every chunk of activities as it is
+        simulated (see the sinks of network_utils.get_activities), so the
+        activities are never held in memory. The results are saved under
+        the name of the matching analysis function
+    chunk_size: int, Optional (Default: 10000)
+        the number of timesteps simulated at a time when metrics are used
     '''
-    if not isinstance(analysis_fncs, list):
+    if metrics is not None:
+        if analysis_fncs is not None:
+            raise ValueError('Pass either analysis_fncs or metrics, not both')
+    elif not isinstance(analysis_fncs, list):
         analysis_fncs = [analysis_fncs]
 
     print('Input Signal Shape: ', np.asarray(input_signal).shape)
 
+    n_intercepts = len(intercept_vals)
+    n_ensembles = encoders.shape[0]
+    network = None
     loop_time = 0
     elapsed_time = 0
-    for ii, intercept in enumerate(intercept_vals):
+    for batch_start in range(0, n_intercepts, batch_size):
         start = timeit.default_timer()
         elapsed_time += loop_time
-        print('%i/%i | ' % (ii+1, len(intercept_vals))
-              + '%.2f%% Complete | ' % (ii/len(intercept_vals)*100)
+        n_batches_left = (n_intercepts - batch_start) / batch_size
+        print('%i/%i | ' % (batch_start+1, n_intercepts)
+              + '%.2f%% Complete | ' % (batch_start/n_intercepts*100)
               + '%.2f min elapsed | ' % (elapsed_time/60)
               + '%.2f min for last sim | ' % (loop_time/60)
               + '~%.2f min remaining...'
-              % ((len(intercept_vals)-ii)*loop_time/60),
+              % (n_batches_left*loop_time/60),
               end='\r')
 
-        # create our intercept distribution from the intercepts vals
-        # Generates intercepts for a d-dimensional ensemble, such that, given a
-        # random uniform input (from the interior of the d-dimensional ball), the
-        # probability of a neuron firing has the probability density function given
-        # by rng.triangular(left, mode, right, size=n)
-        np.random.seed(seed)
-        triangular = np.random.triangular(
-            # intercept_vals = [left, right, mode]
-            left=intercept[0],
-            right=intercept[1],
-            mode=intercept[2],
-            size=encoders.shape[1],
-        )
-        intercepts = nengo.dists.CosineSimilarity(encoders.shape[2] + 2).ppf(1 - triangular)
-        intercept_list = intercepts.reshape((1, encoders.shape[1]))
-
-        print()
-        print(intercept)
-        print(intercept_list)
-
-        # create a network with the new intercepts
-        network = signals.DynamicsAdaptation(
-            n_input=encoders.shape[2],
-            n_output=1,  # number of output is irrelevant
-            n_neurons=encoders.shape[1],
-            intercepts=intercept_list,
-            seed=seed,
-            encoders=encoders,
-            **kwargs)
-
-        # get the spike trains from the sim
-        spike_trains = network_utils.get_activities(
-            network=network, input_signal=input_signal,
-            synapse=0.005)
-
-        # loop through the analysis functions
-        for func in analysis_fncs:
-            func_name = func.__name__
-            y, activity = func(network=network, input_signal=input_signal,
-                               pscs=spike_trains)
-
-            # get the number of active and inactive neurons
-            num_active, num_inactive = (
-                network_utils.n_neurons_active_and_inactive(activity=activity))
-
-            if ii == 0:
+        batch = intercept_vals[batch_start:batch_start+batch_size]
+        intercept_list = []
+        for intercept in batch:
+            # create our intercept distribution from the intercepts vals
+            # Generates intercepts for a d-dimensional ensemble, such that,
+            # given a random uniform input (from the interior of the
+            # d-dimensional ball), the probability of a neuron firing has the
+            # probability density function given by
+            # rng.triangular(left, mode, right, size=n)
+            np.random.seed(seed)
+            triangular = np.random.triangular(
+                # intercept_vals = [left, right, mode]
+                left=intercept[0],
+                right=intercept[1],
+                mode=intercept[2],
+                size=encoders.shape[1],
+            )
+            intercepts = nengo.dists.CosineSimilarity(
+                encoders.shape[2] + 2).ppf(1 - triangular)
+            # the same intercepts for each ensemble of the combination
+            intercepts = np.tile(
+                intercepts.reshape((1, encoders.shape[1])), (n_ensembles, 1))
+            intercept_list.append(intercepts)
+
+            print()
+            print(intercept)
+            print(intercepts)
+        intercept_list = np.vstack(intercept_list)
+
+        sinks = None
+        if metrics is not None:
+            # a new set of metrics for each intercept combination, the last
+            # one counting the active and inactive neurons
+            batch_metrics = [
+                [metric() for metric in metrics]
+                + [network_utils.NeuronsActiveAndInactive()]
+                for _ in batch]
+            if batch_size > 1:
+                sinks = [network_utils.SplitSinks(batch_metrics)]
+            else:
+                sinks = batch_metrics[0]
+
+        # the simulator has an ensemble for each intercept in the list, so
+        # it can only be reused if the batch has as many combinations
+        if (reuse_simulator and network is not None
+                and len(network.adapt_ens) == n_ensembles * len(batch)):
+            # overwrite the gain and bias in the simulator built for the
+            # first set of intercepts
+            network_utils.set_intercepts(
+                sim=network.sim, ensembles=network.adapt_ens,
+                intercepts=intercept_list)
+            spike_trains = network_utils.get_activities(
+                network=network, input_signal=input_signal,
+                synapse=0.005, sim=network.sim, sinks=sinks,
+                chunk_size=chunk_size)
+        else:
+            network_kwargs = dict(kwargs)
+            network_encoders = encoders
+            if batch_size > 1:
+                # a copy of the ensembles for each intercept combination
+                network_kwargs['n_ensembles'] = n_ensembles * len(batch)
+                network_encoders = np.tile(encoders, (len(batch), 1, 1))
+
+            # create a network with the new intercepts
+            network = signals.DynamicsAdaptation(
+                n_input=encoders.shape[2],
+                n_output=1,  # number of output is irrelevant
+                n_neurons=encoders.shape[1],
+                intercepts=intercept_list,
+                seed=seed,
+                encoders=network_encoders,
+                **network_kwargs)
+
+            # get the spike trains from the sim
+            spike_trains = network_utils.get_activities(
+                network=network, input_signal=input_signal,
+                synapse=0.005, cache=cache, sinks=sinks,
+                chunk_size=chunk_size)
+
+        # the results of each combination, as a list of
+        # [name, y, num_active, num_inactive] for each analysis
+        batch_results = []
+        if metrics is not None:
+            for combination_metrics in batch_metrics:
+                num_active, num_inactive = combination_metrics[-1].result()
+                batch_results.append([
+                    [metric.name, metric.result(), num_active, num_inactive]
+                    for metric in combination_metrics[:-1]])
+        else:
+            if batch_size > 1:
+                # the neurons of each combination are a block of columns
+                batch_spike_trains = network_utils.split_activities(
+                    spike_trains, n_splits=len(batch))
+                batch_network = None
+            else:
+                batch_spike_trains = [spike_trains]
+                batch_network = network
+
+            for pscs in batch_spike_trains:
+                results = []
+                # loop through the analysis functions
+                for func in analysis_fncs:
+                    y, activity = func(network=batch_network,
+                                       input_signal=input_signal, pscs=pscs)
+
+                    # get the number of active and inactive neurons
+                    num_active, num_inactive = (
+                        network_utils.n_neurons_active_and_inactive(
+                            activity=activity))
+                    results.append(
+                        [func.__name__, y, num_active, num_inactive])
+                batch_results.append(results)
+
+        for jj, (intercept, results) in enumerate(zip(batch, batch_results)):
+            ii = batch_start + jj
+            for func_name, y, num_active, num_inactive in results:
                 dat = DataHandler(db_name)
-                dat.save(
-                    data={'total_intercepts': len(intercept_vals),
-                          'notes': notes},
-                    save_location='%s/%s' % (save_name, func_name),
-                    overwrite=True)
-
-            # not saving activity because takes up a lot of disk space
-            data = {'intercept_bounds': intercept[:2],
-                    'intercept_mode': intercept[2],
-                    'y': y,
-                    'num_active': num_active,
-                    'num_inactive': num_inactive,
-                    'title': func_name
-                    }
-            dat.save(data=data, save_location='%s/%s/%05d' %
-                     (save_name, func_name, ii), overwrite=True)
-
-            loop_time = timeit.default_timer() - start
+                if ii == 0:
+                    dat.save(
+                        data={'total_intercepts': n_intercepts,
+                              'notes': notes},
+                        save_location='%s/%s' % (save_name, func_name),
+                        overwrite=True)
+
+                # not saving activity because takes up a lot of disk space
+                data = {'intercept_bounds': intercept[:2],
+                        'intercept_mode': intercept[2],
+                        'y': y,
+                        'num_active': num_active,
+                        'num_inactive': num_inactive,
+                        'title': func_name
+                        }
+                dat.save(data=data, save_location='%s/%s/%05d' %
+                         (save_name, func_name, ii), overwrite=True)
+
+        loop_time = timeit.default_timer() - start
 
 
 def review(save_name, ideal_function, num_to_plot=10):
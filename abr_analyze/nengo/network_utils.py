@@ -15,17 +15,28 @@ NOTE: see examples of running for a single profile, or looping through various
 intercepts to later view in the intercept_scan_viewer.py gui
 """
 
+import decimal
+import hashlib
+import os
+import timeit
+import types
 import warnings
 import matplotlib.pyplot as plt
 import numpy as np
+import scipy.sparse
+import scipy.spatial
 
 from abr_control._vendor.nengolib.stats import ScatteredHypersphere
 
 import nengo
 from nengo.utils.matplotlib import rasterplot
 
+from abr_analyze.data_handler import DataHandler
+from abr_analyze import paths
 
-def generate_encoders(n_neurons, input_signal=None, thresh=0.008, depth=0):
+
+def generate_encoders(n_neurons, input_signal=None, thresh=0.008, depth=0,
+                      method='random_pairs', seed=None):
     """
     Accepts an input_signal in the shape of time X dim and outputs encoders
     for the specified number of neurons by sampling from the input.
@@ -51,7 +62,21 @@ def generate_encoders(n_neurons, input_signal=None, thresh=0.008, depth=0):
         the encoder selection process
     depth : int
         how many times has this function been recursively called
+    method : string, Optional (Default: 'random_pairs')
+        'random_pairs': the selection described above
+        'poisson': Poisson disk sampling with a KD-tree, see
+            poisson_disk_encoders. Exactly n_neurons encoders are selected,
+            thresh and depth are not used. input_signal is required, as it
+            sets the dimensions of the encoders
+    seed : int, Optional (Default: None)
+        the seed for the order samples are considered in with 'poisson'
     """
+    if method == 'poisson':
+        return poisson_disk_encoders(
+            n_neurons=n_neurons, input_signal=input_signal, seed=seed)
+    if method != 'random_pairs':
+        raise ValueError('method must be random_pairs or poisson, received %s'
+                         % method)
 
     # first run so we need to generate encoders for the sessions
     ii = 0
@@ -125,7 +150,168 @@ def generate_encoders(n_neurons, input_signal=None, thresh=0.008, depth=0):
     return np.array(input_signal)
 
 
-def raster_plot(network, input_signal, ax, n_ens_to_raster=None):
+def _poisson_disk(points, tree, order, n_samples, radius):
+    '''
+    Visits points in order, selecting each one that is further than radius
+    from all previously selected points, until n_samples are selected.
+    Returns the indices of the selected points
+    '''
+    # python containers are much faster than numpy arrays for single items
+    removed = bytearray(len(points))
+    selected = []
+    for index in order:
+        if removed[index]:
+            continue
+        selected.append(index)
+        if len(selected) == n_samples:
+            break
+        # remove every point within radius of the selected point
+        for neighbour in tree.query_ball_point(points[index], radius):
+            removed[neighbour] = 1
+    return selected
+
+
+def poisson_disk_encoders(n_neurons, input_signal, seed=None, tolerance=1e-3):
+    '''
+    Selects exactly n_neurons encoders from the input_signal with Poisson
+    disk sampling, so the encoders are spread over the input and no two are
+    closer than a minimum distance. A KD-tree of the input finds the samples
+    near each selected one, and the largest minimum distance that still
+    leaves n_neurons samples is found with a binary search, O(N log N) for
+    each step. If there are fewer unique samples than n_neurons, the rest
+    are filled from a ScatteredHypersphere
+
+    PARAMETERS
+    ----------
+    n_neurons : int
+        the number of encoders to select
+    input_signal : array(time_steps, dimensions)
+        the input signal to sample from, required as it sets the dimensions
+        of the encoders
+    seed : int, Optional (Default: None)
+        the seed for the order the samples are considered in
+    tolerance : float, Optional (Default: 1e-3)
+        the binary search for the minimum distance stops once it is known
+        to within this proportion
+    '''
+    if input_signal is None or np.ndim(input_signal) != 2:
+        raise ValueError('input_signal must be an array of shape '
+                         + '(time_steps, dimensions), received %s'
+                         % (None if input_signal is None
+                            else np.shape(input_signal),))
+    points = np.unique(np.asarray(input_signal, dtype=float), axis=0)
+    if len(points) == n_neurons:
+        return points
+    if len(points) < n_neurons:
+        print('Only %i unique samples, appending samples from ' % len(points)
+              + 'ScatteredHypersphere')
+        hypersphere = ScatteredHypersphere(surface=True)
+        hyper_inputs = hypersphere.sample(
+            n_neurons - len(points), points.shape[1])
+        return np.vstack((points, hyper_inputs))
+
+    tree = scipy.spatial.cKDTree(points)
+    order = np.random.RandomState(seed).permutation(len(points)).tolist()
+    low = 0.0
+    high = np.linalg.norm(np.max(points, axis=0) - np.min(points, axis=0))
+    selected = order[:n_neurons]
+    while high - low > tolerance * high:
+        radius = (low + high) / 2
+        candidates = _poisson_disk(points, tree, order, n_neurons, radius)
+        if len(candidates) == n_neurons:
+            low = radius
+            selected = candidates
+        else:
+            high = radius
+
+    return points[selected]
+
+
+def compare_encoder_selection(n_neurons, input_signal, methods=None,
+                              seed=None):
+    '''
+    Runs generate_encoders with each method and returns a dict of the
+    runtime, number of encoders and minimum distance between any two
+    encoders of each
+
+    PARAMETERS
+    ----------
+    n_neurons : int
+        the number of encoders to select
+    input_signal : array(time_steps, dimensions)
+        the input signal to sample from
+    methods : list of strings, Optional (Default: None)
+        the generate_encoders methods to compare, all if None
+    seed : int, Optional (Default: None)
+        the seed for numpy and the 'poisson' method
+    '''
+    if methods is None:
+        methods = ['random_pairs', 'poisson']
+    report = {}
+    for method in methods:
+        np.random.seed(seed)
+        start = timeit.default_timer()
+        encoders = generate_encoders(
+            n_neurons=n_neurons, input_signal=input_signal, method=method,
+            seed=seed)
+        run_time = timeit.default_timer() - start
+        # the distance from each encoder to its nearest neighbour
+        distances, _ = scipy.spatial.cKDTree(encoders).query(encoders, k=2)
+        report[method] = {'time': run_time,
+                          'n_encoders': len(encoders),
+                          'min_distance': np.min(distances[:, 1])}
+        print('%s: %i encoders in %.3f s, minimum distance %.4f' % (
+            method, len(encoders), run_time, report[method]['min_distance']))
+    return report
+
+
+def spike_events(activities):
+    '''
+    Returns the timestep and neuron index of every nonzero activity as two
+    int32 arrays, sorted by timestep, from a dense array or the sparse
+    output of get_activities
+
+    PARAMETERS
+    ----------
+    activities: np.array or scipy.sparse matrix (timesteps x n_neurons)
+        the output from get_activities
+    '''
+    if scipy.sparse.issparse(activities):
+        activities = activities.tocoo()
+        order = np.lexsort((activities.col, activities.row))
+        rows = activities.row[order]
+        cols = activities.col[order]
+    else:
+        rows, cols = np.nonzero(activities)
+    return rows.astype(np.int32), cols.astype(np.int32)
+
+
+def bin_spikes(spike_trains, time_bin, neuron_bin):
+    '''
+    Returns an image of the number of spikes in each bin of time_bin
+    timesteps and neuron_bin neurons, shape (n_neuron_bins, n_time_bins)
+
+    PARAMETERS
+    ----------
+    spike_trains: np.array or scipy.sparse matrix (timesteps x n_neurons)
+        the output from get_activities
+    time_bin: int
+        the number of timesteps in each bin
+    neuron_bin: int
+        the number of neurons in each bin
+    '''
+    n_timesteps, n_neurons = spike_trains.shape
+    n_time_bins = int(np.ceil(n_timesteps / time_bin))
+    n_neuron_bins = int(np.ceil(n_neurons / neuron_bin))
+    steps, neurons = spike_events(spike_trains)
+    counts = np.bincount(
+        (neurons // neuron_bin) * n_time_bins + steps // time_bin,
+        minlength=n_neuron_bins * n_time_bins)
+    return counts.reshape(n_neuron_bins, n_time_bins)
+
+
+def raster_plot(network, input_signal, ax, n_ens_to_raster=None,
+                sparse=False, binned=False, resolution=None):
     '''
     Accepts a Nengo network and runs a simulation with the input_signal
     Plots rasterplot onto ax object up to n_ens_to_raster ensembles
@@ -142,15 +328,49 @@ def raster_plot(network, input_signal, ax, n_ens_to_raster=None):
     n_ens_to_raster: int, Optional (Default: None)
         the number of ensembles to plot in the raster,
         if None all will be plotted
+    sparse: boolean, Optional (Default: False)
+        True to simulate with get_activities(sparse=True) and plot the spike
+        events without creating the dense spike trains
+    binned: boolean, Optional (Default: False)
+        True to draw the number of spikes in bins of timesteps and neurons
+        as a single image instead of a marker for each spike, which is much
+        faster to draw for long simulations and many neurons
+    resolution: tuple of two ints, Optional (Default: None)
+        the (width, height) in pixels of the binned image, the bins are
+        sized to fit. If None the size of ax is used
     '''
     if n_ens_to_raster is None:
         n_ens_to_raster = len(network.adapt_ens)
 
-    spike_trains = get_activities(network, input_signal)
-
-    time = np.ones(len(input_signal))
-
-    ax = rasterplot(np.cumsum(time), spike_trains, ax=ax)
+    spike_trains = get_activities(network, input_signal, sparse=sparse)
+    # only plot the neurons of the first n_ens_to_raster ensembles
+    n_neurons = sum(ens.n_neurons
+                    for ens in network.adapt_ens[:n_ens_to_raster])
+    to_raster = spike_trains[:, :n_neurons]
+
+    time = np.cumsum(np.ones(len(input_signal)))
+
+    if binned:
+        if resolution is None:
+            extent = ax.get_window_extent()
+            resolution = (extent.width, extent.height)
+        time_bin = max(int(np.ceil(len(time) / resolution[0])), 1)
+        neuron_bin = max(int(np.ceil(n_neurons / resolution[1])), 1)
+        image = bin_spikes(to_raster, time_bin=time_bin,
+                           neuron_bin=neuron_bin)
+        ax.imshow(image, aspect='auto', interpolation='nearest',
+                  cmap='gray_r', origin='upper',
+                  extent=(time[0] - 0.5, time[0] - 0.5
+                          + image.shape[1] * time_bin,
+                          0.5 + image.shape[0] * neuron_bin, 0.5))
+        ax.set_ylim(n_neurons + 0.5, 0.5)
+    elif sparse:
+        # plot the spikes the same way as nengo's rasterplot
+        steps, neurons = spike_events(to_raster)
+        ax.plot(time[steps], neurons + 1, '|', color='k')
+        ax.set_ylim(n_neurons + 0.6, 0.4)
+    else:
+        ax = rasterplot(time, to_raster, ax=ax)
 
 
     ax.set_ylabel('Neuron')
@@ -160,10 +380,71 @@ def raster_plot(network, input_signal, ax, n_ens_to_raster=None):
     return spike_trains
 
 
-def get_activities(network, input_signal, dt=0.001, synapse=None):
+def _find_input_nodes(network):
+    '''
+    Returns the nodes of network.nengo_model that have no input of their own
+    and are connected directly to the ensembles in network.adapt_ens, in
+    DynamicsAdaptation the node that outputs network.input_signal. The node
+    functions are not called
+    '''
+    nodes = []
+    for conn in network.nengo_model.all_connections:
+        node = conn.pre_obj
+        if not isinstance(node, nengo.Node) or node.size_in != 0:
+            continue
+        if not callable(node.output) or isinstance(node.output, nengo.Process):
+            continue
+        if not any(conn.post_obj is ens for ens in network.adapt_ens):
+            continue
+        if not any(node is found for found in nodes):
+            nodes.append(node)
+    return nodes
+
+
+def _check_sim_input(sim, input_nodes, signal, dt):
+    '''
+    Raises a ValueError if sim, from a previous call to get_activities, was
+    not built to present signal for dt each to input_nodes
+    '''
+    presented = [op.process for op in sim.model.operators
+                 if isinstance(op, nengo.builder.processes.SimProcess)
+                 and isinstance(op.process, nengo.processes.PresentInput)]
+    if not input_nodes:
+        if presented:
+            raise ValueError('sim was built to present an input_signal to '
+                             + 'its input nodes, and can not be stepped '
+                             + 'through with network.input_signal')
+        return
+    if len(presented) != len(input_nodes):
+        raise ValueError('sim was built with %i input nodes presenting '
+                         % len(presented) + 'the input_signal, but %i '
+                         % len(input_nodes) + 'input nodes are used')
+    for process in presented:
+        if process.inputs.shape != signal.shape:
+            raise ValueError('sim was built with an input_signal of shape '
+                             + '%s, received %s'
+                             % (process.inputs.shape, signal.shape))
+        if process.presentation_time != dt:
+            raise ValueError('sim was built with dt=%g, received %g'
+                             % (process.presentation_time, dt))
+        if not np.array_equal(process.inputs, signal):
+            raise ValueError('sim was built with a different input_signal, '
+                             + 'it can only be reused with the same one')
+
+
+def get_activities(network, input_signal, dt=0.001, synapse=None,
+                   step_by_step=False, sim=None, sparse=False,
+                   chunk_size=10000, sinks=None, cache=None,
+                   input_nodes=None):
     '''
     Accepts a Nengo network and input signal and simulates it, returns the
-    activities. If synapse is None, it returns the spike trains
+    activities. If synapse is None, it returns the spike trains. If sinks
+    are passed in and sparse is False, None is returned
+
+    The input nodes are temporarily replaced by a
+    nengo.processes.PresentInput of the whole input_signal, so the simulator
+    is run once for the full duration instead of once per timestep. If there
+    are no input nodes, network.input_signal is set one timestep at a time
 
     PARAMETERS
     ----------
@@ -171,31 +452,1089 @@ def get_activities(network, input_signal, dt=0.001, synapse=None):
         'abr_control.controllers.signals.dynamics_adaptation'
     input_signal: np array shape of (time_steps x input_dim)
         the input used for the network sim
+    dt: float, Optional (Default: 0.001)
+        how long each sample of input_signal is presented for
     synapse: float, Optional (Default: None)
         the synapse filter on the nengo probe
+    step_by_step: boolean, Optional (Default: False)
+        True to set network.input_signal and run the simulator for each
+        timestep, the probed activities are the same but it is much slower
+    sim: nengo.Simulator, Optional (Default: None)
+        network.sim from a previous call with the same input_signal, dt,
+        synapse and step_by_step, which is reset and run again instead of
+        building a new simulator, ex: after changing its intercepts with
+        set_intercepts
+    sparse: boolean, Optional (Default: False)
+        True to return a scipy.sparse.csr_matrix of the activities with
+        int32 indices instead of a dense array. The simulation is run
+        chunk_size timesteps at a time and the probed data is converted
+        after each chunk, so the dense activities of the whole run are never
+        held in memory. Only saves memory if most activities are zero, ex:
+        spike trains with synapse=None
+    chunk_size: int, Optional (Default: 10000)
+        the number of timesteps simulated at a time when sparse is True or
+        sinks are passed in
+    sinks: list of objects, Optional (Default: None)
+        objects with an append(activities) function, ex: ActivityCounter or
+        H5ActivityWriter. The simulation is run chunk_size timesteps at a
+        time, and after each chunk its activities are passed to every sink
+        and the probes are cleared, so memory use does not grow with the
+        length of input_signal. The activities of the whole run are not
+        kept unless sparse is True, so the results are read from the sinks
+    cache: BuildCache, Optional (Default: None)
+        used to build the simulator, so the decoders and ensemble parameters
+        of a network that has been built before are loaded from disk instead
+        of calculated
+    input_nodes: list of nengo.Nodes, Optional (Default: None)
+        the nodes of network.nengo_model that output network.input_signal.
+        If None, the node with no input that is connected directly to
+        network.adapt_ens is used, which in DynamicsAdaptation is the
+        input node. Must be passed in if more than one node feeds the
+        ensembles
     '''
-    # if there aren't neuron probes in the network add them
-    with network.nengo_model:
-        network.probe_neurons = []
-        for ens in network.adapt_ens:
-            network.probe_neurons.append(
-                nengo.Probe(ens.neurons, synapse=synapse))
-    network.sim = nengo.Simulator(network.nengo_model, progress_bar=False)
+    signal = np.asarray(input_signal, dtype=float)
+    if signal.size == 0:
+        raise ValueError('input_signal is empty, at least one timestep is '
+                         + 'needed to simulate the network')
+    signal = signal.reshape(len(signal), -1)
+
+    if step_by_step:
+        input_nodes = []
+    elif input_nodes is None:
+        input_nodes = _find_input_nodes(network)
+        if len(input_nodes) > 1:
+            raise ValueError('%i nodes with no input are connected to '
+                             % len(input_nodes) + 'network.adapt_ens, pass '
+                             + 'the ones that output network.input_signal '
+                             + 'in as input_nodes')
+
+    if sim is not None:
+        _check_sim_input(sim, input_nodes, signal, dt)
+        sim.reset()
+        network.sim = sim
+    else:
+        # if there aren't neuron probes in the network add them
+        with network.nengo_model:
+            network.probe_neurons = []
+            for ens in network.adapt_ens:
+                network.probe_neurons.append(
+                    nengo.Probe(ens.neurons, synapse=synapse))
+
+        outputs = [node.output for node in input_nodes]
+        try:
+            for node in input_nodes:
+                # the sample at index (t - dt) / dt is output at time t, the
+                # same as setting network.input_signal before each sim.run(dt)
+                node.output = nengo.processes.PresentInput(
+                    signal, presentation_time=dt)
+            if cache is not None:
+                network.sim = cache.build(network)
+            else:
+                network.sim = nengo.Simulator(
+                    network.nengo_model, progress_bar=False)
+        finally:
+            for node, output in zip(input_nodes, outputs):
+                node.output = output
+
+    chunked = sparse or sinks is not None
+    if not chunked:
+        chunk_size = len(signal)
+    activities = []
+    # the number of probed timesteps already converted, when the probes can
+    # not be cleared
+    n_converted = 0
+    for start in range(0, len(signal), chunk_size):
+        stop = min(start + chunk_size, len(signal))
+        if input_nodes:
+            network.sim.run(dt * (stop - start), progress_bar=False)
+        else:
+            for in_sig in input_signal[start:stop]:
+                network.input_signal = in_sig
+                network.sim.run(dt, progress_bar=False)
+
+        chunk = np.hstack([network.sim.data[probe][n_converted:] * dt
+                           for probe in network.probe_neurons])
+        if sinks is not None:
+            for sink in sinks:
+                sink.append(chunk)
+        if sparse:
+            activities.append(scipy.sparse.csr_matrix(chunk))
+        elif not chunked:
+            activities.append(chunk)
+        if chunked:
+            if hasattr(network.sim, 'clear_probes'):
+                network.sim.clear_probes()
+            else:
+                n_converted += len(chunk)
+
+    if sinks is not None and not sparse:
+        return None
+    if sparse:
+        activities = scipy.sparse.vstack(activities, format='csr')
+        activities.indices = activities.indices.astype(np.int32)
+        activities.indptr = activities.indptr.astype(np.int32)
+        return activities
+    return np.array(activities[0])
+
+
+def split_activities(activities, n_splits):
+    '''
+    Splits the neurons of activities into n_splits equal blocks of columns,
+    ex: to separate the activities of several configurations simulated in
+    one network. Returns a list of n_splits arrays (n_timesteps x
+    n_neurons / n_splits), scipy.sparse matrices stay sparse
 
-    for in_sig in input_signal:
-        network.input_signal = in_sig
-        network.sim.run(dt, progress_bar=False)
+    PARAMETERS
+    ----------
+    activities: np.array (n_timesteps x n_neurons)
+        the output from get_activities, can be a scipy.sparse matrix
+    n_splits: int
+        the number of blocks, must divide the number of neurons
+    '''
+    n_neurons = activities.shape[1]
+    if n_neurons % n_splits != 0:
+        raise ValueError('%i neurons can not be split into %i equal blocks'
+                         % (n_neurons, n_splits))
+    if scipy.sparse.issparse(activities):
+        activities = activities.tocsc()
+    block = n_neurons // n_splits
+    splits = []
+    for start in range(0, n_neurons, block):
+        split = activities[:, start:start+block]
+        if scipy.sparse.issparse(split):
+            split = split.tocsr()
+        splits.append(split)
+    return splits
+
+
+class ProportionNeuronsActive():
+    '''
+    An online version of proportion_neurons_active_over_time. A sink for
+    get_activities that counts the active neurons in each chunk of
+    activities as it is simulated, keeping one count per timestep
 
-    activities = []
-    for probe in network.probe_neurons:
-        activities.append(network.sim.data[probe] * dt)
-    activities = np.hstack(activities)
+    PARAMETERS
+    ----------
+    threshold: float, Optional (Default: 1e-2)
+        the activity above which a neuron is counted as active
+    '''
+    name = 'proportion_neurons_active_over_time'
+
+    def __init__(self, threshold=1e-2):
+        self.threshold = threshold
+        self.n_neurons = None
+        self.n_neurons_active = []
+
+    def append(self, activities):
+        '''
+        Adds the counts of a (timesteps x n_neurons) chunk of activities
+        '''
+        self.n_neurons = activities.shape[1]
+        self.n_neurons_active.append(_count_active(
+            activities, threshold=self.threshold, axis=1))
+
+    def result(self):
+        '''
+        Returns the proportion of neurons active at each timestep
+        '''
+        return np.hstack(self.n_neurons_active) / self.n_neurons
+
+
+class ProportionTimeActive():
+    '''
+    An online version of proportion_time_neurons_active. A sink for
+    get_activities that counts the active timesteps of each neuron in each
+    chunk of activities as it is simulated, keeping one count per neuron
+
+    PARAMETERS
+    ----------
+    threshold: float, Optional (Default: 1e-2)
+        the activity above which a neuron is counted as active
+    '''
+    name = 'proportion_time_neurons_active'
+
+    def __init__(self, threshold=1e-2):
+        self.threshold = threshold
+        self.n_timesteps = 0
+        self.n_timesteps_active = None
+
+    def append(self, activities):
+        '''
+        Adds the counts of a (timesteps x n_neurons) chunk of activities
+        '''
+        if self.n_timesteps_active is None:
+            self.n_timesteps_active = np.zeros(activities.shape[1])
+        self.n_timesteps += activities.shape[0]
+        self.n_timesteps_active += _count_active(
+            activities, threshold=self.threshold, axis=0)
+
+    def result(self):
+        '''
+        Returns the proportion of time each neuron is active
+        '''
+        return self.n_timesteps_active / self.n_timesteps
+
+
+class NeuronsActiveAndInactive():
+    '''
+    An online version of n_neurons_active_and_inactive. A sink for
+    get_activities that sums the activity of each neuron in each chunk of
+    activities as it is simulated, keeping one sum per neuron
+    '''
+    name = 'n_neurons_active_and_inactive'
+
+    def __init__(self):
+        self.activity_sum = None
+
+    def append(self, activities):
+        '''
+        Adds the sums of a (timesteps x n_neurons) chunk of activities
+        '''
+        if self.activity_sum is None:
+            self.activity_sum = np.zeros(activities.shape[1])
+        self.activity_sum += np.asarray(activities.sum(axis=0)).ravel()
+
+    def result(self):
+        '''
+        Returns the number of neurons that were ever active and never active
+        '''
+        n_inactive = len(np.where(self.activity_sum == 0)[0])
+        return len(self.activity_sum) - n_inactive, n_inactive
+
+
+class ActivityCounter():
+    '''
+    A sink for get_activities that counts the active neurons in each chunk
+    of activities as it is simulated, so the proportion active metrics can
+    be calculated without keeping the activities
+
+    PARAMETERS
+    ----------
+    threshold: float, Optional (Default: 1e-2)
+        the activity above which a neuron is counted as active
+    '''
+    def __init__(self, threshold=1e-2):
+        self.threshold = threshold
+        self.metrics = [ProportionNeuronsActive(threshold=threshold),
+                        ProportionTimeActive(threshold=threshold),
+                        NeuronsActiveAndInactive()]
+
+    def append(self, activities):
+        '''
+        Adds the counts of a (timesteps x n_neurons) chunk of activities
+        '''
+        for metric in self.metrics:
+            metric.append(activities)
+
+    def proportion_neurons_active(self):
+        '''
+        Returns the proportion of neurons active at each timestep, see
+        proportion_neurons_active_over_time
+        '''
+        return self.metrics[0].result()
+
+    def proportion_time_active(self):
+        '''
+        Returns the proportion of time each neuron is active, see
+        proportion_time_neurons_active
+        '''
+        return self.metrics[1].result()
+
+    def n_active_and_inactive(self):
+        '''
+        Returns the number of neurons that were ever active and never
+        active, see n_neurons_active_and_inactive
+        '''
+        return self.metrics[2].result()
+
+
+class SplitSinks():
+    '''
+    A sink for get_activities that splits each chunk of activities into
+    equal blocks of neurons with split_activities, and passes block ii to
+    every sink in sinks[ii], ex: to keep separate metrics for each
+    configuration simulated in one network
+
+    PARAMETERS
+    ----------
+    sinks: list of lists of sinks
+        the sinks of each block of neurons
+    '''
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def append(self, activities):
+        '''
+        Splits a (timesteps x n_neurons) chunk of activities between sinks
+        '''
+        blocks = split_activities(activities, n_splits=len(self.sinks))
+        for block, block_sinks in zip(blocks, self.sinks):
+            for sink in block_sinks:
+                sink.append(block)
+
+
+class H5ActivityWriter():
+    '''
+    A sink for get_activities that appends each chunk of activities to a
+    dataset in the database as it is simulated, so the activities of long
+    runs are saved without being held in memory, and the chunks simulated
+    so far are kept if the simulation stops
+
+    PARAMETERS
+    ----------
+    db_name: string
+        the name of the database to save to
+    save_location: string
+        the group to save the activities in
+    key: string, Optional (Default: 'activities')
+        the name of the dataset
+    '''
+    def __init__(self, db_name, save_location, key='activities'):
+        self.dat = DataHandler(db_name)
+        self.save_location = save_location
+        self.key = key
+
+    def append(self, activities):
+        '''
+        Appends a (timesteps x n_neurons) chunk of activities to the dataset
+        '''
+        self.dat.append(data={self.key: activities},
+                        save_location=self.save_location)
+
+
+# the nengo versions _set_signal has been tested with, as (major, minor)
+# from the first supported up to but not including the last. It writes
+# into the simulator's signal arrays, which are not part of nengo's api
+SET_SIGNAL_NENGO_VERSIONS = ((4, 0), (5, 0))
 
-    return np.array(activities)
+
+def _set_signal(sim, signal, value):
+    '''
+    Overwrites the value of a signal in a built simulator, including read
+    only signals and signals the optimizer has merged into a larger one.
+    The initial value is overwritten as well, so the new value is kept when
+    the simulator is reset
+
+    Raises a ValueError if the nengo version is not in
+    SET_SIGNAL_NENGO_VERSIONS, if the signal is not laid out in the
+    simulator the way it is in those versions, or if the new value can not
+    be read back from the simulator after it is written
+    '''
+    version = tuple(nengo.version.version_info[:2])
+    low, high = SET_SIGNAL_NENGO_VERSIONS
+    if not low <= version < high:
+        raise ValueError(
+            'Signals can only be set in the simulators of nengo %s up to %s, '
+            % ('.'.join(str(v) for v in low), '.'.join(str(v) for v in high))
+            + 'not %s, build a new simulator instead' % nengo.__version__)
+
+    base = signal.base if signal.is_view else signal
+    value = np.broadcast_to(np.asarray(value, dtype=signal.dtype),
+                            signal.shape)
+    pairs = [(sim.signals[base], sim.signals[signal]),
+             (base.initial_value, signal.initial_value)]
+    # check both before writing either, so a mismatch changes nothing
+    for base_data, signal_data in pairs:
+        if (not isinstance(base_data, np.ndarray)
+                or base_data.dtype != signal.dtype
+                or base_data.shape != base.shape):
+            raise ValueError('The simulator data of %s does not match the '
+                             % base + 'signal, build a new simulator instead')
+        data = _signal_view(signal, base_data)
+        if (data.ctypes.data != signal_data.ctypes.data
+                or data.strides != signal_data.strides):
+            raise ValueError('The simulator data of %s is not at the offset '
+                             % signal + 'and strides of the signal, build a '
+                             + 'new simulator instead')
+
+    for base_data, _ in pairs:
+        writeable = base_data.flags.writeable
+        base_data.setflags(write=True)
+        _signal_view(signal, base_data)[...] = value
+        base_data.setflags(write=writeable)
+
+    for _, signal_data in pairs:
+        if not np.array_equal(signal_data, value):
+            raise ValueError('%s was not changed in the simulator, build a '
+                             % signal + 'new simulator instead')
+
+
+def _signal_view(signal, base_data):
+    '''
+    Returns a view of signal in base_data, the data of its base, the same as
+    the simulator's view. Writeable if base_data is
+    '''
+    return np.ndarray(
+        shape=signal.shape, strides=signal.strides, offset=signal.offset,
+        dtype=signal.dtype, buffer=base_data.data)
+
+
+def set_intercepts(sim, ensembles, intercepts):
+    '''
+    Changes the intercepts of ensembles in a built simulator, by overwriting
+    the gain and bias of their neurons, so a network can be simulated with
+    different intercepts without being built again. The max rates, encoders
+    and everything else in the model stay the same
+
+    NOTE: connection weights solved for from the ensembles are not updated,
+    so only the neural activities match a rebuilt network. Only works with
+    the nengo versions in SET_SIGNAL_NENGO_VERSIONS, a ValueError is raised
+    otherwise
+
+    PARAMETERS
+    ----------
+    sim: nengo.Simulator
+        the built simulator, ex: network.sim after get_activities
+    ensembles: list of nengo.Ensembles
+        the ensembles to change the intercepts of, ex: network.adapt_ens
+    intercepts: array of floats (n_ensembles x n_neurons)
+        the new intercepts of each ensemble
+    '''
+    for ens, ens_intercepts in zip(ensembles, intercepts):
+        built = sim.data[ens]
+        ens_intercepts = np.asarray(ens_intercepts, dtype=float)
+        gain, bias = ens.neuron_type.gain_bias(
+            built.max_rates, ens_intercepts)
+        scaled_encoders = built.encoders * (gain / ens.radius)[:, None]
+
+        _set_signal(sim, sim.model.sig[ens.neurons]['bias'], bias)
+        _set_signal(sim, sim.model.sig[ens]['encoders'], scaled_encoders)
+        sim.model.params[ens] = built._replace(
+            intercepts=ens_intercepts, gain=gain, bias=bias,
+            scaled_encoders=scaled_encoders)
+
+
+def _build_order(network):
+    '''
+    Returns the connections, ensembles, networks and nodes of a nengo network
+    and its subnetworks, in the order the builder seeds them. Probes are
+    left out since they do not change the seeds of the other objects
+    '''
+    objects = []
+    for obj_type in [nengo.Connection, nengo.Ensemble, nengo.Network,
+                     nengo.Node]:
+        objects += network.objects[obj_type]
+    for subnetwork in network.networks:
+        objects += _build_order(subnetwork)
+    return objects
+
+
+def _describe(value, indices):
+    '''
+    Returns a description of a nengo parameter value that is the same
+    between sessions, for hashing. Nengo objects are described by their index
+    in the build order and arrays by a hash of their data. Functions are
+    described by their name and bytecode, so changes to the variables they
+    use are not detected
+    '''
+    if isinstance(value, np.ndarray):
+        return (str(value.dtype), value.shape, hashlib.sha1(
+            np.ascontiguousarray(value).tobytes()).hexdigest())
+    if isinstance(value, nengo.ensemble.Neurons):
+        return ('Neurons', _describe(value.ensemble, indices))
+    if isinstance(value, nengo.base.ObjView):
+        return ('ObjView', _describe(value.obj, indices), repr(value.slice))
+    if isinstance(value, nengo.connection.LearningRule):
+        return ('LearningRule', _describe(value.connection, indices),
+                _describe(value.learning_rule_type, indices))
+    if isinstance(value, nengo.base.NengoObject):
+        return (type(value).__name__, indices.get(value))
+    if isinstance(value, nengo.params.FrozenObject):
+        return (type(value).__name__,) + tuple(
+            (param.name, _describe(getattr(value, param.name), indices))
+            for param in value._params) # pylint: disable=W0212
+    if isinstance(value, (list, tuple)):
+        return tuple(_describe(val, indices) for val in value)
+    if isinstance(value, dict):
+        return tuple(sorted((repr(key), _describe(val, indices))
+                            for key, val in value.items()))
+    if callable(value) and hasattr(value, '__code__'):
+        return (value.__qualname__, value.__code__.co_code.hex(),
+                _describe(value.__code__.co_consts, indices))
+    if isinstance(value, types.CodeType):
+        return (value.co_name, value.co_code.hex())
+    return repr(value)
+
+
+class _CacheBuilder(nengo.builder.Builder):
+    '''
+    The nengo builder used by BuildCache.build, which builds ensembles with
+    BuildCache.build_ensemble and everything else as usual
+    '''
+    def __init__(self, cache):
+        self.cache = cache
+
+    def build(self, model, obj, *args, **kwargs): # pylint: disable=W0221
+        if isinstance(obj, nengo.Ensemble) and not model.has_built(obj):
+            return self.cache.build_ensemble(model, obj)
+        return nengo.builder.Builder.build(model, obj, *args, **kwargs)
+
+
+class BuildCache():
+    '''
+    An on-disk cache of the decoders solved for when building a network, so
+    later sessions building the same network do not solve for them again,
+    which is most of the build time of large ensembles. The encoders, gains,
+    biases, intercepts and max rates of the ensembles are cached as well, so
+    networks without decoded connections, like DynamicsAdaptation, do not
+    sample and calculate them again. Everything is saved in cache_dir under
+    a hash of the parameters of every object in the network (ex: the
+    encoders, intercepts, seeds and neuron types), and the least recently
+    used files are deleted when they take up more than max_size bytes
+
+    Only networks with a seed are cached, since the decoders and ensemble
+    parameters of unseeded networks differ on every build
+
+    Has the interface of a nengo.cache.DecoderCache, and is passed to the
+    nengo builder by build(network) along with a builder that loads the
+    cached ensemble parameters
+
+    PARAMETERS
+    ----------
+    cache_dir: string, Optional (Default: paths.cache_dir/nengo_builds)
+        the folder to save the decoders in
+    max_size: int, Optional (Default: 512e6)
+        the maximum number of bytes of the cache_dir
+    '''
+    def __init__(self, cache_dir=None, max_size=512e6):
+        if cache_dir is None:
+            cache_dir = os.path.join(paths.cache_dir, 'nengo_builds')
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        # the number of connections and ensembles loaded from and saved to
+        # the cache
+        self.hits = 0
+        self.misses = 0
+        self._key = None
+        self._indices = {}
+
+    def key(self, network):
+        '''
+        Returns the hash of the parameters of the objects in
+        network.nengo_model, or None if the network does not have a seed
+
+        PARAMETERS
+        ----------
+        network: .DynamicsAdaptation
+            'abr_control.controllers.signals.dynamics_adaptation'
+        '''
+        model = network.nengo_model
+        if model.seed is None:
+            return None
+
+        objects = _build_order(model)
+        indices = {obj: ii for ii, obj in enumerate(objects)}
+        description = [nengo.__version__, str(nengo.rc.float_dtype)]
+        for obj in objects:
+            if isinstance(obj, nengo.Network):
+                description.append(('Network', obj.seed))
+                continue
+            names = sorted(obj.params)
+            if isinstance(obj, nengo.Node):
+                # the output of nodes does not change the build
+                names = ['size_in', 'size_out']
+            description.append((type(obj).__name__,) + tuple(
+                (name, _describe(getattr(obj, name), indices))
+                for name in names if name != 'label'))
+        return hashlib.sha1(repr(description).encode()).hexdigest()
+
+    def build(self, network):
+        '''
+        Returns a nengo.Simulator of network.nengo_model, with the decoders
+        loaded from the cache if it has been built before, and saved to it
+        otherwise
+
+        PARAMETERS
+        ----------
+        network: .DynamicsAdaptation
+            'abr_control.controllers.signals.dynamics_adaptation'
+        '''
+        key = self.key(network)
+        if key is None:
+            return nengo.Simulator(network.nengo_model, progress_bar=False)
+
+        self._key = key
+        self._indices = {
+            obj: ii for ii, obj in enumerate(_build_order(network.nengo_model))
+            if isinstance(obj, (nengo.Connection, nengo.Ensemble))}
+        try:
+            model = nengo.builder.Model(
+                label=network.nengo_model.label, decoder_cache=self,
+                builder=_CacheBuilder(self))
+            sim = nengo.Simulator(
+                network.nengo_model, model=model, progress_bar=False)
+        finally:
+            self._key = None
+            self._indices = {}
+        return sim
+
+    def _path(self, obj):
+        '''
+        Returns the path of the cached file of obj, or None if obj is not
+        part of the network being built
+        '''
+        if self._key is None or obj not in self._indices:
+            return None
+        return os.path.join(
+            self.cache_dir, '%s_%i.npz' % (self._key, self._indices[obj]))
+
+    def _load(self, path):
+        '''
+        Returns a dict of the arrays saved at path, or None if it does not
+        exist
+        '''
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            arrays = {name: data[name] for name in data.files}
+        # mark as recently used
+        os.utime(path)
+        self.hits += 1
+        return arrays
+
+    def _save(self, path, arrays):
+        '''
+        Saves the dict of arrays to path
+        '''
+        # write to a temporary file first so other processes never load
+        # a partially written file
+        tmp_path = '%s.%i.tmp.npz' % (path[:-4], os.getpid())
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+        self.misses += 1
+
+    def wrap_solver(self, solver_fn):
+        '''
+        Called by the nengo builder, returns solver_fn wrapped to load the
+        decoders of a connection from the cache, or solve for and save them
+        '''
+        def cached_solver(conn, gain, bias, x, targets, rng=np.random):
+            path = self._path(conn)
+            if path is None:
+                return solver_fn(conn, gain, bias, x, targets, rng=rng)
+
+            data = self._load(path)
+            if data is not None:
+                solver_info = {name[5:]: val for name, val in data.items()
+                               if name.startswith('info_')}
+                return data['decoders'], solver_info
+
+            decoders, solver_info = solver_fn(
+                conn, gain, bias, x, targets, rng=rng)
+            info = {'info_%s' % name: val for name, val in solver_info.items()
+                    if isinstance(val, (np.ndarray, int, float))}
+            self._save(path, dict(info, decoders=decoders))
+            return decoders, solver_info
+        return cached_solver
+
+    def build_ensemble(self, model, ens):
+        '''
+        Called by the nengo builder, builds ens into model with the encoders,
+        gains and biases loaded from the cache, or builds it and saves them.
+        The cached values are set on ens while it is built, so the built
+        ensemble is the same as building it without the cache
+
+        PARAMETERS
+        ----------
+        model: nengo.builder.Model
+            the model being built
+        ens: nengo.Ensemble
+            the ensemble to build
+        '''
+        path = self._path(ens)
+        if isinstance(ens.neuron_type, nengo.Direct):
+            # direct mode ensembles have no gains or biases
+            path = None
+        data = None if path is None else self._load(path)
+        if data is None:
+            nengo.builder.Builder.build(model, ens)
+            if path is not None:
+                built = model.params[ens]
+                self._save(path, {name: getattr(built, name) for name in
+                                  ['encoders', 'gain', 'bias', 'intercepts',
+                                   'max_rates']})
+            return
+
+        params = {'encoders': data['encoders'], 'normalize_encoders': False,
+                  'gain': data['gain'], 'bias': data['bias'],
+                  # the gains and biases set the max rates and intercepts
+                  'max_rates': nengo.Ensemble.max_rates.default,
+                  'intercepts': nengo.Ensemble.intercepts.default}
+        original = {name: getattr(ens, name) for name in params}
+        try:
+            for name, value in params.items():
+                setattr(ens, name, value)
+            nengo.builder.Builder.build(model, ens)
+        finally:
+            for name, value in original.items():
+                setattr(ens, name, value)
+        # the max rates and intercepts calculated from the gains and biases
+        # can differ in the last bits from the ones the gains were from
+        model.params[ens] = model.params[ens]._replace(
+            intercepts=data['intercepts'], max_rates=data['max_rates'])
+
+    def _files(self):
+        return [os.path.join(self.cache_dir, name)
+                for name in os.listdir(self.cache_dir)
+                if name.endswith('.npz') and not name.endswith('.tmp.npz')]
+
+    def get_size_in_bytes(self):
+        '''
+        Returns the number of bytes of the cached files
+        '''
+        return sum(os.path.getsize(path) for path in self._files())
+
+    def get_size(self):
+        '''
+        Returns the size of the cached files as a string
+        '''
+        return '%.2f MB' % (self.get_size_in_bytes() / 1e6)
+
+    def shrink(self, limit=None):
+        '''
+        Deletes the least recently used files until the cache takes up at
+        most limit bytes. Called by the nengo builder after each build
+
+        PARAMETERS
+        ----------
+        limit: int, Optional (Default: None)
+            the maximum number of bytes, if None max_size is used
+        '''
+        if limit is None:
+            limit = self.max_size
+        files = sorted(self._files(), key=os.path.getmtime)
+        size = sum(os.path.getsize(path) for path in files)
+        for path in files:
+            if size <= limit:
+                break
+            size -= os.path.getsize(path)
+            os.remove(path)
+
+    def invalidate(self):
+        '''
+        Deletes all of the cached files
+        '''
+        self.shrink(limit=0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+def get_rates(network, input_signal, dt=0.001, chunk_size=10000,
+              validate=False, filter_input=True, probe_synapse=0.005,
+              input_nodes=None):
+    '''
+    Accepts a Nengo network and input signal and returns the steady state
+    firing rate of every neuron at each timestep, calculated from the
+    encoders, gains and biases of the built model and the rate equation of
+    the neuron type (the LIF rate equation for LIF neurons), without running
+    a spiking simulation. The rates are multiplied by dt, so they are on the
+    same scale as the mean of the filtered activities from get_activities
+    and can be passed in as pscs to the proportion active functions
+
+    Returns the rates and a dict comparing them to the spiking simulation if
+    validate is True (see validate_rates), otherwise None
+
+    NOTE: assumes the input_signal is connected to each ensemble directly,
+    as it is in DynamicsAdaptation. The input_signal is filtered with the
+    synapse of that connection before the rates are calculated, so the
+    rates follow the input the neurons receive
+
+    PARAMETERS
+    ----------
+    network: .DynamicsAdaptation
+        'abr_control.controllers.signals.dynamics_adaptation'
+    input_signal: np array shape of (time_steps x input_dim)
+        the input used for the network sim
+    dt: float, Optional (Default: 0.001)
+        the timestep the rates are scaled by
+    chunk_size: int, Optional (Default: 10000)
+        the number of timesteps to calculate at once, to limit memory use
+    validate: boolean, Optional (Default: False)
+        True to also run the spiking simulation with get_activities and
+        compare the two, see validate_rates
+    filter_input: boolean, Optional (Default: True)
+        True to filter input_signal with the synapse on the connection from
+        the input node to each ensemble. False to use input_signal
+        unfiltered, ex: for the points from compress_input, which are not in
+        time order
+    probe_synapse: float, Optional (Default: 0.005)
+        the synapse on the spiking simulation probes when validating
+    input_nodes: list of nengo.Nodes, Optional (Default: None)
+        the nodes of network.nengo_model that output network.input_signal,
+        see get_activities
+    '''
+    signal = np.asarray(input_signal, dtype=float)
+    signal = signal.reshape(len(signal), -1)
+    if filter_input and input_nodes is None:
+        input_nodes = _find_input_nodes(network)
+        if len(input_nodes) != 1:
+            raise ValueError('%i nodes with no input are connected to '
+                             % len(input_nodes) + 'network.adapt_ens, pass '
+                             + 'the one that outputs network.input_signal '
+                             + 'in as input_nodes')
+
+    model = nengo.builder.Model(dt=dt)
+    model.build(network.nengo_model)
+
+    rates = []
+    for ens in network.adapt_ens:
+        ens_signal = signal
+        if filter_input:
+            conns = [conn for conn in network.nengo_model.all_connections
+                     if conn.post_obj is ens
+                     and any(conn.pre_obj is node for node in input_nodes)]
+            if len(conns) != 1:
+                raise ValueError('%s has %i connections from the input '
+                                 % (ens, len(conns)) + 'nodes, expected 1')
+            if conns[0].synapse is not None:
+                # the input starts from zero, as it does in the simulation
+                ens_signal = conns[0].synapse.filt(signal, dt=dt, y0=0)
+        params = model.params[ens]
+        ens_rates = np.zeros((len(signal), ens.n_neurons))
+        for start in range(0, len(signal), chunk_size):
+            # the input projected onto each neuron's encoder
+            x = np.dot(ens_signal[start:start+chunk_size],
+                       params.encoders.T) / ens.radius
+            ens_rates[start:start+chunk_size] = ens.neuron_type.rates(
+                x, params.gain, params.bias)
+        rates.append(ens_rates * dt)
+    rates = np.hstack(rates)
+
+    report = None
+    if validate:
+        pscs = get_activities(
+            network=network, input_signal=input_signal, dt=dt,
+            synapse=probe_synapse, input_nodes=input_nodes)
+        report = validate_rates(rates=rates, pscs=pscs)
+    return rates, report
+
+
+def validate_rates(rates, pscs, threshold=1e-2):
+    '''
+    Compares the output of get_rates to the activities from a spiking
+    simulation and returns a dict of
+        'agreement': the proportion of timesteps and neurons where both agree
+            on whether the neuron is active,
+        'neuron_agreement': the proportion of neurons both agree are active
+            at some point or never active,
+        'proportion_active_error': the mean absolute difference in the
+            proportion of neurons active at each timestep,
+        'time_active_error': the mean absolute difference in the proportion
+            of time each neuron is active
+
+    PARAMETERS
+    ----------
+    rates: np.array (timesteps x n_neurons)
+        the output from get_rates
+    pscs: np.array (timesteps x n_neurons)
+        the output from get_activities with the same input_signal
+    threshold: float, Optional (Default: 1e-2)
+        the value above which a neuron is counted as active
+    '''
+    rates_active = np.asarray(rates) > threshold
+    pscs_active = np.asarray(pscs) > threshold
+    return {
+        'agreement': float(np.mean(rates_active == pscs_active)),
+        'neuron_agreement': float(np.mean(
+            np.any(rates_active, axis=0) == np.any(pscs_active, axis=0))),
+        'proportion_active_error': float(np.mean(np.abs(
+            np.mean(rates_active, axis=1) - np.mean(pscs_active, axis=1)))),
+        'time_active_error': float(np.mean(np.abs(
+            np.mean(rates_active, axis=0) - np.mean(pscs_active, axis=0)))),
+        }
+
+
+def compress_input(input_signal, method='kmeans', n_points=1000,
+                   resolution=0.05, batch_size=1024, n_iterations=100,
+                   seed=None):
+    '''
+    Clusters the timesteps of input_signal into representative points, so
+    the rate based activity metrics can be calculated for fewer inputs when
+    many timesteps are nearly the same, ex: input signals of several runs
+    stacked together. The order of the timesteps is lost, so the points are
+    meant for get_rates with filter_input=False, not for a spiking simulation
+
+    Returns the points (n_points x input_dim), their weights (n_points), the
+    proportion of timesteps each point represents, and the labels
+    (n_timesteps), the index of the point each timestep is represented by
+
+    PARAMETERS
+    ----------
+    input_signal: np array shape of (time_steps x input_dim)
+        the input to compress
+    method: string, Optional (Default: 'kmeans')
+        'kmeans' for mini-batch k-means with n_points clusters, or 'grid' to
+        quantize the input to a grid with resolution spacing, with a point
+        at the mean of the timesteps in each occupied cell
+    n_points: int, Optional (Default: 1000)
+        the number of clusters when method is 'kmeans', clusters that no
+        timestep is closest to are removed
+    resolution: float, Optional (Default: 0.05)
+        the grid spacing when method is 'grid'
+    batch_size: int, Optional (Default: 1024)
+        the number of random timesteps the clusters are moved towards in
+        each iteration when method is 'kmeans'
+    n_iterations: int, Optional (Default: 100)
+        the number of mini-batches when method is 'kmeans'
+    seed: int, Optional (Default: None)
+        the seed for the initial clusters and the mini-batches
+    '''
+    signal = np.asarray(input_signal, dtype=float)
+    signal = signal.reshape(len(signal), -1)
+
+    if method == 'grid':
+        cells = np.floor(signal / resolution).astype(np.int64)
+        _, labels, counts = np.unique(
+            cells, axis=0, return_inverse=True, return_counts=True)
+        labels = labels.reshape(-1)
+        points = np.zeros((len(counts), signal.shape[1]))
+        np.add.at(points, labels, signal)
+        points /= counts[:, None]
+
+    elif method == 'kmeans':
+        rng = np.random.RandomState(seed)
+        n_points = min(n_points, len(signal))
+        points = signal[rng.choice(len(signal), n_points, replace=False)]
+        # the number of timesteps each cluster has been moved towards, the
+        # inverse is the step size of each cluster
+        n_seen = np.zeros(n_points)
+        for _ in range(n_iterations):
+            batch = signal[rng.randint(len(signal), size=batch_size)]
+            _, nearest = scipy.spatial.cKDTree(points).query(batch)
+            n_batch = np.bincount(nearest, minlength=n_points)
+            sums = np.zeros(points.shape)
+            np.add.at(sums, nearest, batch)
+            n_seen += n_batch
+            moved = n_batch > 0
+            points[moved] += ((sums[moved]
+                               - n_batch[moved, None] * points[moved])
+                              / n_seen[moved, None])
+
+        _, labels = scipy.spatial.cKDTree(points).query(signal)
+        counts = np.bincount(labels, minlength=n_points)
+        # remove the clusters no timestep is closest to
+        used = counts > 0
+        points = points[used]
+        labels = (np.cumsum(used) - 1)[labels]
+        counts = counts[used]
+
+    else:
+        raise ValueError('method must be kmeans or grid, received %s'
+                         % method)
+
+    weights = counts / len(signal)
+    return points, weights, labels
+
+
+def compression_error(input_signal, points, weights, labels, network=None,
+                      threshold=1e-2, dt=0.001):
+    '''
+    Compares the output of compress_input to the full input_signal and
+    returns a dict of
+        'compression_ratio': the number of timesteps per point,
+        'quantization_error': the mean distance from each timestep to the
+            point it is represented by,
+        'max_quantization_error': the largest of those distances
+    and if a network is passed in, the rates of the points and of the full
+    input_signal are calculated with get_rates and the dict also has
+        'time_active_error': the mean absolute difference in the proportion
+            of time each neuron is active, with the points weighted,
+        'max_time_active_error': the largest of those differences,
+        'proportion_active_error': the mean absolute difference in the
+            proportion of neurons active at each timestep, with each
+            timestep replaced by its point,
+        'n_active_error': the difference in the number of neurons that are
+            ever active
+
+    PARAMETERS
+    ----------
+    input_signal: np array shape of (time_steps x input_dim)
+        the input passed to compress_input
+    points, weights, labels: np.arrays
+        the output from compress_input
+    network: .DynamicsAdaptation, Optional (Default: None)
+        'abr_control.controllers.signals.dynamics_adaptation'
+    threshold: float, Optional (Default: 1e-2)
+        the rate above which a neuron is counted as active
+    dt: float, Optional (Default: 0.001)
+        passed to get_rates, the rates are calculated with filter_input=False
+    '''
+    signal = np.asarray(input_signal, dtype=float)
+    signal = signal.reshape(len(signal), -1)
+    distances = np.linalg.norm(signal - points[labels], axis=1)
+    error = {
+        'compression_ratio': len(signal) / len(points),
+        'quantization_error': float(np.mean(distances)),
+        'max_quantization_error': float(np.max(distances)),
+        }
+
+    if network is not None:
+        # the points are not in time order, so neither input is filtered
+        rates, _ = get_rates(
+            network=network, input_signal=signal, dt=dt, filter_input=False)
+        point_rates, _ = get_rates(
+            network=network, input_signal=points, dt=dt, filter_input=False)
+
+        time_active, _ = proportion_time_neurons_active(
+            pscs=rates, threshold=threshold)
+        point_time_active, _ = proportion_time_neurons_active(
+            pscs=point_rates, threshold=threshold, weights=weights)
+        neurons_active, _ = proportion_neurons_active_over_time(
+            pscs=rates, threshold=threshold)
+        point_neurons_active, _ = proportion_neurons_active_over_time(
+            pscs=point_rates, threshold=threshold)
+        n_active, _ = n_neurons_active_and_inactive(rates > threshold)
+        point_n_active, _ = n_neurons_active_and_inactive(
+            point_rates > threshold)
+
+        time_active_error = np.abs(time_active - point_time_active)
+        error.update({
+            'time_active_error': float(np.mean(time_active_error)),
+            'max_time_active_error': float(np.max(time_active_error)),
+            'proportion_active_error': float(np.mean(np.abs(
+                neurons_active - point_neurons_active[labels]))),
+            'n_active_error': int(point_n_active - n_active),
+            })
+    return error
+
+
+def _count_active(activity, threshold, axis, chunk_size=10000):
+    '''
+    Returns the number of activities above threshold along axis (0 counts
+    the active timesteps of each neuron, 1 the active neurons at each
+    timestep). Dense and memory-mapped arrays are thresholded chunk_size
+    timesteps at a time to bound memory, sparse matrices are thresholded
+    without densifying when the threshold is not negative
+    '''
+    if scipy.sparse.issparse(activity) and threshold >= 0:
+        return np.asarray(
+            (activity > threshold).sum(axis=axis), dtype=float).ravel()
+
+    n_timesteps = activity.shape[0]
+    if axis == 0:
+        counts = np.zeros(activity.shape[1])
+    else:
+        counts = np.zeros(n_timesteps)
+    for start in range(0, n_timesteps, chunk_size):
+        chunk = activity[start:start+chunk_size]
+        if scipy.sparse.issparse(chunk):
+            chunk = chunk.toarray()
+        active = np.asarray(chunk) > threshold
+        if axis == 0:
+            counts += np.count_nonzero(active, axis=0)
+        else:
+            counts[start:start+chunk_size] = np.count_nonzero(active, axis=1)
+    return counts
 
 
 def proportion_neurons_active_over_time(
-        input_signal=None, network=None, pscs=None, synapse=0.005, ax=None):
+        input_signal=None, network=None, pscs=None, synapse=0.005, ax=None,
+        threshold=1e-2):
     '''
     Accepts a Nengo network and simulates its response to a given input
     Plots the proportion of active neurons vs run time onto the ax object
@@ -209,9 +1548,13 @@ def proportion_neurons_active_over_time(
         'abr_control.controllers.signals.dynamics_adaptation'
     pscs: np.array (timesteps x n_neurons), Optional (Default: None)
         the output from get_activities(synapse)
-        where 0.005 is the default pre_synapse time constant in PES
+        where 0.005 is the default pre_synapse time constant in PES,
+        can be a scipy.sparse matrix from get_activities(sparse=True) or
+        a memory-mapped array
     ax: ax object
         for plotting the output
+    threshold: float, Optional (Default: 1e-2)
+        the activity above which a neuron is counted as active
     '''
     assert not (network is None and pscs is None), (
         "Either a network object or an array of spike trains must be provided")
@@ -222,11 +1565,12 @@ def proportion_neurons_active_over_time(
             input_signal=input_signal,
             synapse=synapse)
 
-    n_neurons_active = np.zeros(pscs.shape[0])
-    for ii, timestep in enumerate(pscs):
-        n_neurons_active[ii] = len(np.where(timestep > 1e-2)[0])
-    proportion_neurons_active = (n_neurons_active /
-                                 (network.n_neurons * network.n_ensembles))
+    n_neurons_active = _count_active(pscs, threshold=threshold, axis=1)
+    if network is None:
+        n_neurons = pscs.shape[1]
+    else:
+        n_neurons = network.n_neurons * network.n_ensembles
+    proportion_neurons_active = n_neurons_active / n_neurons
 
     if ax is not None:
         print('Plotting proportion of active neurons over time...')
@@ -242,7 +1586,8 @@ def proportion_neurons_active_over_time(
 
 
 def proportion_time_neurons_active(
-        input_signal=None, network=None, pscs=None, synapse=0.005, ax=None):
+        input_signal=None, network=None, pscs=None, synapse=0.005, ax=None,
+        threshold=1e-2, weights=None):
     '''
     Accepts a Nengo network andsimulates its response to a given input
     Plots a histogram of neuron activity relative to run time onto ax
@@ -256,9 +1601,16 @@ def proportion_time_neurons_active(
         'abr_control.controllers.signals.dynamics_adaptation'
     pscs: np.array (timesteps x n_neurons), Optional (Default: None)
         the output from get_activities(synapse)
-        where 0.005 is the default pre_synapse time constant in PES
+        where 0.005 is the default pre_synapse time constant in PES,
+        can be a scipy.sparse matrix from get_activities(sparse=True) or
+        a memory-mapped array
     ax: ax object
         for plotting the output
+    threshold: float, Optional (Default: 1e-2)
+        the activity above which a neuron is counted as active
+    weights: np.array (timesteps), Optional (Default: None)
+        the proportion of time each row of pscs represents, ex: the weights
+        from compress_input when pscs are the rates of its points
     '''
     assert not (network is None and pscs is None), (
         "Either a network object or an array of spike trains must be provided")
@@ -269,11 +1621,15 @@ def proportion_time_neurons_active(
             input_signal=input_signal,
             synapse=synapse)
 
-    # for spike_train in pscs:
-    n_timesteps_active = np.zeros(pscs.shape[1])
-    for ii, timestep in enumerate(pscs.T):
-        n_timesteps_active[ii] = len(np.where(timestep > 1e-2)[0])
-    proportion_time_active = n_timesteps_active / pscs.shape[0]
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)
+        time_active = (pscs > threshold).T.dot(weights)
+        proportion_time_active = (
+            np.asarray(time_active).ravel() / np.sum(weights))
+    else:
+        n_timesteps_active = _count_active(
+            pscs, threshold=threshold, axis=0)
+        proportion_time_active = n_timesteps_active / pscs.shape[0]
 
     if ax is not None:
         plt.hist(proportion_time_active, bins=np.linspace(0, 1, 100))
@@ -292,8 +1648,14 @@ def n_neurons_active_and_inactive(activity):
     PARAMETERS
     ----------
     activity: int list of shape (n_timesteps x n_neurons)
-        a list of the neural activity over time
+        a list of the neural activity over time, or a scipy.sparse matrix
+        from get_activities(sparse=True)
     '''
+    if scipy.sparse.issparse(activity):
+        activity_sum = np.asarray(activity.sum(axis=0)).ravel()
+        n_inactive = len(np.where(activity_sum == 0)[0])
+        return activity.shape[1] - n_inactive, n_inactive
+
     activity = np.asarray(activity)
     if activity.ndim != 2:
         raise Exception('Input should be n_timesteps x n_neurons')
@@ -373,6 +1735,76 @@ def gen_learning_profile(network, input_signal, ax_list=None,
         plt.show()
 
 
+def _decimal_grid(value_range, step, scale):
+    '''
+    Returns np.arange(value_range[0], value_range[1], step) as integers in
+    units of 1 / scale, so the values are exact
+    '''
+    def to_int(value):
+        return int(decimal.Decimal(str(value)) * scale)
+    return np.arange(to_int(value_range[0]), to_int(value_range[1]),
+                     to_int(step))
+
+
+def iter_intercept_bounds_and_modes(intercept_range=None, intercept_step=0.1,
+                                    mode_range=None, mode_step=0.2,
+                                    chunk_size=10000):
+    '''
+    Generator that yields the valid combinations of intercept bounds and
+    modes from gen_intercept_bounds_and_modes as arrays of chunk_size rows
+    (the last can be shorter), so large sweeps can be passed on to workers
+    without creating every combination at once
+
+    The values are calculated as integers in units of the smallest decimal
+    place in the ranges and steps, so they are exact and equal modes and
+    bounds are compared correctly. The combinations are ordered by left
+    bound, then right bound, then mode
+
+    PARAMETERS
+    ----------
+    see gen_intercept_bounds_and_modes
+    chunk_size: int, Optional (Default: 10000)
+        the number of combinations in each chunk
+    '''
+    if intercept_range is None:
+        intercept_range = [-0.9, 1]
+    if mode_range is None:
+        mode_range = [-0.9, 1]
+
+    # the number of decimal places needed to represent every value exactly
+    n_decimals = max(
+        max(-decimal.Decimal(str(value)).normalize().as_tuple().exponent, 0)
+        for value in list(intercept_range) + list(mode_range)
+        + [intercept_step, mode_step])
+    scale = 10 ** n_decimals
+    bounds = _decimal_grid(intercept_range, intercept_step, scale)
+    modes = _decimal_grid(mode_range, mode_step, scale)
+
+    buffer = []
+    n_buffered = 0
+    for left in bounds:
+        # every right bound above left, and every mode between them
+        rights = bounds[bounds > left]
+        valid = ((modes[None, :] >= left)
+                 & (modes[None, :] <= rights[:, None]))
+        right_index, mode_index = np.nonzero(valid)
+        combinations = np.empty((len(right_index), 3))
+        combinations[:, 0] = left
+        combinations[:, 1] = rights[right_index]
+        combinations[:, 2] = modes[mode_index]
+        buffer.append(combinations / scale)
+        n_buffered += len(combinations)
+
+        while n_buffered >= chunk_size:
+            buffered = np.vstack(buffer)
+            yield buffered[:chunk_size]
+            buffer = [buffered[chunk_size:]]
+            n_buffered -= chunk_size
+
+    if n_buffered > 0:
+        yield np.vstack(buffer)
+
+
 def gen_intercept_bounds_and_modes(intercept_range=None, intercept_step=0.1,
                                    mode_range=None, mode_step=0.2):
     '''
@@ -384,6 +1816,9 @@ def gen_intercept_bounds_and_modes(intercept_range=None, intercept_step=0.1,
     - mode >= left bound
     - mode <= right bound
 
+    Each row is [left bound, right bound, mode]. To stream the combinations
+    in chunks see iter_intercept_bounds_and_modes
+
     PARAMETERS
     ----------
     intercept_range: list of two floats, Optional (Default: [-0.9, 1])
@@ -405,29 +1840,13 @@ def gen_intercept_bounds_and_modes(intercept_range=None, intercept_step=0.1,
         the right bound must be set to 0.9 + 0.1 = 1.0 to check the range
         of values up to and including 0.9
     '''
-    if intercept_range is None:
-        intercept_range = [-0.9, 1]
-    if mode_range is None:
-        mode_range = [-0.9, 1]
-    intercept_range = np.arange(intercept_range[0], intercept_range[1],
-                                intercept_step)
-    mode_range = np.arange(mode_range[0], mode_range[1], mode_step)
-
-    # Create list of all possible intercepts
-    intercepts = np.array(np.meshgrid(
-        intercept_range, intercept_range)).T.reshape(-1, 2)
-    # get a list of all valid intercepts
-    valid = []
-    for vals in intercepts:
-        vals[0] = round(vals[0], 1)
-        vals[1] = round(vals[1], 1)
-        if vals[0] < vals[1]:
-            for mode in mode_range:
-                mode = round(mode, 1)
-                if vals[0] <= mode <= vals[1]:
-                    valid.append(np.array([vals[0], vals[1], mode]))
-
-    intercepts = np.array(valid)
+    chunks = list(iter_intercept_bounds_and_modes(
+        intercept_range=intercept_range, intercept_step=intercept_step,
+        mode_range=mode_range, mode_step=mode_step))
+    if chunks:
+        intercepts = np.vstack(chunks)
+    else:
+        intercepts = np.zeros((0, 3))
     print('There are %i valid combinations of intercepts and modes' %
           len(intercepts))
 
@@ -1,10 +1,10 @@
 import pytest
 import numpy as np
 
+from abr_analyze.data_handler import DataHandler
 from abr_analyze.nengo import intercepts_scan, network_utils
 
-def get_params():
-    n_ensembles = 1
+def get_params(n_ensembles=1):
     n_neurons = 50
     # encoders should be n_ensembles x n_neurons x n_dims
     encoders = np.array([np.random.choice([-1, 1], n_neurons)[:, None]
@@ -33,6 +33,153 @@ def test_run():
         )
 
 
+def test_run_reuse_simulator():
+    encoders, intercept_vals, input_signal = get_params()
+    dat = DataHandler('intercepts_scan_test_reuse')
+
+    results = []
+    for reuse_simulator in [False, True]:
+        save_name = 'reuse_simulator_%s' % reuse_simulator
+        intercepts_scan.run(
+            encoders=encoders,
+            intercept_vals=intercept_vals,
+            input_signal=input_signal,
+            analysis_fncs=[network_utils.proportion_neurons_active_over_time],
+            db_name='intercepts_scan_test_reuse',
+            save_name=save_name,
+            reuse_simulator=reuse_simulator,
+            )
+        results.append([
+            dat.load(parameters=['y'], save_location='%s/%s/%05d' % (
+                save_name, 'proportion_neurons_active_over_time', ii))['y']
+            for ii in range(len(intercept_vals))])
+
+    # the results are the same as building a new network for each intercept
+    for rebuilt, reused in zip(*results):
+        assert np.array_equal(rebuilt, reused)
+
+
+@pytest.mark.parametrize('batch_size', (1, 2))
+def test_run_reuse_simulator_ensembles(batch_size, monkeypatch):
+    encoders, intercept_vals, input_signal = get_params(n_ensembles=2)
+    intercept_vals = intercept_vals + intercept_vals[:1]
+    db_name = 'intercepts_scan_test_reuse_ensembles'
+    dat = DataHandler(db_name)
+
+    # count the networks built
+    built = []
+    DynamicsAdaptation = intercepts_scan.signals.DynamicsAdaptation
+    def build_network(*args, **kwargs):
+        built.append(kwargs['n_ensembles'])
+        return DynamicsAdaptation(*args, **kwargs)
+    monkeypatch.setattr(
+        intercepts_scan.signals, 'DynamicsAdaptation', build_network)
+
+    results = []
+    for reuse_simulator in [False, True]:
+        built.clear()
+        save_name = 'batch_size_%i_reuse_simulator_%s' % (
+            batch_size, reuse_simulator)
+        intercepts_scan.run(
+            encoders=encoders,
+            intercept_vals=intercept_vals,
+            input_signal=input_signal,
+            analysis_fncs=[network_utils.proportion_neurons_active_over_time],
+            db_name=db_name,
+            save_name=save_name,
+            reuse_simulator=reuse_simulator,
+            batch_size=batch_size,
+            n_ensembles=2,
+            )
+        results.append([
+            dat.load(parameters=['y'], save_location='%s/%s/%05d' % (
+                save_name, 'proportion_neurons_active_over_time', ii))['y']
+            for ii in range(len(intercept_vals))])
+
+    # the simulator built for the first batch is reused for the rest
+    assert built == [2 * batch_size]
+    for rebuilt, reused in zip(*results):
+        assert np.array_equal(rebuilt, reused)
+
+
+def test_run_batched():
+    encoders, intercept_vals, input_signal = get_params()
+    dat = DataHandler('intercepts_scan_test_batched')
+
+    results = []
+    for batch_size in [1, 2, 3]:
+        save_name = 'batch_size_%i' % batch_size
+        intercepts_scan.run(
+            encoders=encoders,
+            intercept_vals=intercept_vals,
+            input_signal=input_signal,
+            analysis_fncs=[network_utils.proportion_neurons_active_over_time],
+            db_name='intercepts_scan_test_batched',
+            save_name=save_name,
+            batch_size=batch_size,
+            )
+        results.append([
+            dat.load(parameters=['y'], save_location='%s/%s/%05d' % (
+                save_name, 'proportion_neurons_active_over_time', ii))['y']
+            for ii in range(len(intercept_vals))])
+
+    # the ensembles of each combination are seeded differently in a batch,
+    # so the proportions only match closely
+    for unbatched, *batched in zip(*results):
+        for y in batched:
+            assert y.shape == unbatched.shape
+            assert np.mean(np.abs(y - unbatched)) < 0.05
+
+
+@pytest.mark.parametrize('batch_size', (1, 2))
+def test_run_metrics(batch_size):
+    encoders, intercept_vals, input_signal = get_params()
+    db_name = 'intercepts_scan_test_metrics'
+    dat = DataHandler(db_name)
+    parameters = ['y', 'num_active', 'num_inactive']
+
+    results = []
+    for streaming in [False, True]:
+        save_name = 'batch_size_%i_streaming_%s' % (batch_size, streaming)
+        if streaming:
+            analysis = {'metrics': [
+                network_utils.ProportionTimeActive,
+                network_utils.ProportionNeuronsActive],
+                        'chunk_size': 30}
+        else:
+            analysis = {'analysis_fncs': [
+                network_utils.proportion_time_neurons_active,
+                network_utils.proportion_neurons_active_over_time]}
+        intercepts_scan.run(
+            encoders=encoders,
+            intercept_vals=intercept_vals,
+            input_signal=input_signal,
+            db_name=db_name,
+            save_name=save_name,
+            batch_size=batch_size,
+            **analysis)
+        results.append([
+            dat.load(parameters=parameters, save_location='%s/%s/%05d' % (
+                save_name, func_name, ii))
+            for func_name in ['proportion_time_neurons_active',
+                              'proportion_neurons_active_over_time']
+            for ii in range(len(intercept_vals))])
+
+    # the metrics computed chunk by chunk match the analysis functions
+    for full, streamed in zip(*results):
+        for parameter in parameters:
+            assert np.array_equal(full[parameter], streamed[parameter])
+
+    with pytest.raises(ValueError):
+        intercepts_scan.run(
+            encoders=encoders,
+            intercept_vals=intercept_vals,
+            input_signal=input_signal,
+            db_name=db_name,
+            analysis_fncs=[network_utils.proportion_time_neurons_active],
+            metrics=[network_utils.ProportionTimeActive])
+
+
 def test_review(plt):
     encoders, intercept_vals, input_signal = get_params()
 
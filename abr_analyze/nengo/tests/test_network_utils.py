@@ -1,8 +1,13 @@
+import timeit
+
+import matplotlib.figure
 import pytest
 import numpy as np
+import scipy.sparse
 
 import nengo
 
+from abr_analyze.data_handler import DataHandler
 from abr_analyze.nengo import network_utils
 
 class DynamicsAdaptation:
@@ -33,6 +38,23 @@ class DynamicsAdaptation:
 
         self.sim = nengo.Simulator(self.nengo_model)
 
+
+class DynamicsAdaptation2d(DynamicsAdaptation):
+    def __init__(self, n_neurons, n_ensembles, **kwargs):
+        self.n_neurons = n_neurons
+        self.n_ensembles = n_ensembles
+        self.input_signal = np.zeros(2)
+
+        self.nengo_model = nengo.Network()
+        with self.nengo_model:
+            input_node = nengo.Node(lambda t: self.input_signal, size_out=2)
+
+            self.adapt_ens = []
+            for ii in range(n_ensembles):
+                self.adapt_ens.append(nengo.Ensemble(
+                    n_neurons, dimensions=2, **kwargs))
+                nengo.Connection(input_node, self.adapt_ens[ii])
+
 @pytest.mark.parametrize('thresh', ((0.001, 0.01, 0.1, 1.0)))
 def test_generate_encoders(thresh):
 
@@ -51,6 +73,42 @@ def test_generate_encoders(thresh):
         assert np.all(np.linalg.norm(encoders - encoders[ii]) > thresh)
 
 
+@pytest.mark.parametrize('n_neurons', (10, 100, 500))
+def test_generate_encoders_poisson(n_neurons):
+    x = np.arange(0, 2*np.pi, 0.001)
+    input_signal = np.vstack([np.sin(x), np.cos(x)]).T
+
+    encoders = network_utils.generate_encoders(
+        n_neurons=n_neurons, input_signal=input_signal, method='poisson',
+        seed=0)
+    assert encoders.shape == (n_neurons, 2)
+    # the encoders are samples of the input
+    assert np.allclose(np.linalg.norm(encoders, axis=1), 1)
+    # and the same encoders are selected with the same seed
+    assert np.array_equal(encoders, network_utils.generate_encoders(
+        n_neurons=n_neurons, input_signal=input_signal, method='poisson',
+        seed=0))
+
+    report = network_utils.compare_encoder_selection(
+        n_neurons=n_neurons, input_signal=input_signal, seed=0)
+    assert report['poisson']['n_encoders'] == n_neurons
+    assert (report['poisson']['min_distance']
+            >= report['random_pairs']['min_distance'])
+
+
+def test_generate_encoders_poisson_padded():
+    input_signal = np.array([[1, 0], [0, 1], [1, 0]])
+    encoders = network_utils.generate_encoders(
+        n_neurons=5, input_signal=input_signal, method='poisson')
+    assert encoders.shape == (5, 2)
+
+    # the input_signal sets the dimensions of the encoders
+    for input_signal in [None, np.ones(10)]:
+        with pytest.raises(ValueError):
+            network_utils.generate_encoders(
+                n_neurons=5, input_signal=input_signal, method='poisson')
+
+
 # NOTE: this tests plots are properly generated, for full confirmation
 # the plots in results folder should be visually inspected
 @pytest.mark.parametrize('network, num_ens_to_raster', (
@@ -65,6 +123,37 @@ def test_raster_plot(network, num_ens_to_raster, plt):
     network_utils.raster_plot(network, input_signal, ax, num_ens_to_raster)
 
 
+def test_bin_spikes():
+    rng = np.random.RandomState(0)
+    spike_trains = (rng.rand(1003, 47) > 0.9).astype(float)
+
+    image = network_utils.bin_spikes(spike_trains, time_bin=10, neuron_bin=5)
+    assert image.shape == (10, 101)
+    assert np.sum(image) == np.sum(spike_trains)
+    assert image[2, 3] == np.sum(spike_trains[30:40, 10:15])
+    assert np.array_equal(image, network_utils.bin_spikes(
+        scipy.sparse.csr_matrix(spike_trains), time_bin=10, neuron_bin=5))
+
+
+@pytest.mark.parametrize('sparse', (False, True))
+def test_raster_plot_binned(sparse):
+    network = DynamicsAdaptation(100, 3, seed=0)
+    input_signal = np.sin(np.linspace(0, 2*np.pi, 3000))
+    # the plt fixture is a mock unless plots are saved, so check a figure
+    fig = matplotlib.figure.Figure()
+    ax = fig.add_subplot(1, 1, 1)
+    network_utils.raster_plot(
+        network, input_signal, ax, n_ens_to_raster=2, sparse=sparse,
+        binned=True, resolution=(500, 50))
+
+    # one image with bins sized for the resolution, only the rastered
+    # ensembles are drawn
+    images = ax.get_images()
+    assert len(images) == 1
+    assert images[0].get_array().shape == (50, 500)
+    assert ax.get_ylim() == (200.5, 0.5)
+
+
 @pytest.mark.parametrize('network, input_signal, answer', (
     (DynamicsAdaptation(1, 1, encoders=[[1]], max_rates=[10]),
      np.ones(1000), 10),
@@ -90,6 +179,294 @@ def test_get_activities(network, input_signal, answer):
     assert abs(np.sum(spike_trains) - answer) <= threshold
 
 
+@pytest.mark.parametrize('input_signal', (
+    np.sin(np.linspace(0, 2*np.pi, 2000)),
+    np.vstack([np.sin(np.linspace(0, 2*np.pi, 2000))]*2).T,
+    ))
+def test_get_activities_whole_signal(input_signal):
+    if input_signal.ndim == 1:
+        network = DynamicsAdaptation(50, 2, seed=0)
+    else:
+        network = DynamicsAdaptation2d(50, 2, seed=0)
+
+    # benchmark against setting the input and running the sim each timestep
+    start = timeit.default_timer()
+    step_by_step = network_utils.get_activities(
+        network=network, input_signal=input_signal, synapse=0.005,
+        step_by_step=True)
+    step_time = timeit.default_timer() - start
+
+    start = timeit.default_timer()
+    whole_signal = network_utils.get_activities(
+        network=network, input_signal=input_signal, synapse=0.005)
+    whole_time = timeit.default_timer() - start
+    print('%i timesteps, step by step: %.3f s, whole signal: %.3f s'
+          % (len(input_signal), step_time, whole_time))
+
+    assert np.array_equal(step_by_step, whole_signal)
+
+
+def test_get_activities_input_nodes():
+    network = DynamicsAdaptation(50, 1, seed=0)
+    input_node = network.nengo_model.nodes[0]
+    calls = []
+    def bias_func(t):
+        calls.append(t)
+        return 0.1
+    with network.nengo_model:
+        # a second node feeding the ensemble that does not output
+        # network.input_signal
+        nengo.Connection(
+            nengo.Node(bias_func, size_out=1), network.adapt_ens[0])
+
+    # the input nodes are found from the connections, without calling them
+    assert network_utils._find_input_nodes(network)[0] is input_node
+    assert len(calls) == 0
+
+    input_signal = np.sin(np.linspace(0, 2*np.pi, 500))
+    step_by_step = network_utils.get_activities(
+        network=network, input_signal=input_signal, synapse=0.005,
+        step_by_step=True)
+    whole_signal = network_utils.get_activities(
+        network=network, input_signal=input_signal, synapse=0.005,
+        input_nodes=[input_node])
+    assert np.array_equal(step_by_step, whole_signal)
+
+    # the input node is not guessed when there is more than one candidate
+    with pytest.raises(ValueError):
+        network_utils.get_activities(
+            network=network, input_signal=input_signal, synapse=0.005)
+
+
+def test_get_activities_errors():
+    network = DynamicsAdaptation(20, 1, seed=0)
+    input_signal = np.sin(np.linspace(0, 2*np.pi, 200))
+    with pytest.raises(ValueError):
+        network_utils.get_activities(
+            network=network, input_signal=np.zeros(0), synapse=0.005)
+
+    network_utils.get_activities(
+        network=network, input_signal=input_signal, synapse=0.005)
+    sim = network.sim
+    # the simulator can only be reused with the input_signal and dt it was
+    # built with
+    for kwargs in [{'input_signal': input_signal[:100]},
+                   {'input_signal': np.vstack([input_signal]*2).T},
+                   {'input_signal': input_signal * 2},
+                   {'input_signal': input_signal, 'dt': 0.002},
+                   {'input_signal': input_signal, 'step_by_step': True}]:
+        with pytest.raises(ValueError):
+            network_utils.get_activities(
+                network=network, synapse=0.005, sim=sim, **kwargs)
+    network_utils.get_activities(
+        network=network, input_signal=input_signal, synapse=0.005, sim=sim)
+
+
+@pytest.mark.parametrize('network, input_signal, answer', (
+    (DynamicsAdaptation(1, 1, encoders=[[1]], max_rates=[100]),
+     np.ones(1000), 100),
+    (DynamicsAdaptation(1, 1, encoders=[[-1]], max_rates=[100]),
+     -1 * np.ones(1000), 100),
+    (DynamicsAdaptation(1, 1, encoders=[[1]], max_rates=[100]),
+     -1 * np.ones(1000), 0),
+    ))
+def test_get_rates(network, input_signal, answer):
+    rates, report = network_utils.get_rates(
+        network=network, input_signal=input_signal, chunk_size=300,
+        filter_input=False)
+
+    assert report is None
+    assert rates.shape == (1000, 1)
+    assert np.isclose(np.sum(rates), answer)
+
+
+@pytest.mark.parametrize('synapse', (None, 0.005, 0.02))
+def test_get_rates_synapse(synapse):
+    network = DynamicsAdaptation(50, 1, seed=0)
+    if synapse != 0.005:
+        # nengo's default synapse is 0.005
+        network.nengo_model.connections[0].synapse = synapse
+    input_signal = np.ones((200, 1))
+    rates, _ = network_utils.get_rates(
+        network=network, input_signal=input_signal)
+
+    # the rates follow the input filtered by the synapse on the connection
+    # to the ensemble, which rises from zero at the start of the run
+    filtered = input_signal
+    if synapse is not None:
+        filtered = nengo.Lowpass(synapse).filt(input_signal, dt=0.001, y0=0)
+    assert np.allclose(rates, network_utils.get_rates(
+        network=network, input_signal=filtered, filter_input=False)[0])
+    if synapse is not None:
+        assert not np.allclose(rates, network_utils.get_rates(
+            network=network, input_signal=input_signal,
+            filter_input=False)[0])
+
+
+def test_get_rates_validate():
+    network = DynamicsAdaptation(100, 2, seed=0)
+    input_signal = np.sin(np.linspace(0, 2*np.pi, 2000))
+    rates, report = network_utils.get_rates(
+        network=network, input_signal=input_signal, validate=True,
+        probe_synapse=0.01)
+
+    assert rates.shape == (2000, 200)
+    assert report['agreement'] > 0.95
+    assert report['neuron_agreement'] > 0.95
+
+    # the rates can be used in place of the spiking activities
+    proportion_active, _ = network_utils.proportion_neurons_active_over_time(
+        network=network, pscs=rates)
+    assert np.all((proportion_active >= 0) & (proportion_active <= 1))
+
+
+def test_set_intercepts():
+    input_signal = np.sin(np.linspace(0, 2*np.pi, 1000))
+    rng = np.random.RandomState(1)
+
+    network = DynamicsAdaptation(60, 2, seed=0)
+    network_utils.get_activities(
+        network=network, input_signal=input_signal, synapse=0.005)
+    sim = network.sim
+
+    for _ in range(3):
+        intercepts = rng.uniform(-0.5, 0.9, 60)
+        network_utils.set_intercepts(
+            sim=sim, ensembles=network.adapt_ens,
+            intercepts=[intercepts, intercepts])
+        reused = network_utils.get_activities(
+            network=network, input_signal=input_signal, synapse=0.005,
+            sim=sim)
+
+        # compare to building the network with the intercepts
+        rebuilt = network_utils.get_activities(
+            network=DynamicsAdaptation(
+                60, 2, seed=0, intercepts=intercepts),
+            input_signal=input_signal, synapse=0.005)
+
+        assert np.array_equal(reused, rebuilt)
+
+
+def test_set_intercepts_nengo_version(monkeypatch):
+    input_signal = np.sin(np.linspace(0, 2*np.pi, 200))
+    network = DynamicsAdaptation(20, 1, seed=0)
+    before = network_utils.get_activities(
+        network=network, input_signal=input_signal, synapse=0.005)
+
+    # the simulator is not changed with untested versions of nengo
+    monkeypatch.setattr(
+        network_utils, 'SET_SIGNAL_NENGO_VERSIONS', ((0, 0), (1, 0)))
+    with pytest.raises(ValueError):
+        network_utils.set_intercepts(
+            sim=network.sim, ensembles=network.adapt_ens,
+            intercepts=[np.zeros(20)])
+    after = network_utils.get_activities(
+        network=network, input_signal=input_signal, synapse=0.005,
+        sim=network.sim)
+    assert np.array_equal(before, after)
+
+
+def test_build_cache(tmp_path):
+    input_signal = np.sin(np.linspace(0, 2*np.pi, 500))
+
+    def get_network(intercepts=nengo.dists.Uniform(-1, 0.9)):
+        network = DynamicsAdaptation(60, 2, intercepts=intercepts)
+        network.nengo_model.seed = 0
+        with network.nengo_model:
+            output = nengo.Node(size_in=1)
+            network.conn = nengo.Connection(
+                network.adapt_ens[0], output, function=lambda x: x**2,
+                learning_rule_type=nengo.PES())
+        return network
+
+    results = []
+    for _ in range(2):
+        cache = network_utils.BuildCache(cache_dir=str(tmp_path))
+        network = get_network()
+        activities = network_utils.get_activities(
+            network=network, input_signal=input_signal, cache=cache)
+        results.append((activities, network.sim.data[network.conn].weights))
+        assert cache.key(network) == cache.key(get_network())
+    # the decoders and the parameters of the two ensembles are calculated
+    # the first time and loaded the second
+    assert (cache.hits, cache.misses) == (3, 0)
+    assert np.array_equal(results[0][0], results[1][0])
+    assert np.array_equal(results[0][1], results[1][1])
+
+    # a different network is not loaded from the cache
+    assert cache.key(get_network(intercepts=nengo.dists.Uniform(-1, 0.5))) \
+        != cache.key(network)
+    network.nengo_model.seed = None
+    assert cache.key(network) is None
+
+    assert cache.get_size_in_bytes() > 0
+    cache.shrink(limit=0)
+    assert cache.get_size_in_bytes() == 0
+
+
+def test_build_cache_ensembles(tmp_path):
+    # a network without decoded connections
+    def get_network():
+        network = DynamicsAdaptation(60, 2)
+        network.nengo_model.seed = 0
+        return network
+    input_signal = np.sin(np.linspace(0, 2*np.pi, 500))
+    expected = get_network()
+    expected_activities = network_utils.get_activities(
+        network=expected, input_signal=input_signal, synapse=0.005)
+
+    for hits in [0, 2]:
+        cache = network_utils.BuildCache(cache_dir=str(tmp_path))
+        network = get_network()
+        activities = network_utils.get_activities(
+            network=network, input_signal=input_signal, synapse=0.005,
+            cache=cache)
+        # the ensemble parameters are calculated the first time and loaded
+        # the second
+        assert (cache.hits, cache.misses) == (hits, 2 - hits)
+        assert np.array_equal(activities, expected_activities)
+        for ens, expected_ens in zip(network.adapt_ens, expected.adapt_ens):
+            built = network.sim.model.params[ens]
+            expected_built = expected.sim.model.params[expected_ens]
+            for name in built._fields:
+                assert np.array_equal(getattr(built, name),
+                                      getattr(expected_built, name))
+        # the ensemble parameters are left unchanged
+        assert network.adapt_ens[0].gain is None
+
+
+@pytest.mark.parametrize('synapse', (None, 0.005))
+def test_get_activities_sparse(synapse, plt):
+    network = DynamicsAdaptation(50, 2, seed=0)
+    input_signal = np.sin(np.linspace(0, 2*np.pi, 2500))
+
+    dense = network_utils.get_activities(
+        network=network, input_signal=input_signal, synapse=synapse)
+    sparse = network_utils.get_activities(
+        network=network, input_signal=input_signal, synapse=synapse,
+        sparse=True, chunk_size=1000)
+
+    assert scipy.sparse.issparse(sparse)
+    assert sparse.indices.dtype == np.int32
+    assert np.array_equal(sparse.toarray(), dense)
+
+    # the analysis functions give the same results without densifying
+    for func in [network_utils.proportion_neurons_active_over_time,
+                 network_utils.proportion_time_neurons_active]:
+        assert np.array_equal(func(network=network, pscs=sparse)[0],
+                              func(network=network, pscs=dense)[0])
+    assert (network_utils.n_neurons_active_and_inactive(sparse)
+            == network_utils.n_neurons_active_and_inactive(dense))
+
+    steps, neurons = network_utils.spike_events(sparse)
+    assert np.array_equal(
+        np.stack([steps, neurons]), np.stack(np.nonzero(dense)))
+
+    fig = plt.figure()
+    ax = fig.add_subplot(1, 1, 1)
+    network_utils.raster_plot(network, input_signal, ax, sparse=True)
+
+
 # expected sum of proportion of total neurons active over time over 1 second
 # is n_neurons_active / n_neurons * max_rates
 @pytest.mark.parametrize('network, input_signal, answer', (
@@ -143,6 +520,87 @@ def test_proportion_time_neurons_active(network, input_signal, answer, plt):
     assert round(abs(np.sum(proportion_time_active) - answer), 6) <= threshold
 
 
+def test_split_activities():
+    activities = np.arange(24).reshape(4, 6) % 5
+    splits = network_utils.split_activities(activities, n_splits=3)
+    assert len(splits) == 3
+    assert np.array_equal(np.hstack(splits), activities)
+
+    sparse_splits = network_utils.split_activities(
+        scipy.sparse.csr_matrix(activities), n_splits=3)
+    for split, sparse_split in zip(splits, sparse_splits):
+        assert scipy.sparse.isspmatrix_csr(sparse_split)
+        assert np.array_equal(sparse_split.toarray(), split)
+
+    with pytest.raises(ValueError):
+        network_utils.split_activities(activities, n_splits=4)
+
+
+def test_get_activities_sinks():
+    network = DynamicsAdaptation(50, 2, seed=0)
+    input_signal = np.sin(np.linspace(0, 2*np.pi, 2500))
+    dense = network_utils.get_activities(
+        network=network, input_signal=input_signal, synapse=0.005)
+
+    dat = DataHandler('network_utils_test')
+    if dat.check_group_exists('sinks'):
+        dat.delete(save_location='sinks')
+    counter = network_utils.ActivityCounter()
+    writer = network_utils.H5ActivityWriter(
+        db_name='network_utils_test', save_location='sinks')
+    activities = network_utils.get_activities(
+        network=network, input_signal=input_signal, synapse=0.005,
+        chunk_size=1000, sinks=[counter, writer])
+    # the activities are only passed to the sinks
+    assert activities is None
+
+    # the metrics accumulated chunk by chunk match the full activities
+    assert np.array_equal(
+        counter.proportion_neurons_active(),
+        network_utils.proportion_neurons_active_over_time(
+            network=network, pscs=dense)[0])
+    assert np.array_equal(
+        counter.proportion_time_active(),
+        network_utils.proportion_time_neurons_active(
+            network=network, pscs=dense)[0])
+    assert (counter.n_active_and_inactive()
+            == network_utils.n_neurons_active_and_inactive(dense))
+
+    saved = dat.load(parameters=['activities'], save_location='sinks')
+    assert np.array_equal(saved['activities'], dense)
+
+
+@pytest.mark.parametrize('threshold', (0, 1e-2, 0.5))
+@pytest.mark.parametrize('form', ('dense', 'sparse', 'memmap'))
+def test_proportion_active_forms(threshold, form, tmp_path):
+    rng = np.random.RandomState(0)
+    pscs = rng.rand(2500, 30) * (rng.rand(2500, 30) > 0.7)
+
+    # the per timestep and per neuron loops the metrics are defined by
+    neurons_active = np.array(
+        [len(np.where(timestep > threshold)[0]) for timestep in pscs]) / 30
+    time_active = np.array(
+        [len(np.where(neuron > threshold)[0]) for neuron in pscs.T]) / 2500
+
+    if form == 'sparse':
+        activity = scipy.sparse.csr_matrix(pscs)
+    elif form == 'memmap':
+        activity = np.memmap(str(tmp_path / 'pscs.dat'), dtype=float,
+                             mode='w+', shape=pscs.shape)
+        activity[:] = pscs
+    else:
+        activity = pscs
+
+    proportion_neurons_active, _ = (
+        network_utils.proportion_neurons_active_over_time(
+            pscs=activity, threshold=threshold))
+    proportion_time_active, _ = network_utils.proportion_time_neurons_active(
+        pscs=activity, threshold=threshold)
+
+    assert np.array_equal(proportion_neurons_active, neurons_active)
+    assert np.array_equal(proportion_time_active, time_active)
+
+
 @pytest.mark.parametrize('network, input_signal, answer', (
     (DynamicsAdaptation(2, 1, encoders=[[1], [1]], max_rates=[10, 10]),
      np.ones((1000, 1)), (2, 0)),
@@ -197,3 +655,66 @@ def test_gen_intercept_bounds_and_modes(intercept_range, intercept_step,
 
     assert (np.all(intercepts[:, 0] <= intercepts[:, 2]) and
             np.all(intercepts[:, 2] <= intercepts[:, 1]))
+
+
+@pytest.mark.parametrize('method', ('kmeans', 'grid'))
+def test_compress_input(method):
+    rng = np.random.RandomState(0)
+    x = np.linspace(0, 2*np.pi, 1000)
+    # several noisy runs of the same trajectory
+    input_signal = np.vstack([
+        0.8 * np.vstack([np.sin(x), np.cos(x)]).T + rng.randn(1000, 2) * 0.01
+        for _ in range(5)])
+    network = DynamicsAdaptation2d(50, 1, seed=0)
+
+    points, weights, labels = network_utils.compress_input(
+        input_signal, method=method, n_points=200, resolution=0.05, seed=0)
+    assert points.shape[1] == 2 and len(points) <= 200
+    assert np.isclose(np.sum(weights), 1)
+    assert np.array_equal(
+        np.bincount(labels, minlength=len(points)) / len(input_signal),
+        weights)
+
+    error = network_utils.compression_error(
+        input_signal, points, weights, labels, network=network)
+    assert error['compression_ratio'] >= 25
+    assert error['max_quantization_error'] < 0.1
+    assert error['time_active_error'] < 0.01
+    assert error['proportion_active_error'] < 0.01
+
+
+def test_compress_input_repeated():
+    # a repeated input compresses to one point per timestep without error
+    base = np.vstack([np.linspace(-1, 1, 300), np.linspace(1, -1, 300)]).T
+    points, weights, labels = network_utils.compress_input(
+        np.tile(base, (3, 1)), method='grid', resolution=1e-9)
+    assert len(points) == len(base)
+    assert np.allclose(weights, 1 / len(base))
+
+    network = DynamicsAdaptation2d(50, 1, seed=0)
+    rates, _ = network_utils.get_rates(
+        network=network, input_signal=base, filter_input=False)
+    point_rates, _ = network_utils.get_rates(
+        network=network, input_signal=points, filter_input=False)
+    time_active, _ = network_utils.proportion_time_neurons_active(pscs=rates)
+    weighted, _ = network_utils.proportion_time_neurons_active(
+        pscs=point_rates, weights=weights)
+    assert np.allclose(time_active, weighted)
+
+    with pytest.raises(ValueError):
+        network_utils.compress_input(base, method='random')
+
+
+def test_iter_intercept_bounds_and_modes():
+    intercepts = network_utils.gen_intercept_bounds_and_modes(
+        intercept_step=0.05, mode_step=0.05)
+    # the values are exact, so modes equal to a bound are included
+    assert np.array_equal(np.round(intercepts, 2), intercepts)
+    assert np.any(intercepts[:, 0] == intercepts[:, 2])
+    assert np.any(intercepts[:, 1] == intercepts[:, 2])
+    assert len(np.unique(intercepts, axis=0)) == len(intercepts)
+
+    chunks = list(network_utils.iter_intercept_bounds_and_modes(
+        intercept_step=0.05, mode_step=0.05, chunk_size=1000))
+    assert all(len(chunk) == 1000 for chunk in chunks[:-1])
+    assert np.array_equal(np.vstack(chunks), intercepts)
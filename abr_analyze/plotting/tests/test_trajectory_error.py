@@ -1,7 +1,11 @@
+import functools
+import multiprocessing
+
 import numpy as np
 import pytest
 
-from abr_analyze.plotting import TrajectoryError
+import abr_analyze.data_processor as proc
+from abr_analyze.plotting import TrajectoryError, trajectory_error
 from abr_analyze.data_handler import DataHandler
 from abr_analyze.utils import random_trajectories
 
@@ -56,3 +60,349 @@ def test_statistical_error(ideal, save_data, regen, save_location=save_location)
     data = traj.statistical_error(
         save_location=save_location.split('/')[0], ideal=ideal, sessions=1,
         runs=1, save_data=save_data, regen=regen)
+
+
+def test_statistical_error_workers():
+    dat = DataHandler('test')
+    test_name = 'traj_err_workers_test'
+    sessions = 2
+    runs = 3
+    for session in range(sessions):
+        for run in range(runs):
+            dat.save(data=random_trajectories.generate(steps=50),
+                     save_location='%s/session%03d/run%03d'
+                     % (test_name, session, run), overwrite=True)
+
+    traj = TrajectoryError(
+        db_name='test', time_derivative=1, interpolated_samples=40)
+    locations = ['%s/session%03d/run%03d' % (test_name, session, run)
+                 for session in range(sessions) for run in range(runs)]
+    serial_runs = traj.calculate_run_errors(locations, workers=1)
+    parallel_runs = traj.calculate_run_errors(locations, workers=2)
+    # the errors of every run are returned in the order of locations
+    assert serial_runs == parallel_runs
+
+    results = []
+    for workers in [1, 2]:
+        # the confidence intervals are bootstrapped
+        np.random.seed(0)
+        results.append(traj.statistical_error(
+            save_location=test_name, sessions=sessions, runs=runs,
+            save_data=False, regen=True, workers=workers))
+    serial, parallel = results
+    for key in ['mean', 'upper_bound', 'lower_bound']:
+        assert np.array_equal(serial[key], parallel[key])
+
+
+def test_statistical_error_workers_registered_metric(monkeypatch):
+    db_name = 'traj_err_workers_metric_test'
+    test_name = 'traj_err_workers_metric_test'
+    metric_dat = DataHandler(db_name)
+    for run in range(3):
+        metric_dat.save(
+            data=random_trajectories.generate(steps=50),
+            save_location='%s/session000/run%03d' % (test_name, run),
+            overwrite=True)
+    monkeypatch.setitem(
+        trajectory_error.METRICS, 'loose_settling_time',
+        functools.partial(trajectory_error.settling_time, tolerance=100))
+    traj = TrajectoryError(
+        db_name=db_name, interpolated_samples=None,
+        metrics=['loose_settling_time'])
+    locations = ['%s/session000/run%03d' % (test_name, run)
+                 for run in range(3)]
+
+    serial_runs = traj.calculate_run_errors(locations, workers=1)
+    # spawned workers do not inherit the metrics registered in this process
+    start_method = multiprocessing.get_start_method()
+    multiprocessing.set_start_method('spawn', force=True)
+    try:
+        parallel_runs = traj.calculate_run_errors(locations, workers=2)
+    finally:
+        multiprocessing.set_start_method(start_method, force=True)
+    assert serial_runs == parallel_runs
+
+
+def test_statistical_error_incremental(monkeypatch):
+    dat = DataHandler('test')
+    test_name = 'traj_err_incremental_test'
+    runs = 2
+    for session in range(2):
+        for run in range(runs):
+            dat.save(data=random_trajectories.generate(steps=50),
+                     save_location='%s/session%03d/run%03d'
+                     % (test_name, session, run), overwrite=True)
+
+    traj = TrajectoryError(
+        db_name='test', time_derivative=0, interpolated_samples=40)
+
+    calculated = []
+    calculate_error = traj.calculate_error
+
+    def counted_calculate_error(save_location, ideal=None):
+        calculated.append(save_location)
+        return calculate_error(save_location=save_location, ideal=ideal)
+    monkeypatch.setattr(traj, 'calculate_error', counted_calculate_error)
+
+    traj.statistical_error(
+        save_location=test_name, sessions=2, runs=runs, regen=True)
+    assert len(calculated) == 4
+
+    # add a session and change one of the saved runs
+    for run in range(runs):
+        dat.save(data=random_trajectories.generate(steps=50),
+                 save_location='%s/session002/run%03d' % (test_name, run),
+                 overwrite=True)
+    dat.delete('%s/session000/run001' % test_name)
+    dat.save(data=random_trajectories.generate(steps=60),
+             save_location='%s/session000/run001' % test_name,
+             overwrite=True)
+
+    calculated.clear()
+    incremental = traj.statistical_error(
+        save_location=test_name, sessions=3, runs=runs, regen='incremental')
+    assert sorted(calculated) == [
+        '%s/session000/run001' % test_name,
+        '%s/session002/run000' % test_name,
+        '%s/session002/run001' % test_name]
+
+    # the statistics match regenerating the error for every run
+    calculated.clear()
+    full = traj.statistical_error(
+        save_location=test_name, sessions=3, runs=runs, regen=True)
+    assert len(calculated) == 6
+    assert np.allclose(incremental['mean'], full['mean'])
+
+
+@pytest.mark.parametrize('interpolated_samples', ((None), (40)))
+@pytest.mark.parametrize('time_derivative', ((1), (2)))
+def test_calculate_error_derivative(interpolated_samples, time_derivative):
+    parameters = ['ee_xyz', 'ideal_trajectory', 'time']
+    data = proc.load_and_process(
+        db_name='test', save_location=save_location, parameters=parameters,
+        interpolated_samples=interpolated_samples)
+    if interpolated_samples is None:
+        spacing = np.cumsum(data['time'])
+    else:
+        spacing = np.sum(data['time']) / len(data['time'])
+    for key in ['ee_xyz', 'ideal_trajectory']:
+        for _ in range(time_derivative):
+            data[key] = np.gradient(data[key], spacing, axis=0)
+    manual_error = np.linalg.norm(
+        data['ee_xyz'] - data['ideal_trajectory'], axis=1)
+
+    traj = TrajectoryError(
+        db_name='test', time_derivative=time_derivative,
+        interpolated_samples=interpolated_samples)
+    error = traj.calculate_error(save_location=save_location)['error']
+    assert np.allclose(manual_error, error)
+
+    # smoothed derivatives return an error for every sample
+    traj = TrajectoryError(
+        db_name='test', time_derivative=time_derivative,
+        interpolated_samples=interpolated_samples, differentiation='savgol',
+        window_length=5, polyorder=time_derivative+1)
+    smoothed_error = traj.calculate_error(
+        save_location=save_location)['error']
+    assert smoothed_error.shape == manual_error.shape
+
+
+def test_metrics():
+    metrics = ['rmse', 'max_deviation', 'final_error', 'path_length_ratio',
+               'settling_time']
+    traj = TrajectoryError(
+        db_name='test', time_derivative=0, interpolated_samples=None,
+        metrics=metrics)
+    data = traj.calculate_error(save_location=save_location)
+
+    error = data['error']
+    assert np.isclose(data['rmse'], np.sqrt(np.mean(error**2)))
+    assert np.isclose(data['max_deviation'], np.max(error))
+    assert np.isclose(data['final_error'], error[-1])
+    ee_length = np.sum(np.linalg.norm(np.diff(data['ee_xyz'], axis=0), axis=1))
+    ideal_length = np.sum(np.linalg.norm(
+        np.diff(data['ideal_trajectory'], axis=0), axis=1))
+    assert np.isclose(data['path_length_ratio'], ee_length / ideal_length)
+
+    # statistics are calculated for every metric
+    test_name = 'traj_err_metrics_test'
+    for run in range(3):
+        dat.save(data=random_trajectories.generate(steps=50),
+                 save_location='%s/session000/run%03d' % (test_name, run),
+                 overwrite=True)
+    ci_errors = traj.statistical_error(
+        save_location=test_name, sessions=1, runs=3, save_data=False,
+        regen=True)
+    for metric in metrics:
+        assert len(ci_errors['metrics'][metric]['mean']) == 3
+
+    with pytest.raises(ValueError):
+        TrajectoryError(db_name='test', metrics=['not_a_metric'])
+
+
+def test_settling_time():
+    time = np.linspace(0, 1, 11)
+    ideal = np.zeros((11, 3))
+    ee_xyz = np.zeros((11, 3))
+    ee_xyz[:, 0] = [1, 0.5, 0.2, 0.1, 0.04, 0.08, 0.03, 0.02, 0.01, 0, 0]
+    data = {'ee_xyz': ee_xyz, 'ideal_trajectory': ideal,
+            'cumulative_time': time}
+    assert np.isclose(trajectory_error.settling_time(
+        data, 'ideal_trajectory', tolerance=0.05), time[6])
+    # never settles
+    data['ee_xyz'][-1, 0] = 1
+    assert np.isnan(trajectory_error.settling_time(
+        data, 'ideal_trajectory', tolerance=0.05))
+
+
+def test_calculate_error_dtw():
+    # the end-effector follows the ideal path but is delayed
+    test_location = 'traj_err_dtw_test/session000/run000'
+    t = np.linspace(0, 1, 200)
+    ideal = np.stack([np.sin(np.pi*t), np.cos(np.pi*t), t], axis=1)
+    ee_xyz = np.vstack([np.repeat(ideal[:1], 10, axis=0), ideal[:-10]])
+    dat.save(data={'ee_xyz': ee_xyz, 'ideal_trajectory': ideal,
+                   'time': np.ones(200) * 0.005},
+             save_location=test_location, overwrite=True)
+
+    norm_error = TrajectoryError(
+        db_name='test', interpolated_samples=None).calculate_error(
+            save_location=test_location)
+    dtw_error = TrajectoryError(
+        db_name='test', interpolated_samples=None, error_mode='dtw',
+        dtw_band=20).calculate_error(save_location=test_location)
+
+    assert np.sum(dtw_error['error']) < 0.1 * np.sum(norm_error['error'])
+    path = dtw_error['warping_path']
+    assert len(dtw_error['error']) == len(path)
+
+
+@pytest.mark.parametrize('time_derivative', (0, 1, 2))
+@pytest.mark.parametrize('differentiation', ('gradient', 'savgol'))
+def test_stream_error(time_derivative, differentiation):
+    traj = TrajectoryError(
+        db_name='test', time_derivative=time_derivative,
+        interpolated_samples=None, differentiation=differentiation,
+        metrics=trajectory_error.STREAMING_METRICS)
+    data = traj.calculate_error(save_location=save_location)
+
+    # the chunks join into the error of the whole run
+    error = np.hstack([
+        chunk['error'] for chunk in traj.stream_error(
+            save_location=save_location, chunk_size=13)])
+    assert np.allclose(error, data['error'])
+
+    summary = traj.calculate_error_streaming(
+        save_location=save_location, chunk_size=13)
+    assert np.isclose(summary['summed_error'], np.sum(data['error']))
+    assert summary['n_samples'] == len(data['error'])
+    for metric in trajectory_error.STREAMING_METRICS:
+        assert np.isclose(summary[metric], data[metric])
+
+
+@pytest.mark.parametrize('time_derivative', (0, 1))
+@pytest.mark.parametrize('differentiation', ('gradient', 'savgol'))
+def test_stream_error_empty(time_derivative, differentiation):
+    empty_location = 'traj_err_empty_test/%s_%i/session000/run000' % (
+        differentiation, time_derivative)
+    dat.save(data={'ee_xyz': np.zeros((0, 3)), 'time': np.zeros(0),
+                   'ideal_trajectory': np.zeros((0, 6))},
+             save_location=empty_location, overwrite=True)
+    traj = TrajectoryError(
+        db_name='test', time_derivative=time_derivative,
+        interpolated_samples=None, differentiation=differentiation)
+
+    with pytest.raises(ValueError):
+        traj.calculate_error_streaming(save_location=empty_location)
+
+
+def test_statistical_error_chunk_size():
+    kwargs = {'db_name': 'test', 'time_derivative': 1,
+              'interpolated_samples': None, 'metrics': ['rmse']}
+    loaded = TrajectoryError(**kwargs).statistical_error(
+        save_location='traj_err_test', save_data=False, regen=True)
+    streamed = TrajectoryError(chunk_size=10, **kwargs).statistical_error(
+        save_location='traj_err_test', save_data=False, regen=True)
+
+    assert np.allclose(loaded['mean'], streamed['mean'])
+    assert np.allclose(loaded['metrics']['rmse']['mean'],
+                       streamed['metrics']['rmse']['mean'])
+
+    with pytest.raises(ValueError):
+        TrajectoryError(db_name='test', chunk_size=10)
+    with pytest.raises(ValueError):
+        TrajectoryError(db_name='test', interpolated_samples=None,
+                        chunk_size=10, metrics=['settling_time'])
+
+
+def test_compare_errors(monkeypatch):
+    dat = DataHandler('test')
+    test_names = ['traj_err_compare_%i' % ii for ii in range(3)]
+    for test_name in test_names:
+        for run in range(2):
+            dat.save(data=random_trajectories.generate(steps=50),
+                     save_location='%s/session000/run%03d'
+                     % (test_name, run), overwrite=True)
+
+    kwargs = {'db_name': 'test', 'test_names': test_names,
+              'time_derivatives': [0, 1], 'runs': 2,
+              'interpolated_samples': 40, 'baseline_low': test_names[0],
+              'baseline_high': test_names[2]}
+    comparison = trajectory_error.compare_errors(**kwargs)
+
+    assert comparison['mean'].shape == (3, 2, 2)
+    assert len(comparison['table']) == 3 * 2 * 2
+    direct = TrajectoryError(
+        db_name='test', time_derivative=1,
+        interpolated_samples=40).statistical_error(
+            save_location=test_names[1], runs=2)
+    assert np.allclose(comparison['mean'][1, 1], direct['mean'])
+    assert np.allclose(comparison['scaled_mean'][0], 0)
+    assert np.allclose(comparison['scaled_mean'][2], 1)
+
+    # the saved errors are loaded instead of recalculated
+    def calculate_error(*args, **kwargs):
+        raise Exception('the error should not be recalculated')
+    monkeypatch.setattr(TrajectoryError, 'calculate_error', calculate_error)
+    cached = trajectory_error.compare_errors(**kwargs)
+    assert np.allclose(cached['mean'], comparison['mean'])
+
+    with pytest.raises(ValueError):
+        trajectory_error.compare_errors(
+            db_name='test', test_names=test_names, baseline_low='not_a_test',
+            baseline_high=test_names[0])
+
+
+def test_compare_errors_workers(monkeypatch):
+    # the serial and parallel results are saved to separate databases
+    db_names = ['traj_err_compare_serial_test',
+                'traj_err_compare_parallel_test']
+    test_names = ['traj_err_compare_workers_%i' % ii for ii in range(2)]
+    for test_name in test_names:
+        for run in range(2):
+            data = random_trajectories.generate(steps=50)
+            for db_name in db_names:
+                DataHandler(db_name).save(
+                    data=dict(data),
+                    save_location='%s/session000/run%03d' % (test_name, run),
+                    overwrite=True)
+
+    kwargs = {'test_names': test_names, 'time_derivatives': [0, 1],
+              'runs': 2, 'interpolated_samples': 40, 'metrics': ['rmse']}
+    serial = trajectory_error.compare_errors(
+        db_name=db_names[0], workers=1, **kwargs)
+    parallel = trajectory_error.compare_errors(
+        db_name=db_names[1], workers=2, **kwargs)
+    # the confidence intervals are bootstrapped, so only the means match
+    assert np.array_equal(serial['mean'], parallel['mean'])
+    assert [row['mean'] for row in serial['table']] == [
+        row['mean'] for row in parallel['table']]
+
+    # the results of the workers are saved
+    def calculate_error(*args, **kwargs):
+        raise Exception('the error should not be recalculated')
+    monkeypatch.setattr(TrajectoryError, 'calculate_error', calculate_error)
+    cached = trajectory_error.compare_errors(
+        db_name=db_names[1], workers=2, **kwargs)
+    assert np.array_equal(cached['mean'], parallel['mean'])
+    assert np.array_equal(cached['upper_bound'], parallel['upper_bound'])
@@ -17,8 +17,152 @@ from abr_analyze.data_handler import DataHandler
 import abr_analyze.data_processor as proc
 import abr_analyze.data_visualizer as vis
 
+
+def _error_worker(db_name, kwargs, metric_functions):
+    """
+    Returns a TrajectoryError with a read only DataHandler, the state that
+    each calculate_run_errors worker process reuses for every run
+
+    Worker processes that are spawned instead of forked start from a fresh
+    METRICS, so the functions of the metrics are registered again first
+    """
+    for name, function in metric_functions.items():
+        register_metric(name, function)
+    return TrajectoryError(db_name=db_name, read_only=True, **kwargs)
+
+
+def _run_errors_worker(trajectory_error, save_location, ideal):
+    """
+    Returns the summed error and metrics of the run at save_location
+    """
+    return trajectory_error.calculate_run_error(
+        save_location=save_location, ideal=ideal)
+
+
+def _comparison_worker(db_name, kwargs, metric_functions, read_only):
+    """
+    Returns the state that each compare_errors worker process reuses, the
+    arguments of its TrajectoryErrors and a dict to hold one for each time
+    derivative
+    """
+    for name, function in metric_functions.items():
+        register_metric(name, function)
+    return db_name, dict(kwargs, read_only=read_only), {}
+
+
+def _statistical_error_worker(state, test_name, time_derivative, ideal,
+                              sessions, runs, regen, workers):
+    """
+    Returns the statistical error of test_name and the results to save, see
+    TrajectoryError.calculate_statistical_error
+    """
+    db_name, kwargs, trajectory_errors = state
+    if time_derivative not in trajectory_errors:
+        trajectory_errors[time_derivative] = TrajectoryError(
+            db_name=db_name, time_derivative=time_derivative, **kwargs)
+    print('Comparing %s, time derivative %i' % (test_name, time_derivative))
+    return trajectory_errors[time_derivative].calculate_statistical_error(
+        save_location=test_name, ideal=ideal, sessions=sessions, runs=runs,
+        regen=regen, workers=workers)
+
+
+def _to_str(value):
+    """
+    Returns a string loaded from the database as a python string
+    """
+    value = np.asarray(value).item()
+    if isinstance(value, bytes):
+        value = value.decode()
+    return str(value)
+
+
+def rmse(data, ideal):
+    """
+    Returns the root mean squared two norm error over the run
+    """
+    return np.sqrt(np.mean(data['error']**2))
+
+
+def max_deviation(data, ideal):
+    """
+    Returns the largest two norm error over the run
+    """
+    return np.max(data['error'])
+
+
+def final_error(data, ideal):
+    """
+    Returns the two norm error at the end of the run
+    """
+    return data['error'][-1]
+
+
+def path_length_ratio(data, ideal):
+    """
+    Returns the length of the end-effector path over the length of the ideal
+    path
+    """
+    ee_length = np.sum(np.linalg.norm(np.diff(data['ee_xyz'], axis=0), axis=1))
+    ideal_length = np.sum(np.linalg.norm(np.diff(data[ideal], axis=0), axis=1))
+    return ee_length / ideal_length
+
+
+def settling_time(data, ideal, tolerance=0.05):
+    """
+    Returns the time after which the end-effector stays within tolerance
+    times its starting distance from the final position of the ideal path.
+    Returns NaN if the end-effector has not settled by the end of the run
+    """
+    distance = np.linalg.norm(data['ee_xyz'] - data[ideal][-1], axis=1)
+    outside = np.nonzero(distance > tolerance * distance[0])[0]
+    if len(outside) == 0:
+        return data['cumulative_time'][0]
+    if outside[-1] == len(distance) - 1:
+        return np.nan
+    return data['cumulative_time'][outside[-1] + 1]
+
+
+# the metrics that can be calculated by TrajectoryError, each function
+# accepts the data dict from calculate_error (after interpolation and
+# differentiation, with the two norm error to the ideal trajectory saved
+# under 'error') and the key of the ideal trajectory, and returns a float
+METRICS = {
+    'rmse': rmse,
+    'max_deviation': max_deviation,
+    'final_error': final_error,
+    'path_length_ratio': path_length_ratio,
+    'settling_time': settling_time,
+}
+
+# the metrics that calculate_error_streaming accumulates chunk by chunk
+STREAMING_METRICS = ['rmse', 'max_deviation', 'final_error',
+                     'path_length_ratio']
+
+
+def register_metric(name, function):
+    """
+    Adds a metric that can be calculated by TrajectoryError
+
+    Parameters
+    ----------
+    name: string
+        the key the metric is saved under
+    function: function
+        accepts the data dict from calculate_error and the key of the ideal
+        trajectory, and returns a float, see METRICS. To be used with
+        workers > 1 in statistical_error it must be picklable, ex: defined
+        at the module level or a functools.partial of one
+    """
+    if name in ['error', 'summed_error']:
+        raise ValueError('%s is reserved for the two norm error' % name)
+    METRICS[name] = function
+
+
 class TrajectoryError():
-    def __init__(self, db_name, time_derivative=0, interpolated_samples=100):
+    def __init__(self, db_name, time_derivative=0, interpolated_samples=100,
+                 read_only=False, differentiation='gradient',
+                 window_length=11, polyorder=3, metrics=None,
+                 error_mode='norm', dtw_band=0.1, chunk_size=None):
         '''
         PARAMETERS
         ----------
@@ -33,20 +177,102 @@ class TrajectoryError():
             1: velocity
             2: acceleration
             3: jerk
+        read_only: boolean, Optional (Default: False)
+            True to open the database in read only mode, results can not be
+            saved in this mode
+        differentiation: string, Optional (Default: 'gradient')
+            the method used to differentiate the data, see
+            data_processor.time_derivative
+            'gradient': central differences, applied time_derivative times
+            'savgol': Savitzky-Golay derivative of order time_derivative
+                in one pass, which smooths out noise
+        window_length: odd int, Optional (Default: 11)
+            the number of samples in the savgol window
+        polyorder: int, Optional (Default: 3)
+            the order of the savgol polynomial, must be at least
+            time_derivative
+        metrics: list of strings, Optional (Default: None)
+            metrics from METRICS to calculate in the same pass as the two
+            norm error, ex: ['rmse', 'max_deviation', 'settling_time']
+            These are calculated on the differentiated data
+        error_mode: string, Optional (Default: 'norm')
+            'norm': the error is the two norm between the end-effector and
+                the ideal trajectory at each timestep
+            'dtw': the end-effector and ideal trajectory are aligned with
+                dynamic time warping first (see data_processor.dtw), so that
+                delays in following the path are not counted as error. The
+                error is the two norm between aligned samples
+        dtw_band: float or int, Optional (Default: 0.1)
+            the width of the Sakoe-Chiba band used in dtw mode, as a
+            proportion of the number of samples if less than 1, otherwise
+            in samples
+        chunk_size: positive int, Optional (Default: None)
+            if set, the error of each run in statistical_error is calculated
+            chunk_size samples at a time with calculate_error_streaming, so
+            memory use does not grow with the length of the runs. Requires
+            interpolated_samples=None, the norm error_mode, and metrics
+            from STREAMING_METRICS
         '''
+        if error_mode not in ['norm', 'dtw']:
+            raise ValueError('error_mode must be norm or dtw, received %s'
+                             % error_mode)
+        if metrics is None:
+            metrics = []
+        for metric in metrics:
+            if metric not in METRICS:
+                raise ValueError('%s is not a registered metric, ' % metric
+                                 + 'choose from %s' % list(METRICS.keys()))
+        if chunk_size is not None:
+            if interpolated_samples is not None:
+                raise ValueError('chunk_size can only be used with '
+                                 + 'interpolated_samples=None')
+            if error_mode != 'norm':
+                raise ValueError('chunk_size can only be used with the norm '
+                                 + 'error_mode')
+            for metric in metrics:
+                if metric not in STREAMING_METRICS:
+                    raise ValueError('%s can not be calculated in chunks, '
+                                     % metric + 'choose from %s'
+                                     % STREAMING_METRICS)
         # instantiate our data processor
-        self.dat = DataHandler(db_name)
+        self.dat = DataHandler(db_name, read_only=read_only)
         self.db_name = db_name
         self.time_derivative = time_derivative
         self.interpolated_samples = interpolated_samples
+        self.differentiation = differentiation
+        self.window_length = window_length
+        self.polyorder = polyorder
+        self.metrics = list(metrics)
+        self.error_mode = error_mode
+        self.dtw_band = dtw_band
+        self.chunk_size = chunk_size
+
+    def get_settings(self):
+        '''
+        returns a dict of the parameters used to process the data, used to
+        instantiate the same TrajectoryError in other processes
+        '''
+        return {'time_derivative': self.time_derivative,
+                'interpolated_samples': self.interpolated_samples,
+                'differentiation': self.differentiation,
+                'window_length': self.window_length,
+                'polyorder': self.polyorder,
+                'metrics': self.metrics,
+                'error_mode': self.error_mode,
+                'dtw_band': self.dtw_band,
+                'chunk_size': self.chunk_size}
 
     def statistical_error(self, save_location, ideal=None, sessions=1, runs=1,
-                          save_data=True, regen=False):
+                          save_data=True, regen=False, workers=1):
         '''
         calls the calculate error function to get the trajectory for all runs
         and sessions specified at the save location and calculates the mean
         error and confidence intervals
 
+        The mean and confidence intervals of each metric are returned in a
+        dict under the key 'metrics', and saved under
+        save_location/statistical_error_<time_derivative>/<metric>
+
         PARAMETERS
         ----------
         save_location: string
@@ -62,10 +288,47 @@ class TrajectoryError():
             the number of runs in each session
         save_data: boolean, Optional (Default: True)
             True to save data, this saves the error for each session
-        regen: boolean, Optional (Default: False)
-            True to regenerate data
+        regen: boolean or string, Optional (Default: False)
+            True to regenerate data for all runs
             False to load data if it exists
+            'incremental' to only calculate the error of runs that have been
+                added or changed since the error was last saved, and update
+                the mean and confidence intervals
+            The error of each run is saved under
+            save_location/statistical_error_<time_derivative>/session/run
+            with an id of the data it was calculated from (see
+            get_source_id), which is used to check if a run has changed
+        workers: positive int, Optional (Default: 1)
+            the number of processes to spread the runs across, each opens
+            the database in read only mode. The results are saved once all
+            runs have been processed
         '''
+        ci_errors, results = self.calculate_statistical_error(
+            save_location=save_location, ideal=ideal, sessions=sessions,
+            runs=runs, regen=regen, workers=workers)
+        if save_data:
+            for location, data in results:
+                self.dat.save(data=data, save_location=location,
+                              overwrite=True)
+
+        return ci_errors
+
+    def calculate_statistical_error(self, save_location, ideal=None,
+                                    sessions=1, runs=1, regen=False,
+                                    workers=1):
+        '''
+        the calculations of statistical_error without saving, so that they
+        can be done with a read only database. Returns the dict returned by
+        statistical_error and a list of the (location, data) that it saves,
+        which is empty if the saved errors were loaded
+
+        PARAMETERS
+        ----------
+        see statistical_error
+        '''
+        results = []
+        aggregate_location = '%s/statistical_error_%i' % (
+            save_location, self.time_derivative)
         if regen is False:
             exists = self.dat.check_group_exists(
                 '%s/statistical_error_%s'%(save_location, self.time_derivative))
@@ -79,34 +342,187 @@ class TrajectoryError():
 
                 # still using as boolean, just a python cheatcode
                 exists = len(ci_errors['mean'])
+
+            # load the saved statistics of each metric, recalculate if any
+            # are missing
+            if exists:
+                ci_errors['metrics'] = {}
+                for metric in self.metrics:
+                    metric_location = '%s/%s' % (aggregate_location, metric)
+                    if not self.dat.check_group_exists(metric_location):
+                        exists = False
+                        break
+                    ci_errors['metrics'][metric] = self.dat.load(
+                        parameters=['mean', 'upper_bound', 'lower_bound'],
+                        save_location=metric_location)
         else:
             exists = False
 
         if not exists:
-            errors = []
-            for session in range(sessions):
-                session_error = []
-                for run in range(runs):
-                    print('%.3f processing complete...' %
-                          (100*((run+1)+(session*runs)) / (sessions*runs)),
-                          end='\r')
-                    loc = ('%s/session%03d/run%03d'
-                           % (save_location, session, run))
-                    data = self.calculate_error(save_location=loc, ideal=ideal)
-                    session_error.append(np.sum(data['error']))
-                errors.append(session_error)
+            locations = [
+                '%s/session%03d/run%03d' % (save_location, session, run)
+                for session in range(sessions) for run in range(runs)]
+            # the errors of each run are saved with the id of the data they
+            # were calculated from
+            run_locations = [
+                '%s/session%03d/run%03d' % (aggregate_location, session, run)
+                for session in range(sessions) for run in range(runs)]
+            source_ids = [self.get_source_id(loc, ideal) for loc in locations]
+            keys = ['summed_error'] + self.metrics
+
+            # reuse the saved errors of runs that have not changed
+            run_errors = [None] * len(locations)
+            if regen is False or regen == 'incremental':
+                for ii, run_location in enumerate(run_locations):
+                    if self.dat.check_group_exists(run_location):
+                        saved = self.dat.load(
+                            parameters=keys + ['source_id'],
+                            save_location=run_location)
+                        # keys that are not saved are loaded as None
+                        missing = any(np.asarray(saved[key]).dtype == object
+                                      for key in keys)
+                        if (not missing and _to_str(saved['source_id'])
+                                == source_ids[ii]):
+                            run_errors[ii] = {
+                                key: float(saved[key]) for key in keys}
+
+            to_process = [
+                ii for ii, val in enumerate(run_errors) if val is None]
+            print('Calculating error for %i/%i runs' %
+                  (len(to_process), len(locations)))
+            processed = self.calculate_run_errors(
+                locations=[locations[ii] for ii in to_process],
+                ideal=ideal, workers=workers)
+            for ii, errors in zip(to_process, processed):
+                run_errors[ii] = errors
+
+            errors = np.reshape(
+                [errors['summed_error'] for errors in run_errors],
+                (sessions, runs)).tolist()
 
             ci_errors = proc.get_mean_and_ci(raw_data=errors)
             ci_errors['time_derivative'] = self.time_derivative
 
-            if save_data:
-                self.dat.save(
-                    data=ci_errors,
-                    save_location='%s/statistical_error_%i' % (
-                        save_location, self.time_derivative),
-                    overwrite=True)
+            metric_errors = {}
+            for metric in self.metrics:
+                metric_errors[metric] = proc.get_mean_and_ci(
+                    raw_data=np.reshape(
+                        [errors[metric] for errors in run_errors],
+                        (sessions, runs)))
 
-        return ci_errors
+            results.append((aggregate_location, dict(ci_errors)))
+            for metric in self.metrics:
+                results.append(('%s/%s' % (aggregate_location, metric),
+                                metric_errors[metric]))
+            for ii, errors in zip(to_process, processed):
+                results.append((run_locations[ii],
+                                dict(errors, source_id=source_ids[ii])))
+
+            ci_errors['metrics'] = metric_errors
+
+        return ci_errors, results
+
+    def get_run_errors(self, data):
+        '''
+        accepts the dict returned by calculate_error and returns a dict of the
+        summed error and the value of each metric
+
+        PARAMETERS
+        ----------
+        data: dict
+            the output of calculate_error
+        '''
+        errors = {'summed_error': float(np.sum(data['error']))}
+        for metric in self.metrics:
+            errors[metric] = float(data[metric])
+        return errors
+
+    def calculate_run_error(self, save_location, ideal=None):
+        '''
+        returns a dict of the summed error and the value of each metric of
+        the run at save_location, see get_run_errors. If chunk_size is set
+        the run is processed in chunks with calculate_error_streaming
+
+        PARAMETERS
+        ----------
+        save_location: string
+            location of the run in the database
+        ideal: string, Optional (Default: None)
+            the key of the trajectory to calculate the error relative to,
+            see calculate_error
+        '''
+        if self.chunk_size is not None:
+            summary = self.calculate_error_streaming(
+                save_location=save_location, ideal=ideal)
+            return {key: float(summary[key])
+                    for key in ['summed_error'] + self.metrics}
+        return self.get_run_errors(
+            self.calculate_error(save_location=save_location, ideal=ideal))
+
+    def calculate_run_errors(self, locations, ideal=None, workers=1):
+        '''
+        calls the calculate error function for each location and returns a
+        list of dicts of the summed error and metrics of each (see
+        get_run_errors), in the order of locations
+
+        PARAMETERS
+        ----------
+        locations: list of strings
+            locations of runs in the database
+        ideal: string, Optional (Default: None)
+            the key of the trajectory to calculate the error relative to,
+            see calculate_error
+        workers: positive int, Optional (Default: 1)
+            the number of processes to spread the locations across, each
+            opens the database in read only mode
+        '''
+        run_errors = []
+        if workers > 1 and len(locations) > 1:
+            for errors in proc.map_in_workers(
+                    _run_errors_worker,
+                    [(loc, ideal) for loc in locations],
+                    initializer=_error_worker,
+                    initargs=(self.db_name, self.get_settings(),
+                              {metric: METRICS[metric]
+                               for metric in self.metrics}),
+                    n_workers=workers):
+                run_errors.append(errors)
+                print('%.3f processing complete...' %
+                      (100*len(run_errors) / len(locations)),
+                      end='\r')
+        else:
+            for loc in locations:
+                run_errors.append(
+                    self.calculate_run_error(save_location=loc, ideal=ideal))
+                print('%.3f processing complete...' %
+                      (100*len(run_errors) / len(locations)),
+                      end='\r')
+
+        return run_errors
+
+    def get_source_id(self, save_location, ideal=None):
+        '''
+        returns a string identifying the version of the data at save_location
+        and the settings used to calculate its error. If either changes the
+        saved error of the run is out of date
+
+        PARAMETERS
+        ----------
+        save_location: string
+            location of the run in the database
+        ideal: string, Optional (Default: None)
+            the key of the trajectory to calculate the error relative to,
+            see calculate_error
+        '''
+        if ideal is None:
+            ideal = 'ideal_trajectory'
+        modification_id = self.dat.get_modification_id(
+            save_location=save_location,
+            parameters=['ee_xyz', 'time', ideal])
+        return '%s-%s-%s-%s-%s-%s-%s-%s' % (
+            modification_id, ideal, self.interpolated_samples,
+            self.differentiation, self.window_length, self.polyorder,
+            self.error_mode, self.dtw_band)
 
     def calculate_error(self, save_location, ideal=None):
         '''
@@ -126,6 +542,10 @@ class TrajectoryError():
             'read_location': string, the location the raw data was loaded from,
             'error': the two-norm error between the end-effector trajectory and
                 the path planner followed that run
+            'warping_path': in dtw error_mode, the (n_aligned, 2) indices of
+                the aligned ee_xyz and ideal samples the error is calculated
+                between
+            plus the value of each metric in metrics under its name
 
         PARAMETERS
         ----------
@@ -146,13 +566,20 @@ class TrajectoryError():
             db_name=self.db_name,
             save_location=save_location,
             parameters=parameters,
-            interpolated_samples=self.interpolated_samples)
+            interpolated_samples=self.interpolated_samples,
+            data_handler=self.dat)
 
         if ideal == 'ideal_trajectory':
             data['ideal_trajectory'] = data['ideal_trajectory'][:, :3]
-        dt = np.sum(data['time']) / len(data['time'])
+        if self.interpolated_samples is None:
+            # the raw data is differentiated at the times it was recorded
+            time = np.cumsum(data['time'])
+            dt = None
+        else:
+            time = None
+            dt = np.sum(data['time']) / len(data['time'])
 
-        # integrate data
+        # differentiate data
         if self.time_derivative > 0:
             # set our keys that are able to be differentiated to avoid errors
             differentiable_keys = ['ee_xyz', 'ideal_trajectory']
@@ -161,26 +588,324 @@ class TrajectoryError():
 
             for key in data:
                 if key in differentiable_keys:
-                    # differentiate the number of times specified by
+                    # differentiate all dimensions to the order specified by
                     # time_derivative
-                    for _ in range(0, self.time_derivative):
-                        data[key][:, 0] = np.gradient(data[key][:, 0], dt)
-                        data[key][:, 1] = np.gradient(data[key][:, 1], dt)
-                        data[key][:, 2] = np.gradient(data[key][:, 2], dt)
+                    data[key] = proc.time_derivative(
+                        data=data[key], order=self.time_derivative,
+                        dt=dt, time_vector=time,
+                        method=self.differentiation,
+                        window_length=self.window_length,
+                        polyorder=self.polyorder)
 
         data['time_derivative'] = self.time_derivative
         data['read_location'] = save_location
-        data['error'] = np.linalg.norm((data['ee_xyz'] - data[ideal]), axis=1)
+        if self.error_mode == 'dtw':
+            band = self.dtw_band
+            if band < 1:
+                band = int(np.ceil(band * len(data['ee_xyz'])))
+            _, path = proc.dtw(
+                data['ee_xyz'], data[ideal], band=band, return_path=True)
+            data['warping_path'] = path
+            data['error'] = np.linalg.norm(
+                (data['ee_xyz'][path[:, 0]] - data[ideal][path[:, 1]]),
+                axis=1)
+        else:
+            data['error'] = np.linalg.norm(
+                (data['ee_xyz'] - data[ideal]), axis=1)
+
+        # calculate the metrics from the same processed data
+        for metric in self.metrics:
+            data[metric] = METRICS[metric](data, ideal)
 
         return data
 
+    def stream_error(self, save_location, ideal=None, chunk_size=None):
+        '''
+        generator that calculates the error of the raw data at save_location
+        chunk_size samples at a time, for runs that are too long to load at
+        once. Each chunk is loaded with enough samples on either side for
+        the derivative to match calculate_error with
+        interpolated_samples=None
+
+        yields a dict for each chunk of
+            'cumulative_time': the time of each sample since the run started,
+            'ee_xyz': the differentiated end-effector positions,
+            ideal: the differentiated ideal trajectory,
+            'error': the two-norm error between the two
+        a ValueError is raised if the run has no samples
+
+        PARAMETERS
+        ----------
+        save_location: string
+            location of data in database
+        ideal: string, Optional (Default: None)
+            the key of the trajectory to calculate the error relative to,
+            see calculate_error
+        chunk_size: positive int, Optional (Default: None)
+            the number of samples in each chunk, uses self.chunk_size if
+            None, or 10000 if that is not set either
+        '''
+        if self.interpolated_samples is not None:
+            raise ValueError('Only raw data can be streamed, set '
+                             + 'interpolated_samples=None')
+        if self.error_mode != 'norm':
+            raise ValueError('Only the norm error_mode can be streamed')
+        if chunk_size is None:
+            chunk_size = self.chunk_size or 10000
+        if ideal is None:
+            ideal = 'ideal_trajectory'
+
+        # samples needed on either side of a chunk to differentiate its edges
+        # the same as the whole run
+        overlap = 0
+        dt = None
+        if self.time_derivative > 0:
+            if self.differentiation == 'savgol':
+                overlap = self.window_length
+                # savgol uses the average timestep of the whole run
+                n_samples = 0
+                total_time = 0.0
+                first_time = 0.0
+                for start, stop, chunk in self.dat.load_chunks(
+                        parameters=['time'], save_location=save_location,
+                        chunk_size=chunk_size):
+                    if start == 0:
+                        first_time = chunk['time'][0]
+                    n_samples += stop - start
+                    total_time += np.sum(chunk['time'])
+                if n_samples == 0:
+                    raise ValueError('There are no samples in %s to '
+                                     % save_location + 'calculate the error of')
+                dt = (total_time - first_time) / max(n_samples - 1, 1)
+            else:
+                # each gradient changes one more sample at the edges
+                overlap = self.time_derivative
+
+        # the cumulative time before the first sample loaded for each chunk
+        time_offset = 0.0
+        n_streamed = 0
+        for start, stop, chunk in self.dat.load_chunks(
+                parameters=['ee_xyz', 'time', ideal],
+                save_location=save_location, chunk_size=chunk_size,
+                overlap=overlap):
+            low = max(start - overlap, 0)
+            cumulative_time = time_offset + np.cumsum(chunk['time'])
+            next_low = max(stop - overlap, 0)
+            if next_low > low:
+                time_offset = cumulative_time[next_low - low - 1]
+
+            if ideal == 'ideal_trajectory':
+                chunk[ideal] = chunk[ideal][:, :3]
+            for key in ['ee_xyz', ideal]:
+                chunk[key] = proc.time_derivative(
+                    data=chunk[key], order=self.time_derivative, dt=dt,
+                    time_vector=cumulative_time if dt is None else None,
+                    method=self.differentiation,
+                    window_length=self.window_length,
+                    polyorder=self.polyorder)
+
+            keep = slice(start - low, stop - low)
+            ee_xyz = chunk['ee_xyz'][keep]
+            ideal_xyz = chunk[ideal][keep]
+            yield {'cumulative_time': cumulative_time[keep],
+                   'ee_xyz': ee_xyz,
+                   ideal: ideal_xyz,
+                   'error': np.linalg.norm(ee_xyz - ideal_xyz, axis=1)}
+            n_streamed += stop - start
+        if n_streamed == 0:
+            raise ValueError('There are no samples in %s to calculate the '
+                             % save_location + 'error of')
+
+    def calculate_error_streaming(self, save_location, ideal=None,
+                                  chunk_size=None):
+        '''
+        calculates summary statistics of the error of the raw data at
+        save_location with stream_error, keeping only one chunk in memory at
+        a time
+
+        the following dict is returned
+        data = {
+            'summed_error': the sum of the two-norm error over the run,
+            'n_samples': the number of samples in the run,
+            'duration': the cumulative time at the end of the run,
+            'time_derivative': int, the order of differentiation applied,
+            'read_location': string, the location the raw data was loaded from,
+            plus the value of each metric in STREAMING_METRICS under its name
+
+        PARAMETERS
+        ----------
+        see stream_error
+        '''
+        if ideal is None:
+            ideal = 'ideal_trajectory'
+        summed_error = 0.0
+        squared_error = 0.0
+        max_error = -np.inf
+        n_samples = 0
+        ee_length = 0.0
+        ideal_length = 0.0
+        last = None
+        for chunk in self.stream_error(
+                save_location=save_location, ideal=ideal,
+                chunk_size=chunk_size):
+            summed_error += np.sum(chunk['error'])
+            squared_error += np.sum(chunk['error']**2)
+            max_error = max(max_error, np.max(chunk['error']))
+            n_samples += len(chunk['error'])
+            # include the step from the end of the previous chunk
+            ee_xyz = chunk['ee_xyz']
+            ideal_xyz = chunk[ideal]
+            if last is not None:
+                ee_xyz = np.vstack([last['ee_xyz'][-1:], ee_xyz])
+                ideal_xyz = np.vstack([last[ideal][-1:], ideal_xyz])
+            ee_length += np.sum(
+                np.linalg.norm(np.diff(ee_xyz, axis=0), axis=1))
+            ideal_length += np.sum(
+                np.linalg.norm(np.diff(ideal_xyz, axis=0), axis=1))
+            last = chunk
+
+        return {'summed_error': summed_error,
+                'n_samples': n_samples,
+                'duration': last['cumulative_time'][-1],
+                'time_derivative': self.time_derivative,
+                'read_location': save_location,
+                'rmse': np.sqrt(squared_error / n_samples),
+                'max_deviation': max_error,
+                'final_error': last['error'][-1],
+                'path_length_ratio': ee_length / ideal_length}
+
     def plot(self, ax, save_location, step=-1, c=None, linestyle='--',
-             label=None, loc=1, title='Trajectory Error to Path Planner'):
+             label=None, loc=1, title='Trajectory Error to Path Planner',
+             metric=None):
 
+        location = '%s/statistical_error_%i'%(
+            save_location, self.time_derivative)
+        # plot the statistics of a metric instead of the summed error
+        if metric is not None:
+            location += '/%s' % metric
         data = self.dat.load(
             parameters=['mean', 'upper_bound', 'lower_bound'],
-            save_location='%s/statistical_error_%i'%(
-                save_location, self.time_derivative))
+            save_location=location)
         vis.plot_mean_and_ci(
             ax=ax, data=data, c=c, linestyle=linestyle,
             label=label, loc=loc, title=title)
+
+
+def compare_errors(db_name, test_names, time_derivatives=(0,), sessions=1,
+                   runs=1, ideal=None, regen=False, workers=1,
+                   baseline_low=None, baseline_high=None, scaling_factor=1,
+                   **kwargs):
+    """
+    Calculates, or loads if saved, the statistical error of each test for
+    each order of time derivative and returns them as arrays that can be
+    compared directly, instead of calling statistical_error for each test
+
+    the following dict is returned
+    comparison = {
+        'test_names': the list of test_names,
+        'time_derivatives': the list of time_derivatives,
+        'mean': the mean summed error (n_tests, n_time_derivatives, runs),
+        'upper_bound': the upper confidence bound, shaped like mean,
+        'lower_bound': the lower confidence bound, shaped like mean,
+        'table': a list of dicts, one for each test, time derivative and run,
+            of the above
+    if baselines are passed in, the mean and bounds scaled relative to them
+    with scale_data are also returned under 'scaled_mean',
+    'scaled_upper_bound' and 'scaled_lower_bound', and added to the table
+
+    Parameters
+    ----------
+    db_name: string
+        the name of the database to load data from
+    test_names: list of strings
+        the locations of the tests to compare, each with sessions of runs
+        saved as test_name/sessionXXX/runXXX
+    time_derivatives: list of ints, Optional (Default: (0,))
+        the orders of time derivative to calculate the error of
+    sessions: int, Optional (Default: 1)
+        the number of sessions in each test
+    runs: int, Optional (Default: 1)
+        the number of runs in each session
+    ideal: string, Optional (Default: None)
+        the key of the trajectory to calculate the error relative to, see
+        TrajectoryError.calculate_error
+    regen: boolean or string, Optional (Default: False)
+        passed to TrajectoryError.statistical_error, the default loads the
+        saved errors of tests that have already been processed
+    workers: positive int, Optional (Default: 1)
+        the number of processes the tests and time derivatives are spread
+        across, each opens the database in read only mode. The results are
+        saved once all of them have been processed. If only one test and
+        time derivative are compared its runs are spread across them
+    baseline_low: string, Optional (Default: None)
+        the test in test_names whose error is scaled to 0
+    baseline_high: string, Optional (Default: None)
+        the test in test_names whose error is scaled to 1
+    scaling_factor: float, Optional (Default: 1)
+        multiplies the scaled errors
+    **kwargs: passed to TrajectoryError, ex: interpolated_samples
+    """
+    test_names = list(test_names)
+    time_derivatives = list(time_derivatives)
+    if (baseline_low is None) != (baseline_high is None):
+        raise ValueError('Both baseline_low and baseline_high are needed to '
+                         + 'scale the errors')
+    for baseline in [baseline_low, baseline_high]:
+        if baseline is not None and baseline not in test_names:
+            raise ValueError('The baseline %s is not in test_names'
+                             % baseline)
+
+    keys = ['mean', 'upper_bound', 'lower_bound']
+    # stats of each time derivative, test and run
+    stats = np.zeros((len(keys), len(test_names), len(time_derivatives),
+                      runs))
+    pairs = [(ii, jj) for jj in range(len(time_derivatives))
+             for ii in range(len(test_names))]
+    n_workers = max(min(workers, len(pairs)), 1)
+    # the runs are only spread across processes if the pairs are not
+    run_workers = workers if n_workers == 1 else 1
+    metric_functions = {metric: METRICS[metric]
+                        for metric in kwargs.get('metrics') or []
+                        if metric in METRICS}
+    # the workers only read from the database, everything is saved once
+    # they have finished so the database is not written to while open
+    computed = list(proc.map_in_workers(
+        _statistical_error_worker,
+        [(test_names[ii], time_derivatives[jj], ideal, sessions, runs, regen,
+          run_workers) for ii, jj in pairs],
+        initializer=_comparison_worker,
+        initargs=(db_name, kwargs, metric_functions, n_workers > 1),
+        n_workers=n_workers))
+
+    dat = DataHandler(db_name)
+    for (ii, jj), (ci_errors, results) in zip(pairs, computed):
+        for location, data in results:
+            dat.save(data=data, save_location=location, overwrite=True)
+        for kk, key in enumerate(keys):
+            stats[kk, ii, jj] = ci_errors[key]
+
+    comparison = {'test_names': test_names,
+                  'time_derivatives': time_derivatives}
+    for kk, key in enumerate(keys):
+        comparison[key] = stats[kk]
+
+    if baseline_low is not None:
+        # scale the mean and bounds of every test and time derivative at once
+        scaled = proc.scale_data(
+            data=stats,
+            baseline_low=stats[0, test_names.index(baseline_low)],
+            baseline_high=stats[0, test_names.index(baseline_high)],
+            scaling_factor=scaling_factor)
+        for kk, key in enumerate(keys):
+            comparison['scaled_%s' % key] = scaled[kk]
+        keys = keys + ['scaled_%s' % key for key in keys]
+
+    comparison['table'] = [
+        dict({'test_name': test_name, 'time_derivative': time_derivative,
+              'run': run},
+             **{key: float(comparison[key][ii, jj, run]) for key in keys})
+        for ii, test_name in enumerate(test_names)
+        for jj, time_derivative in enumerate(time_derivatives)
+        for run in range(runs)]
+
+    return comparison
@@ -12,6 +12,7 @@
     specified for each function (EX: testing if a renamed group exists).
 '''
 import pytest
+import h5py
 import numpy as np
 
 from abr_analyze.data_handler import DataHandler
@@ -227,3 +228,146 @@ def test_rename_dataset():
     # check if the new location exists
     exists = dat.check_group_exists(location=new_save_location, create=False)
     assert exists is True
+
+
+def test_read_only():
+    dat = DataHandler('tests')
+    dat.save(data={'float': 3.14},
+             save_location='test_read_only',
+             overwrite=True)
+
+    dat_read = DataHandler('tests', read_only=True)
+    loaded = dat_read.load(parameters=['float'],
+                           save_location='test_read_only')
+    assert loaded['float'] == 3.14
+
+    # groups are not created in read only mode
+    exists = dat_read.check_group_exists(
+        location='test_read_only_not_created', create=True)
+    assert exists is False
+
+    # and data can not be saved
+    with pytest.raises(Exception):
+        dat_read.save(data={'float': 3.14},
+                      save_location='test_read_only',
+                      overwrite=True)
+
+
+def test_get_modification_id():
+    dat = DataHandler('tests')
+    dat.save(data={'array': np.ones(100), 'other': np.zeros(3)},
+             save_location='test_modification_id',
+             overwrite=True)
+
+    modification_id = dat.get_modification_id(
+        save_location='test_modification_id', parameters=['array'])
+    assert modification_id == dat.get_modification_id(
+        save_location='test_modification_id', parameters=['array'])
+
+    # changing the data changes the id
+    dat.delete(save_location='test_modification_id/array')
+    dat.save(data={'array': np.ones(100) * 2},
+             save_location='test_modification_id',
+             overwrite=True, timestamp=False)
+    assert modification_id != dat.get_modification_id(
+        save_location='test_modification_id', parameters=['array'])
+
+    # changing a single row in the same second without a timestamp changes
+    # the id
+    modification_id = dat.get_modification_id(
+        save_location='test_modification_id', parameters=['array'])
+    array = np.ones(100) * 2
+    array[1] = 3
+    dat.delete(save_location='test_modification_id/array')
+    dat.save(data={'array': array}, save_location='test_modification_id',
+             overwrite=True, timestamp=False)
+    assert modification_id != dat.get_modification_id(
+        save_location='test_modification_id', parameters=['array'])
+
+    # appending changes the id
+    modification_id = dat.get_modification_id(
+        save_location='test_modification_id_append')
+    dat.append(data={'array': np.ones((5, 2))},
+               save_location='test_modification_id_append')
+    appended_id = dat.get_modification_id(
+        save_location='test_modification_id_append')
+    assert appended_id != modification_id
+    dat.append(data={'array': np.ones((5, 2))},
+               save_location='test_modification_id_append')
+    assert appended_id != dat.get_modification_id(
+        save_location='test_modification_id_append')
+
+    # saving the hash with the data gives the same id
+    dat.save(data={'array': array}, save_location='test_modification_id_hash',
+             overwrite=True, timestamp=False, hash_data=True)
+    assert dat.get_modification_id(
+        save_location='test_modification_id_hash') == dat.get_modification_id(
+            save_location='test_modification_id', parameters=['array'])
+
+    # datasets without a saved hash are hashed in full once, and the hash is
+    # saved with them unless the DataHandler is read only
+    with h5py.File(dat.db_loc, 'a') as db:
+        db.require_group('test_modification_id_h5py').create_dataset(
+            'array', data=np.zeros(50))
+    dat_read = DataHandler('tests', read_only=True)
+    modification_id = dat_read.get_modification_id(
+        save_location='test_modification_id_h5py', chunk_size=7)
+    with h5py.File(dat.db_loc, 'r') as db:
+        assert 'sha1' not in db['test_modification_id_h5py/array'].attrs
+    assert modification_id == dat.get_modification_id(
+        save_location='test_modification_id_h5py', chunk_size=7)
+    with h5py.File(dat.db_loc, 'r') as db:
+        assert 'sha1' in db['test_modification_id_h5py/array'].attrs
+    assert modification_id == dat.get_modification_id(
+        save_location='test_modification_id_h5py', chunk_size=7)
+
+    # data modified in place is hashed again once its saved hash is removed
+    with h5py.File(dat.db_loc, 'a') as db:
+        db['test_modification_id_h5py/array'][33] = 1
+        del db['test_modification_id_h5py/array'].attrs['sha1']
+    assert modification_id != dat.get_modification_id(
+        save_location='test_modification_id_h5py', chunk_size=7)
+
+    assert dat.get_modification_id(save_location='not_a_location') is None
+
+
+@pytest.mark.parametrize('chunk_size, overlap', ((10, 0), (7, 3), (100, 2)))
+def test_load_chunks(chunk_size, overlap):
+    dat = DataHandler('tests')
+    data = {'array': np.arange(50), 'matrix': np.arange(150).reshape(50, 3)}
+    save_location = 'test_load_chunks_%i' % chunk_size
+    dat.save(data=data, save_location=save_location, overwrite=True)
+
+    stops = []
+    for start, stop, chunk in dat.load_chunks(
+            parameters=['array', 'matrix'], save_location=save_location,
+            chunk_size=chunk_size, overlap=overlap):
+        low = max(start - overlap, 0)
+        high = min(stop + overlap, 50)
+        assert np.array_equal(chunk['array'], data['array'][low:high])
+        assert np.array_equal(chunk['matrix'], data['matrix'][low:high])
+        stops.append(stop)
+    assert stops[-1] == 50
+    assert len(stops) == int(np.ceil(50 / chunk_size))
+
+    # scalars and missing keys can not be loaded in chunks
+    for parameters in (['array', 'timestamp'], ['array', 'not_a_key']):
+        with pytest.raises(ValueError):
+            next(dat.load_chunks(
+                parameters=parameters, save_location=save_location))
+
+
+def test_append():
+    dat = DataHandler('tests')
+    if dat.check_group_exists('test_append'):
+        dat.delete(save_location='test_append')
+    chunks = [np.random.rand(n_rows, 3) for n_rows in (5, 1, 10)]
+    for chunk in chunks:
+        dat.append(data={'array': chunk}, save_location='test_append')
+
+    loaded = dat.load(parameters=['array'], save_location='test_append')
+    assert np.array_equal(loaded['array'], np.vstack(chunks))
+
+    with pytest.raises(ValueError):
+        dat.append(data={'array': np.zeros((2, 4))},
+                   save_location='test_append')
@@ -1,3 +1,6 @@
+import gc
+import time
+
 import matplotlib.pyplot as plt
 import numpy as np
 import pytest
@@ -149,6 +152,180 @@ def test_load_and_process(interpolated_samples, parameters):
     load_and_process(interpolated_samples, parameters)
 
 
+@pytest.mark.parametrize('resample, interpolated_samples, dt', (
+    ('linear', 50, None),
+    ('fixed_dt', None, 0.05),
+    ('decimate', 50, None),
+    ('stride', 50, None),
+    ('raw', 50, None),
+    ))
+def test_load_and_process_resample(resample, interpolated_samples, dt):
+    dat = DataHandler('tests')
+    loc = 'resample_%s' % resample
+    steps = 400
+    fake_traj_data = random_trajectories.generate(steps=steps, plot=False)
+    dat.save(data=fake_traj_data, save_location=loc, overwrite=True)
+    parameters = ['ee_xyz', 'ideal_trajectory', 'time']
+
+    data = proc.load_and_process(
+        db_name='tests',
+        save_location=loc,
+        parameters=parameters,
+        interpolated_samples=interpolated_samples,
+        resample=resample,
+        dt=dt)
+
+    sample_times = np.cumsum(fake_traj_data['time'])
+    n_samples = len(data['cumulative_time'])
+    for key in ['ee_xyz', 'ideal_trajectory']:
+        assert data[key].shape == (n_samples, 3)
+    # time is resampled with the other parameters
+    assert data['time'].shape == (n_samples,)
+    assert np.allclose(np.cumsum(data['time']), data['cumulative_time'])
+    # every strategy uses the same time origin
+    assert np.isclose(data['cumulative_time'][0], sample_times[0])
+    assert data['cumulative_time'][-1] <= sample_times[-1] + 1e-12
+
+    if resample in ('linear', 'fixed_dt', 'raw'):
+        # the data is sampled at the returned times
+        assert np.allclose(
+            data['ee_xyz'][:, 0],
+            np.interp(data['cumulative_time'], sample_times,
+                      np.asarray(fake_traj_data['ee_xyz'])[:, 0]))
+
+    if resample == 'fixed_dt':
+        assert np.allclose(np.diff(data['cumulative_time']), dt)
+        # linear interpolation of each column matches np.interp
+        assert np.allclose(
+            data['ee_xyz'][:, 1],
+            np.interp(data['cumulative_time'], sample_times,
+                      fake_traj_data['ee_xyz'][:, 1]))
+    elif resample in ('decimate', 'stride'):
+        factor = steps // interpolated_samples
+        assert n_samples == int(np.ceil(steps / factor))
+        assert np.allclose(data['cumulative_time'], sample_times[::factor])
+        if resample == 'stride':
+            assert np.array_equal(
+                data['ee_xyz'], fake_traj_data['ee_xyz'][::factor])
+        else:
+            # filtering should remove some of the high frequency noise
+            assert np.all(np.abs(
+                data['ee_xyz'][5:-5]
+                - fake_traj_data['ee_xyz'][::factor][5:-5]) < 0.05)
+    elif resample == 'raw':
+        assert n_samples == steps
+        assert np.array_equal(data['ee_xyz'], fake_traj_data['ee_xyz'])
+    else:
+        assert n_samples == interpolated_samples
+
+
+@pytest.mark.parametrize('interpolated_samples', (50, None))
+def test_load_and_process_default(interpolated_samples):
+    dat = DataHandler('tests')
+    loc = 'resample_default_%s' % interpolated_samples
+    steps = 400
+    fake_traj_data = random_trajectories.generate(steps=steps, plot=False)
+    dat.save(data=fake_traj_data, save_location=loc, overwrite=True)
+
+    data = proc.load_and_process(
+        db_name='tests',
+        save_location=loc,
+        parameters=['ee_xyz', 'time'],
+        interpolated_samples=interpolated_samples)
+
+    # without a resample strategy the original output is returned
+    time = fake_traj_data['time']
+    if interpolated_samples is None:
+        ee_xyz = fake_traj_data['ee_xyz']
+        n_samples = steps
+    else:
+        ee_xyz = proc.interpolate_data(
+            data=fake_traj_data['ee_xyz'], time_intervals=time,
+            interpolated_samples=interpolated_samples)
+        n_samples = interpolated_samples
+    assert np.array_equal(data['ee_xyz'], ee_xyz)
+    assert np.array_equal(data['time'], time)
+    assert np.array_equal(
+        data['cumulative_time'], np.linspace(0, np.sum(time), n_samples))
+
+
+@pytest.mark.parametrize('resample', ('linear', 'fixed_dt', 'decimate',
+                                      'stride', 'raw'))
+def test_load_and_process_only_time(resample):
+    dat = DataHandler('tests')
+    loc = 'only_time_%s' % resample
+    time = np.full(100, 0.01)
+    dat.save(data={'time': time}, save_location=loc, overwrite=True)
+
+    data = proc.load_and_process(
+        db_name='tests',
+        save_location=loc,
+        parameters=['time'],
+        interpolated_samples=20,
+        resample=resample,
+        dt=0.05)
+
+    assert np.isclose(data['cumulative_time'][0], 0.01)
+    assert np.all(np.diff(data['cumulative_time']) > 0)
+    assert len(data['time']) == len(data['cumulative_time'])
+
+
+def test_load_and_process_resample_invalid():
+    dat = DataHandler('tests')
+    dat.save(data=random_trajectories.generate(steps=20, plot=False),
+             save_location='resample_invalid', overwrite=True)
+    with pytest.raises(ValueError):
+        proc.load_and_process(
+            db_name='tests',
+            save_location='resample_invalid',
+            parameters=['ee_xyz', 'time'],
+            resample='cubic')
+
+
+def _add_to_state(state, value):
+    return state + value
+
+
+@pytest.mark.parametrize('n_workers', (1, 2))
+def test_map_in_workers(n_workers):
+    results = list(proc.map_in_workers(
+        _add_to_state, [(ii,) for ii in range(7)], initializer=int,
+        initargs=(10,), n_workers=n_workers, max_in_flight=3))
+    assert results == list(range(10, 17))
+    # the state is not kept in this process
+    assert proc._worker_state is None # pylint: disable=W0212
+
+
+@pytest.mark.parametrize('n_workers', (1, 2))
+def test_load_and_process_many(n_workers):
+    dat = DataHandler('tests')
+    parameters = ['ee_xyz', 'ideal_trajectory', 'time']
+    locations = ['load_many_%i/run%03d' % (n_workers, ii) for ii in range(5)]
+    for loc in locations:
+        dat.save(data=random_trajectories.generate(steps=50, plot=False),
+                 save_location=loc, overwrite=True)
+
+    results = proc.load_and_process_many(
+        db_name='tests',
+        locations=locations,
+        parameters=parameters,
+        interpolated_samples=20,
+        n_workers=n_workers,
+        max_in_flight=2)
+
+    assert len(results) == len(locations)
+    for loc, data in zip(locations, results):
+        expected = proc.load_and_process(
+            db_name='tests',
+            save_location=loc,
+            parameters=parameters,
+            interpolated_samples=20)
+        assert data['read_location'] == loc
+        assert data['process_time'] >= 0
+        for key in parameters + ['cumulative_time']:
+            assert np.array_equal(data[key], expected[key])
+
+
 def test_calc_cartesion_points():
     db = 'tests'
     dat = DataHandler(db)
@@ -185,3 +362,341 @@ def test_calc_cartesion_points():
                 ('Expected %i Received %i'
                  % (expected_shape[ii][jj],
                     np.asarray(data[ii]).shape[jj])))
+
+
+def test_calc_cartesian_points_batched():
+    sympy = pytest.importorskip('sympy')
+
+    class fake_sympy_robot_config():
+        # planar two link arm with the transforms defined in sympy, the same
+        # way abr_control configs define them
+        def __init__(self):
+            self.N_JOINTS = 2
+            self.N_LINKS = 2
+            self.q = [sympy.Symbol('q%i' % ii) for ii in range(2)]
+            self.x = [sympy.Symbol('x'), sympy.Symbol('y'), sympy.Symbol('z')]
+            q0, q1 = self.q
+            self._T = {
+                'joint0': [0, 0, 0.5],
+                'joint1': [sympy.cos(q0), sympy.sin(q0), 0.5],
+                'EE': [sympy.cos(q0) + sympy.cos(q0 + q1),
+                       sympy.sin(q0) + sympy.sin(q0 + q1), 0.5],
+                'link0': [sympy.cos(q0)/2, sympy.sin(q0)/2, 0.5],
+                'link1': [sympy.cos(q0) + sympy.cos(q0 + q1)/2,
+                          sympy.sin(q0) + sympy.sin(q0 + q1)/2, 0.5],
+                }
+
+        def _calc_Tx(self, name, x=None, lambdify=True):
+            Tx = sympy.Matrix(self._T[name] + [1])
+            if lambdify:
+                return sympy.lambdify(self.q + self.x, Tx)
+            return Tx
+
+        def Tx(self, name, q, x=None):
+            return np.array(
+                self._calc_Tx(name)(*(tuple(q) + (0, 0, 0))),
+                dtype=float)[:-1].flatten()
+
+    robot_config = fake_sympy_robot_config()
+    q = np.random.uniform(-np.pi, np.pi, (50, robot_config.N_JOINTS))
+
+    joints, links, ee_xyz = proc.calc_cartesian_points(
+        robot_config=robot_config, q=q, use_cache=False)
+
+    for t, q_t in enumerate(q):
+        for ii in range(robot_config.N_JOINTS):
+            assert np.allclose(
+                joints[t, ii], robot_config.Tx('joint%i' % ii, q=q_t))
+        assert np.allclose(joints[t, -1], robot_config.Tx('EE', q=q_t))
+        assert np.allclose(ee_xyz[t], robot_config.Tx('EE', q=q_t))
+        for ii in range(robot_config.N_LINKS):
+            assert np.allclose(
+                links[t, ii], robot_config.Tx('link%i' % ii, q=q_t))
+
+    # a second call with the same joint angles is loaded from the cache
+    cached = proc.calc_cartesian_points(robot_config=robot_config, q=q)
+    cached_again = proc.calc_cartesian_points(robot_config=robot_config, q=q)
+    for val, cached_val in zip([joints, links, ee_xyz], cached_again):
+        assert np.array_equal(val, cached_val)
+    # and modifying the returned values does not affect the cache
+    cached[0] += 1
+    assert np.array_equal(
+        proc.calc_cartesian_points(robot_config=robot_config, q=q)[0], joints)
+
+    # the cached values are dropped with the robot_config
+    assert robot_config in proc._cartesian_points_cache
+    assert robot_config in proc._batched_Tx_cache
+    n_configs = len(proc._cartesian_points_cache)
+    del robot_config
+    gc.collect()
+    assert len(proc._cartesian_points_cache) == n_configs - 1
+
+
+def test_pipeline(monkeypatch):
+    dat = DataHandler('tests')
+    sessions = 2
+    runs = 3
+    locations = []
+    for session in range(sessions):
+        for run in range(runs):
+            loc = 'pipeline/session%03d/run%03d' % (session, run)
+            dat.save(data=random_trajectories.generate(steps=60, plot=False),
+                     save_location=loc, overwrite=True)
+            locations.append(loc)
+
+    parameters = ['ee_xyz', 'ideal_trajectory', 'time']
+    pipeline = (proc.Pipeline('tests', locations, chunk_size=4)
+                .load(parameters, interpolated_samples=40, cache=True)
+                .differentiate(['ee_xyz', 'ideal_trajectory'], order=1)
+                .norm('ee_xyz', 'ideal_trajectory', name='error')
+                .reduce('error', np.sum, name='summed_error')
+                .bootstrap('summed_error', shape=(sessions, runs)))
+    results = pipeline.run()
+
+    assert len(results['data']) == len(locations)
+    summed_errors = []
+    for loc, data in zip(locations, results['data']):
+        expected = proc.load_and_process(
+            db_name='tests', save_location=loc, parameters=parameters,
+            interpolated_samples=40, resample='linear')
+        dt = np.mean(np.diff(expected['cumulative_time']))
+        error = np.linalg.norm(
+            np.gradient(expected['ee_xyz'], dt, axis=0)
+            - np.gradient(expected['ideal_trajectory'], dt, axis=0), axis=1)
+        assert data['read_location'] == loc
+        assert np.allclose(data['error'], error)
+        assert np.isclose(data['summed_error'], np.sum(error))
+        summed_errors.append(data['summed_error'])
+    assert np.allclose(
+        results['bootstrap']['mean'],
+        np.mean(np.reshape(summed_errors, (sessions, runs)), axis=0))
+
+    # changing a stage after the cached load stage does not reload the data
+    calls = []
+    load_and_process = proc.load_and_process
+
+    def counted_load_and_process(**kwargs):
+        calls.append(kwargs['save_location'])
+        return load_and_process(**kwargs)
+    monkeypatch.setattr(proc, 'load_and_process', counted_load_and_process)
+
+    base = proc.Pipeline('tests', locations, keep=['error'])
+    pipeline = base.load(parameters, interpolated_samples=40, cache=True)
+    pipeline.norm('ee_xyz', 'ideal_trajectory', name='error').run()
+    assert len(calls) == len(locations)
+    calls.clear()
+    results = pipeline.norm('ee_xyz', name='error').run()
+    assert len(calls) == 0
+    assert list(results['data'][0].keys()) == ['error']
+
+    # changing the load stage does reload the data
+    results = (base.load(parameters, interpolated_samples=20, cache=True)
+               .norm('ee_xyz', name='error').run())
+    assert len(calls) == len(locations)
+    assert len(results['data'][0]['error']) == 20
+
+    # modifying the results does not change the cached data
+    pipeline = proc.Pipeline('tests', locations).load(
+        parameters, interpolated_samples=20, cache=True)
+    results = pipeline.run()
+    expected = np.copy(results['data'][0]['ee_xyz'])
+    results['data'][0]['ee_xyz'][:] = 0
+    results['data'][0]['ee_xyz'] = None
+    results = pipeline.run()
+    assert np.array_equal(results['data'][0]['ee_xyz'], expected)
+
+    # saving new data to a location reloads it
+    calls.clear()
+    dat.delete(save_location=locations[0])
+    dat.save(data=random_trajectories.generate(steps=60, plot=False),
+             save_location=locations[0])
+    results = pipeline.run()
+    assert calls == [locations[0]]
+    assert not np.array_equal(results['data'][0]['ee_xyz'], expected)
+    assert np.array_equal(
+        results['data'][0]['ee_xyz'],
+        load_and_process(
+            db_name='tests', save_location=locations[0],
+            parameters=parameters, interpolated_samples=20,
+            resample='linear')['ee_xyz'])
+
+
+@pytest.mark.parametrize('interpolated_samples, resample, dt', (
+    (30, 'linear', None),
+    (None, 'fixed_dt', 0.05),
+    (None, 'raw', None),
+    ))
+def test_load_run_array(interpolated_samples, resample, dt):
+    dat = DataHandler('tests')
+    test_name = 'run_array_%s' % resample
+    # session 1 is missing its last run and the runs have different lengths
+    structure = {0: [0, 1, 2], 1: [0, 1]}
+    saved = {}
+    for session, runs in structure.items():
+        for run in runs:
+            data = random_trajectories.generate(
+                steps=40 + 10 * run, plot=False)
+            dat.save(data=data, save_location='%s/session%03d/run%03d'
+                     % (test_name, session, run), overwrite=True)
+            saved[(session, run)] = data
+
+    assert proc.get_sessions_and_runs('tests', test_name) == structure
+
+    data = proc.load_run_array(
+        db_name='tests', test_name=test_name, parameter='ee_xyz',
+        interpolated_samples=interpolated_samples, resample=resample, dt=dt)
+
+    assert data['sessions'] == [0, 1]
+    assert data['runs'] == [0, 1, 2]
+    assert data['data'].shape[:3] == data['mask'].shape
+    assert data['data'].shape[3] == 3
+    # the missing run is masked out
+    assert not np.any(data['mask'][1, 2])
+    assert np.all(np.isnan(data['data'][1, 2]))
+
+    for (session, run), saved_data in saved.items():
+        expected = proc.load_and_process(
+            db_name='tests',
+            save_location='%s/session%03d/run%03d' % (test_name, session, run),
+            parameters=['ee_xyz', 'time'],
+            interpolated_samples=interpolated_samples,
+            resample=resample, dt=dt)['ee_xyz']
+        length = np.sum(data['mask'][session, run])
+        assert length == len(expected)
+        assert np.allclose(data['data'][session, run, :length], expected)
+
+    # limiting the number of sessions and runs
+    data = proc.load_run_array(
+        db_name='tests', test_name=test_name, parameter='ee_xyz',
+        sessions=1, runs=2, interpolated_samples=interpolated_samples,
+        resample=resample, dt=dt)
+    assert data['data'].shape[:2] == (1, 2)
+    assert np.all(data['mask'][:, :, 0])
+
+    # time is sampled the same way as the other parameters
+    ee_xyz = proc.load_run_array(
+        db_name='tests', test_name=test_name, parameter='ee_xyz',
+        interpolated_samples=interpolated_samples, resample=resample, dt=dt)
+    time = proc.load_run_array(
+        db_name='tests', test_name=test_name, parameter='time',
+        interpolated_samples=interpolated_samples, resample=resample, dt=dt)
+    assert time['data'].shape == ee_xyz['data'].shape[:3] + (1,)
+    assert np.array_equal(time['mask'], ee_xyz['mask'])
+    assert np.allclose(
+        np.nancumsum(time['data'][..., 0], axis=2)[time['mask']],
+        time['cumulative_time'][time['mask']])
+
+    with pytest.raises(ValueError):
+        proc.load_run_array(
+            db_name='tests', test_name=test_name, parameter='time',
+            resample=None)
+
+
+@pytest.mark.parametrize('method, order', (
+    ('gradient', 1), ('gradient', 2), ('savgol', 1), ('savgol', 2),
+    ('savgol', 3),
+    ))
+def test_time_derivative(method, order):
+    # non-uniform sample times
+    time = np.cumsum(np.random.uniform(0.008, 0.012, 500))
+    # a polynomial in each dimension, whose derivatives are known
+    # quadratic for central differences, quartic for the savgol polynomial
+    n_coefficients = 3 if method == 'gradient' else 5
+    coefficients = np.random.uniform(-1, 1, (4, n_coefficients))
+    data = np.stack([np.polyval(c, time) for c in coefficients], axis=1)
+    expected = np.stack(
+        [np.polyval(np.polyder(c, order), time) for c in coefficients],
+        axis=1)
+
+    if method == 'gradient':
+        derivative = proc.time_derivative(
+            data, order=order, time_vector=time, method=method)
+        # central differences are exact for quadratics at the interior
+        assert np.allclose(
+            derivative[order:-order], expected[order:-order])
+    else:
+        # savgol treats the samples as evenly spaced
+        time = np.linspace(time[0], time[-1], len(time))
+        data = np.stack([np.polyval(c, time) for c in coefficients], axis=1)
+        expected = np.stack(
+            [np.polyval(np.polyder(c, order), time) for c in coefficients],
+            axis=1)
+        derivative = proc.time_derivative(
+            data, order=order, time_vector=time, method=method,
+            window_length=11, polyorder=4)
+        assert np.allclose(derivative, expected, atol=1e-6)
+
+    # a batch of runs is differentiated the same as each run
+    batch = np.stack([data, 2*data])
+    batch_derivative = proc.time_derivative(
+        batch, order=order, time_vector=time, method=method, axis=1,
+        polyorder=4)
+    assert np.allclose(batch_derivative[0], derivative)
+    assert np.allclose(batch_derivative[1], 2*derivative)
+
+
+def test_time_derivative_errors():
+    data = np.random.rand(20, 3)
+    with pytest.raises(ValueError):
+        proc.time_derivative(data, order=1)
+    with pytest.raises(ValueError):
+        proc.time_derivative(data, order=3, dt=0.1, method='savgol',
+                             polyorder=2)
+    with pytest.raises(ValueError):
+        proc.time_derivative(data, order=1, dt=0.1, method='spline')
+
+
+@pytest.mark.parametrize('n, m, band', (
+    (30, 30, 3), (30, 25, 2), (25, 30, 10), (40, 40, None), (1, 5, None),
+    ))
+@pytest.mark.parametrize('use_numba', (False, True))
+def test_dtw(n, m, band, use_numba):
+    if use_numba:
+        pytest.importorskip('numba')
+    x = np.random.rand(n, 3)
+    y = np.random.rand(m, 3)
+
+    # full cumulative cost matrix, limited to the band
+    width = max(n, m) if band is None else max(band, abs(n - m))
+    cumulative = np.full((n+1, m+1), np.inf)
+    cumulative[0, 0] = 0
+    for ii in range(1, n+1):
+        for jj in range(1, m+1):
+            if abs(ii - jj) <= width:
+                cumulative[ii, jj] = (
+                    np.linalg.norm(x[ii-1] - y[jj-1])
+                    + min(cumulative[ii-1, jj], cumulative[ii, jj-1],
+                          cumulative[ii-1, jj-1]))
+
+    distance, path = proc.dtw(
+        x, y, band=band, return_path=True, use_numba=use_numba)
+    assert np.isclose(distance, cumulative[n, m])
+    # the path starts and ends at the ends of both trajectories, and its
+    # cost is the distance
+    assert np.array_equal(path[0], [0, 0])
+    assert np.array_equal(path[-1], [n-1, m-1])
+    assert np.all(np.diff(path, axis=0) >= 0)
+    assert np.isclose(
+        np.sum(np.linalg.norm(x[path[:, 0]] - y[path[:, 1]], axis=1)),
+        distance)
+
+
+def test_dtw_benchmark():
+    pytest.importorskip('numba')
+    # compile the kernel before timing
+    proc.dtw(np.zeros((2, 3)), np.zeros((2, 3)), use_numba=True)
+    x = np.random.rand(10000, 3)
+    y = np.random.rand(10000, 3)
+
+    results = []
+    for use_numba in [False, True]:
+        start = time.time()
+        results.append(proc.dtw(
+            x, y, band=100, return_path=True, use_numba=use_numba))
+        print('10k sample DTW with a band of 100, numba=%s: %.3f s'
+              % (use_numba, time.time() - start))
+
+    # both kernels fill in the same cumulative cost matrix
+    (numpy_distance, numpy_path), (numba_distance, numba_path) = results
+    assert np.isclose(numpy_distance, numba_distance)
+    assert np.array_equal(numpy_path, numba_path)